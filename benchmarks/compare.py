@@ -0,0 +1,52 @@
+"""
+Compares two benchmark results from benchmarks.run, scenario by scenario,
+and exits non-zero if any got slower or ran more queries than allowed.
+
+    python -m benchmarks.compare before.json after.json --threshold 1.2
+"""
+
+import argparse
+import json
+import sys
+
+METRICS = ["p50_ms", "p99_ms", "queries_per_request"]
+
+
+def compare(before: dict, after: dict, threshold: float) -> tuple[list[str], bool]:
+    lines = [f"{'scenario':<26}" + "".join(f"{m:>24}" for m in METRICS)]
+    regressed = False
+    for name, new in after["scenarios"].items():
+        old = before["scenarios"].get(name)
+        if old is None:
+            continue
+        cells = []
+        for metric in METRICS:
+            ratio = new[metric] / old[metric] if old[metric] else 1.0
+            # query counts are exact, so any increase is a regression
+            limit = 1.0 if metric == "queries_per_request" else threshold
+            flag = "!" if ratio > limit else " "
+            regressed |= ratio > limit
+            cells.append(f"{old[metric]:>9} -> {new[metric]:<9} {flag}")
+        lines.append(f"{name:<26}" + "".join(f"{c:>24}" for c in cells))
+    return lines, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=1.2)
+    args = parser.parse_args()
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    if before["params"] != after["params"]:
+        print("warning: the runs used different parameters", file=sys.stderr)
+    lines, regressed = compare(before, after, args.threshold)
+    print("\n".join(lines))
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Measures GET /users/{id} latency on its own and while full GET /users/
+listings run in parallel. With the point lookups on the async engine and
+the listing in the threadpool, p99 should stay roughly flat.
+
+    python -m benchmarks.concurrency --users 5000 --lookups 500
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from .stats import summarize
+
+
+def seed(engine, users: int):
+    from sqlalchemy import insert
+    from hpcadmin_server.database.models import User
+
+    rows = [
+        {
+            "username": f"user{i}",
+            "firstname": "User",
+            "lastname": f"Number{i}",
+            "email": f"user{i}@example.org",
+            "is_pi": i % 50 == 0,
+        }
+        for i in range(users)
+    ]
+    with engine.begin() as connection:
+        connection.execute(insert(User), rows)
+
+
+async def lookups(client, user_ids: list[int], count: int) -> list[float]:
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        response = await client.get(f"/users/{user_ids[i % len(user_ids)]}")
+        samples.append(time.perf_counter() - start)
+        assert response.status_code == 200
+    return samples
+
+
+async def listings(client, stop: asyncio.Event) -> int:
+    done = 0
+    while not stop.is_set():
+        response = await client.get("/users/")
+        assert response.status_code == 200
+        done += 1
+    return done
+
+
+async def run(users: int, count: int, listers: int) -> dict:
+    import httpx
+    import main
+    from hpcadmin_server.database import db, migrations
+
+    migrations.upgrade(db.engine)
+    seed(db.engine, users)
+    user_ids = list(range(1, users + 1))
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as c:
+        idle = await lookups(c, user_ids, count)
+        stop = asyncio.Event()
+        background = [asyncio.create_task(listings(c, stop)) for _ in range(listers)]
+        # let the listings get going before measuring
+        await asyncio.sleep(0.1)
+        loaded = await lookups(c, user_ids, count)
+        stop.set()
+        full_listings = sum(await asyncio.gather(*background))
+    return {
+        "users": users,
+        "parallel_listings": listers,
+        "full_listings_completed": full_listings,
+        "get_user_idle": summarize(idle),
+        "get_user_during_listing": summarize(loaded),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--lookups", type=int, default=500)
+    parser.add_argument("--listers", type=int, default=1)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # the engines are built from settings at import time
+        os.environ["HPCADMIN_DATABASE_URL"] = f"sqlite:///{tmpdir}/bench.db"
+        result = asyncio.run(run(args.users, args.lookups, args.listers))
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Seeded synthetic HPC directory: users, the pirgs they belong to and the
+groups inside those pirgs.
+
+Membership follows a power law, like a real cluster: most pirgs are a
+handful of people, a few are hundreds or thousands. Groups nest inside their
+pirg, so a group's members are always drawn from the pirg's members. The same
+arguments always produce the same directory, so runs on different commits
+measure the same data.
+"""
+
+import random
+from dataclasses import dataclass, field
+
+
+@dataclass
+class Directory:
+    users: list[dict] = field(default_factory=list)
+    pirgs: list[dict] = field(default_factory=list)
+    groups: list[dict] = field(default_factory=list)
+    # (pirg or group id, user id)
+    pirg_users: list[tuple[int, int]] = field(default_factory=list)
+    pirg_admins: list[tuple[int, int]] = field(default_factory=list)
+    group_users: list[tuple[int, int]] = field(default_factory=list)
+    pirg_members: dict[int, list[int]] = field(default_factory=dict)
+
+
+def _power_law(rng: random.Random, alpha: float, low: int, high: int) -> int:
+    return min(high, int(low * rng.paretovariate(alpha)))
+
+
+def generate(
+    users: int,
+    pirgs: int,
+    seed: int = 0,
+    alpha: float = 1.2,
+    groups_per_pirg: int = 3,
+) -> Directory:
+    """
+    `users` includes the `pirgs` pis, one owning each pirg and sponsoring
+    the users that aren't pis. Smaller `alpha` gives a heavier tail of large
+    pirgs.
+    """
+    if pirgs < 1 or users <= pirgs:
+        raise ValueError("Need at least one pirg and more users than pirgs")
+    rng = random.Random(seed)
+    d = Directory()
+    pi_ids = list(range(1, pirgs + 1))
+    for id in range(1, users + 1):
+        is_pi = id <= pirgs
+        d.users.append(
+            {
+                "id": id,
+                "username": f"{'pi' if is_pi else 'user'}{id}",
+                "firstname": "Bench",
+                "lastname": f"User{id}",
+                "email": f"user{id}@example.org",
+                "is_pi": is_pi,
+                "sponsor_id": None if is_pi else rng.choice(pi_ids),
+            }
+        )
+    others = list(range(pirgs + 1, users + 1))
+    group_id = 0
+    for pirg_id, owner_id in enumerate(pi_ids, start=1):
+        d.pirgs.append({"id": pirg_id, "name": f"pirg{pirg_id}", "owner_id": owner_id})
+        members = rng.sample(others, _power_law(rng, alpha, 2, len(others)))
+        d.pirg_members[pirg_id] = members
+        d.pirg_users += [(pirg_id, user_id) for user_id in members]
+        admins = members[: rng.randint(0, 2)]
+        d.pirg_admins += [(pirg_id, user_id) for user_id in admins]
+        for g in range(rng.randint(0, 2 * groups_per_pirg)):
+            group_id += 1
+            d.groups.append(
+                {"id": group_id, "name": f"pirg{pirg_id}_g{g}", "pirg_id": pirg_id}
+            )
+            size = _power_law(rng, alpha, 1, len(members))
+            d.group_users += [(group_id, u) for u in rng.sample(members, size)]
+    return d
+
+
+def seed(engine, d: Directory) -> None:
+    """
+    Bulk insert `d` into a migrated, empty database.
+    """
+    from sqlalchemy import insert
+    from hpcadmin_server.database import migrations, models
+
+    with engine.begin() as connection:
+        connection.execute(insert(models.User), d.users)
+        connection.execute(insert(models.Pirg), d.pirgs)
+        if d.groups:
+            connection.execute(insert(models.Group), d.groups)
+        for table, parent, rows in [
+            (models.pirg_user_association_table, "pirg_id", d.pirg_users),
+            (models.pirg_admin_association_table, "pirg_id", d.pirg_admins),
+            (models.group_user_association_table, "group_id", d.group_users),
+        ]:
+            if rows:
+                connection.execute(
+                    insert(table), [{parent: p, "user_id": u} for p, u in rows]
+                )
+    # the rows went in around crud, so the memberships it keeps are derived
+    # the way the migration derives them for an existing database
+    migrations.run_backfill(engine, migrations.backfill_memberships)
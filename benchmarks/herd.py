@@ -0,0 +1,85 @@
+"""
+Measures a thundering herd: many clients asking for the same full listing
+at once, as nodes do at the top of the hour, with the single-flight
+coalescing on and off.
+
+    python -m benchmarks.herd --clients 200 --rounds 5
+"""
+
+import argparse
+import asyncio
+import dataclasses
+import json
+import os
+import statistics
+import tempfile
+import time
+
+PATHS = ["/pirgs/", "/groups/"]
+
+
+async def herd(client, path: str, clients: int) -> float:
+    start = time.perf_counter()
+    responses = await asyncio.gather(*(client.get(path) for _ in range(clients)))
+    assert all(r.status_code == 200 for r in responses)
+    return time.perf_counter() - start
+
+
+async def run(users: int, pirgs: int, clients: int, rounds: int) -> dict:
+    import httpx
+    from sqlalchemy import event
+
+    from hpcadmin_server.api import pagination
+    from hpcadmin_server.app import create_app
+    from hpcadmin_server.database import db, migrations
+
+    from .generator import generate, seed
+
+    migrations.upgrade(db.engine)
+    seed(db.engine, generate(users, pirgs))
+    app = create_app()
+    statements = 0
+
+    def count(*args):
+        nonlocal statements
+        statements += 1
+
+    event.listen(db.engine, "before_cursor_execute", count)
+    settings = pagination.settings
+    result = {"users": users, "pirgs": pirgs, "clients": clients, "rounds": rounds}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as c:
+        for single_flight in (False, True):
+            pagination.settings = dataclasses.replace(
+                settings, single_flight=single_flight
+            )
+            mode = result["single_flight" if single_flight else "uncoalesced"] = {}
+            for path in PATHS:
+                # the first request compiles the statements
+                await c.get(path)
+                statements = 0
+                seconds = [await herd(c, path, clients) for _ in range(rounds)]
+                mode[path] = {
+                    "herd_ms": round(statistics.median(seconds) * 1000, 3),
+                    "statements_per_herd": statements / rounds,
+                }
+    pagination.settings = settings
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=40000)
+    parser.add_argument("--pirgs", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # the engines are built from settings at import time
+        os.environ["HPCADMIN_DATABASE_URL"] = f"sqlite:///{tmpdir}/bench.db"
+        result = asyncio.run(run(args.users, args.pirgs, args.clients, args.rounds))
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Runs every scenario against a generated directory in a file backed SQLite
+database, in process through the ASGI transport, and writes throughput,
+latency percentiles, queries per request and peak RSS as JSON.
+
+    python -m benchmarks.run --users 40000 --pirgs 2000 --out before.json
+    python -m benchmarks.compare before.json after.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+
+from sqlalchemy import event
+
+from .generator import generate, seed
+from .stats import peak_rss_mb, summarize
+
+
+class Recorder:
+    """
+    Makes requests, timing each one and counting the statements they run.
+    """
+
+    def __init__(self, client, engines):
+        self.client = client
+        self.samples: list[float] = []
+        self.queries = 0
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, conn, cursor, statement, *args):
+        if not statement.startswith("BEGIN"):
+            self.queries += 1
+
+    async def __call__(self, method: str, url: str, status: int = 200, **kwargs):
+        start = time.perf_counter()
+        response = await self.client.request(method, url, **kwargs)
+        self.samples.append(time.perf_counter() - start)
+        if response.status_code != status:
+            raise AssertionError(
+                f"{method} {url}: {response.status_code} {response.text[:200]}"
+            )
+        return response
+
+    def reset(self):
+        self.samples = []
+        self.queries = 0
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    # everything importing the settings has to wait for the database url
+    import httpx
+    import main
+    from hpcadmin_server.database import async_db, db, migrations
+
+    from .scenarios import SCENARIOS
+
+    migrations.upgrade(db.engine)
+    start = time.perf_counter()
+    directory = generate(args.users, args.pirgs, seed=args.seed, alpha=args.alpha)
+    seed(db.engine, directory)
+    seeded = time.perf_counter() - start
+
+    engines = [db.engine]
+    if async_db.async_engine is not None:
+        engines.append(async_db.async_engine.sync_engine)
+    rng = random.Random(args.seed)
+    state = {}
+    results = {}
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as c:
+        request = Recorder(c, engines)
+        for s in SCENARIOS:
+            if args.only and s.name not in args.only:
+                continue
+            request.reset()
+            start = time.perf_counter()
+            await s.run(request, directory, rng, s.count(args.requests), state)
+            elapsed = time.perf_counter() - start
+            if not request.samples:
+                continue
+            results[s.name] = {
+                **summarize(request.samples),
+                "throughput_rps": round(len(request.samples) / elapsed, 1),
+                "queries_per_request": round(request.queries / len(request.samples), 2),
+                "peak_rss_mb": peak_rss_mb(),
+            }
+    return {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "params": {
+            "users": args.users,
+            "pirgs": args.pirgs,
+            "groups": len(directory.groups),
+            "memberships": len(directory.pirg_users) + len(directory.group_users),
+            "seed": args.seed,
+            "alpha": args.alpha,
+            "requests": args.requests,
+        },
+        "seed_seconds": round(seeded, 3),
+        "peak_rss_mb": peak_rss_mb(),
+        "scenarios": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=40000)
+    parser.add_argument("--pirgs", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--alpha", type=float, default=1.2)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--only", action="append", help="run just this scenario")
+    parser.add_argument("--out", help="write the results here instead of stdout")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # the engines are built from settings at import time
+        os.environ["HPCADMIN_DATABASE_URL"] = f"sqlite:///{tmpdir}/bench.db"
+        result = asyncio.run(run(args))
+    output = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+"""
+Scripted traffic for every route in api/users.py and api/pirgs.py.
+
+A scenario makes `count` timed requests through `request`, drawing its
+targets from the generated directory with `rng`. Scenarios run in the order
+they're defined, reads before writes, and the writes that undo each other
+(add then remove, create then delete) pass what they touched on in `state`.
+"""
+
+import json
+import random
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from hpcadmin_server.api.conditional import entity_etag
+from hpcadmin_server.api.pagination import NDJSON
+
+from .generator import Directory
+
+# full listings return every row, so they get a fraction of the requests
+HEAVY_SHARE = 20
+PAGE_SIZE = 100
+BATCH_SIZE = 50
+IMPORT_SIZE = 2000
+
+
+@dataclass(frozen=True)
+class Scenario:
+    name: str
+    run: Callable[..., Awaitable[None]]
+    heavy: bool = False
+
+    def count(self, requests: int) -> int:
+        return max(1, requests // HEAVY_SHARE) if self.heavy else requests
+
+
+SCENARIOS: list[Scenario] = []
+
+
+def scenario(name: str, heavy: bool = False):
+    def register(run):
+        SCENARIOS.append(Scenario(name, run, heavy))
+        return run
+
+    return register
+
+
+def _pirg(d: Directory, rng: random.Random) -> dict:
+    return rng.choice(d.pirgs)
+
+
+def _outsiders(d: Directory, rng: random.Random, pirg_id: int, n: int) -> list[int]:
+    # users that aren't already members of the pirg
+    members = set(d.pirg_members[pirg_id])
+    picked = []
+    while len(picked) < n:
+        user_id = rng.randint(len(d.pirgs) + 1, len(d.users))
+        if user_id not in members and user_id not in picked:
+            picked.append(user_id)
+    return picked
+
+
+#####
+# Users
+#####
+
+
+@scenario("users_page")
+async def users_page(request, d: Directory, rng, count: int, state: dict):
+    for _ in range(count):
+        after = rng.randrange(len(d.users))
+        await request("GET", f"/users/?limit={PAGE_SIZE}&after={after}")
+
+
+@scenario("users_full", heavy=True)
+async def users_full(request, d: Directory, rng, count: int, state: dict):
+    for _ in range(count):
+        await request("GET", "/users/")
+
+
+@scenario("users_ndjson", heavy=True)
+async def users_ndjson(request, d: Directory, rng, count: int, state: dict):
+    for _ in range(count):
+        await request("GET", "/users/", headers={"Accept": NDJSON})
+
+
+@scenario("users_search")
+async def users_search(request, d: Directory, rng, count: int, state: dict):
+    # what the help desk lookup sends, part of someone's username
+    for _ in range(count):
+        username = rng.choice(d.users)["username"]
+        start = rng.randrange(len(username) - 2)
+        await request("GET", f"/users/?q={username[start:start + 3]}&limit=20")
+
+
+@scenario("users_filtered")
+async def users_filtered(request, d: Directory, rng, count: int, state: dict):
+    for _ in range(count):
+        pirg = _pirg(d, rng)
+        await request("GET", f"/users/?pirg={pirg['name']}&is_pi=false")
+
+
+@scenario("user_by_id")
+async def user_by_id(request, d: Directory, rng, count: int, state: dict):
+    for _ in range(count):
+        await request("GET", f"/users/{rng.choice(d.users)['id']}")
+
+
+@scenario("user_by_username")
+async def user_by_username(request, d: Directory, rng, count: int, state: dict):
+    for _ in range(count):
+        await request("GET", f"/users/{rng.choice(d.users)['username']}")
+
+
+@scenario("user_memberships")
+async def user_memberships(request, d: Directory, rng, count: int, state: dict):
+    for _ in range(count):
+        username = rng.choice(d.users)["username"]
+        await request("GET", f"/users/{username}/memberships")
+
+
+@scenario("user_memberships_batch")
+async def user_memberships_batch(request, d: Directory, rng, count: int, state: dict):
+    for _ in range(count):
+        users = rng.sample(d.users, BATCH_SIZE)
+        usernames = [u["username"] for u in users]
+        await request("POST", "/users/memberships:batch", json={"usernames": usernames})
+
+
+@scenario("user_sponsees")
+async def user_sponsees(request, d: Directory, rng, count: int, state: dict):
+    # the first users are the pis, who sponsor everyone else
+    for _ in range(count):
+        pi = _pirg(d, rng)["owner_id"]
+        username = d.users[pi - 1]["username"]
+        await request("GET", f"/users/{username}/sponsees")
+
+
+@scenario("user_not_modified")
+async def user_not_modified(request, d: Directory, rng, count: int, state: dict):
+    # nothing has been written yet, so every user is still at version 1
+    for _ in range(count):
+        user_id = rng.choice(d.users)["id"]
+        etag = entity_etag("user", user_id, 1)
+        await request(
+            "GET", f"/users/{user_id}", headers={"If-None-Match": etag}, status=304
+        )
+
+
+#####
+# Pirgs
+#####
+
+
+@scenario("pirgs_page")
+async def pirgs_page(request, d: Directory, rng, count: int, state: dict):
+    for _ in range(count):
+        after = rng.randrange(len(d.pirgs))
+        await request("GET", f"/pirgs/?limit={PAGE_SIZE}&after={after}")
+
+
+@scenario("pirgs_full", heavy=True)
+async def pirgs_full(request, d: Directory, rng, count: int, state: dict):
+    for _ in range(count):
+        await request("GET", "/pirgs/")
+
+
+@scenario("pirgs_ndjson", heavy=True)
+async def pirgs_ndjson(request, d: Directory, rng, count: int, state: dict):
+    for _ in range(count):
+        await request("GET", "/pirgs/", headers={"Accept": NDJSON})
+
+
+@scenario("pirg_groups")
+async def pirg_groups(request, d: Directory, rng, count: int, state: dict):
+    for _ in range(count):
+        await request("GET", f"/pirgs/{_pirg(d, rng)['name']}/groups")
+
+
+@scenario("user_create")
+async def user_create(request, d: Directory, rng, count: int, state: dict):
+    for i in range(count):
+        user = {
+            "username": f"bench_user{i}",
+            "firstname": "Bench",
+            "lastname": "Created",
+            "email": f"bench_user{i}@example.org",
+            "is_pi": False,
+            "sponsor_id": rng.randint(1, len(d.pirgs)),
+        }
+        await request("POST", "/users/", json=user)
+
+
+@scenario("users_import", heavy=True)
+async def users_import(request, d: Directory, rng, count: int, state: dict):
+    # a semester's onboarding file, each pi followed by the students they sponsor
+    for i in range(count):
+        rows = []
+        for j in range(IMPORT_SIZE):
+            sponsor = f"bench_import{i}_0" if j else None
+            rows.append(
+                {
+                    "username": f"bench_import{i}_{j}",
+                    "firstname": "Bench",
+                    "lastname": "Imported",
+                    "email": f"bench_import{i}_{j}@example.org",
+                    "is_pi": not j,
+                    "sponsor": sponsor,
+                }
+            )
+        body = "".join(json.dumps(row) + "\n" for row in rows)
+        await request(
+            "POST", "/users:import", content=body, headers={"Content-Type": NDJSON}
+        )
+
+
+@scenario("pirg_create")
+async def pirg_create(request, d: Directory, rng, count: int, state: dict):
+    for i in range(count):
+        pirg = {
+            "name": f"bench_pirg{i}",
+            "owner_id": rng.randint(1, len(d.pirgs)),
+            "admin_ids": [],
+            "user_ids": rng.sample(range(len(d.pirgs) + 1, len(d.users) + 1), 5),
+        }
+        await request("POST", "/pirgs/", json=pirg)
+
+
+@scenario("pirg_user_add")
+async def pirg_user_add(request, d: Directory, rng, count: int, state: dict):
+    state["pirg_users"] = []
+    for _ in range(count):
+        pirg = _pirg(d, rng)
+        [user_id] = _outsiders(d, rng, pirg["id"], 1)
+        await request("POST", f"/pirgs/{pirg['name']}/users", json={"user_id": user_id})
+        state["pirg_users"].append((pirg["name"], user_id))
+
+
+@scenario("pirg_user_remove")
+async def pirg_user_remove(request, d: Directory, rng, count: int, state: dict):
+    for name, user_id in state.get("pirg_users", [])[:count]:
+        await request("DELETE", f"/pirgs/{name}/users/{user_id}")
+
+
+@scenario("pirg_users_batch_add")
+async def pirg_users_batch_add(request, d: Directory, rng, count: int, state: dict):
+    state["pirg_batches"] = []
+    for _ in range(count):
+        pirg = _pirg(d, rng)
+        user_ids = _outsiders(d, rng, pirg["id"], BATCH_SIZE)
+        await request(
+            "POST", f"/pirgs/{pirg['name']}/users:batch", json={"user_ids": user_ids}
+        )
+        state["pirg_batches"].append((pirg["name"], user_ids))
+
+
+@scenario("pirg_users_batch_remove")
+async def pirg_users_batch_remove(request, d: Directory, rng, count: int, state: dict):
+    for name, user_ids in state.get("pirg_batches", [])[:count]:
+        await request(
+            "DELETE", f"/pirgs/{name}/users:batch", json={"user_ids": user_ids}
+        )
+
+
+#####
+# Pirg groups
+#####
+
+
+@scenario("group_create")
+async def group_create(request, d: Directory, rng, count: int, state: dict):
+    state["groups"] = []
+    for i in range(count):
+        pirg = _pirg(d, rng)
+        members = d.pirg_members[pirg["id"]]
+        group = {
+            "name": f"bench_group{i}",
+            "pirg_id": pirg["id"],
+            "user_ids": members[: len(members) // 2],
+        }
+        response = await request("POST", f"/pirgs/{pirg['name']}/groups", json=group)
+        # the other half of the pirg's members are free to be added
+        state["groups"].append(
+            (pirg["name"], response.json()["id"], members[len(members) // 2 :])
+        )
+
+
+@scenario("group_user_add")
+async def group_user_add(request, d: Directory, rng, count: int, state: dict):
+    state["group_users"] = []
+    groups = [g for g in state.get("groups", []) if g[2]]
+    for name, group_id, free in groups[:count]:
+        url = f"/pirgs/{name}/groups/{group_id}/users"
+        await request("POST", url, json={"user_id": free[0]})
+        state["group_users"].append((name, group_id, free[0]))
+
+
+@scenario("group_user_remove")
+async def group_user_remove(request, d: Directory, rng, count: int, state: dict):
+    for name, group_id, user_id in state.get("group_users", [])[:count]:
+        await request("DELETE", f"/pirgs/{name}/groups/{group_id}/users/{user_id}")
+
+
+@scenario("group_users_batch_add")
+async def group_users_batch_add(request, d: Directory, rng, count: int, state: dict):
+    for name, group_id, free in state.get("groups", [])[:count]:
+        url = f"/pirgs/{name}/groups/{group_id}/users:batch"
+        await request("POST", url, json={"user_ids": free[:BATCH_SIZE]})
+
+
+@scenario("group_users_batch_remove")
+async def group_users_batch_remove(request, d: Directory, rng, count: int, state: dict):
+    for name, group_id, free in state.get("groups", [])[:count]:
+        url = f"/pirgs/{name}/groups/{group_id}/users:batch"
+        await request("DELETE", url, json={"user_ids": free[:BATCH_SIZE]})
+
+
+@scenario("group_delete")
+async def group_delete(request, d: Directory, rng, count: int, state: dict):
+    for name, group_id, _ in state.get("groups", [])[:count]:
+        await request("DELETE", f"/pirgs/{name}/groups/{group_id}")
@@ -0,0 +1,124 @@
+"""
+Measures how long a fresh worker takes to import the app, run its startup
+and answer its first requests, with the statement cache warm-up on and off.
+Each run is a new process, against a generated directory in a temporary
+SQLite file.
+
+    python -m benchmarks.startup --runs 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# the first request to each of these is what a restarted worker pays for
+FIRST_REQUESTS = [
+    "/users/?limit=100",
+    "/users/?limit=100&after=100",
+    "/users/1",
+    "/users/user300",
+    "/users/user300/memberships",
+    "/pirgs/?limit=100",
+    "/pirgs/pirg1/groups",
+]
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 3)
+
+
+async def _serve_first_requests(app) -> tuple[float, dict]:
+    import httpx
+
+    start = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        started = time.perf_counter() - start
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://b") as c:
+            first = {}
+            for path in FIRST_REQUESTS:
+                start = time.perf_counter()
+                response = await c.get(path)
+                first[path] = time.perf_counter() - start
+                assert response.status_code == 200, (path, response.status_code)
+    return started, first
+
+
+def child() -> dict:
+    start = time.perf_counter()
+    import main
+
+    imported = time.perf_counter() - start
+    started, first = asyncio.run(_serve_first_requests(main.app))
+    return {
+        "import_ms": _ms(imported),
+        "startup_ms": _ms(started),
+        "first_requests_ms": _ms(sum(first.values())),
+        "first_request_ms": {path: _ms(s) for path, s in first.items()},
+    }
+
+
+def measure(database_url: str, warm_up: bool, runs: int) -> dict:
+    env = {
+        **os.environ,
+        "HPCADMIN_DATABASE_URL": database_url,
+        "HPCADMIN_WARM_UP": "1" if warm_up else "0",
+    }
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.startup", "--child"],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        samples.append(json.loads(output))
+    result = {
+        key: statistics.median(s[key] for s in samples)
+        for key in ["import_ms", "startup_ms", "first_requests_ms"]
+    }
+    result["first_request_ms"] = {
+        path: statistics.median(s["first_request_ms"][path] for s in samples)
+        for path in FIRST_REQUESTS
+    }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=4000)
+    parser.add_argument("--pirgs", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(child()))
+        return
+    with tempfile.TemporaryDirectory() as tmpdir:
+        database_url = f"sqlite:///{tmpdir}/bench.db"
+        # the engines are built from settings at import time
+        os.environ["HPCADMIN_DATABASE_URL"] = database_url
+        from hpcadmin_server.database import db, migrations
+
+        from .generator import generate, seed
+
+        migrations.upgrade(db.engine)
+        seed(db.engine, generate(args.users, args.pirgs))
+        db.engine.dispose()
+        result = {
+            "runs": args.runs,
+            "cold": measure(database_url, warm_up=False, runs=args.runs),
+            "warm_up": measure(database_url, warm_up=True, runs=args.runs),
+        }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
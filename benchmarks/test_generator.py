@@ -0,0 +1,37 @@
+from sqlalchemy import func, select
+
+from hpcadmin_server.config import Settings
+from hpcadmin_server.database import migrations, models
+from hpcadmin_server.database.db import create_db_engine
+from .generator import generate, seed
+
+
+class TestGenerator:
+    def setup_class(self):
+        self.directory = generate(500, 20, seed=1)
+
+    def test_deterministic(self):
+        assert generate(500, 20, seed=1) == self.directory
+        assert generate(500, 20, seed=2) != self.directory
+
+    def test_groups_nest_in_pirgs(self):
+        pirg_of = {g["id"]: g["pirg_id"] for g in self.directory.groups}
+        for group_id, user_id in self.directory.group_users:
+            assert user_id in self.directory.pirg_members[pirg_of[group_id]]
+
+    def test_memberships_unique(self):
+        for rows in [self.directory.pirg_users, self.directory.group_users]:
+            assert len(rows) == len(set(rows))
+
+    def test_seed(self):
+        engine = create_db_engine(Settings(database_url="sqlite://"))
+        migrations.upgrade(engine)
+        seed(engine, self.directory)
+        with engine.connect() as connection:
+            count = select(func.count()).select_from(models.User)
+            assert connection.scalar(count) == 500
+            count = select(func.count()).select_from(
+                models.group_user_association_table
+            )
+            assert connection.scalar(count) == len(self.directory.group_users)
+        engine.dispose()
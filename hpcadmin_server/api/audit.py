@@ -0,0 +1,74 @@
+from fastapi import APIRouter, Depends, Query, Request, Response
+from sqlalchemy.orm import Session
+from . import schemas
+from .pagination import MAX_PAGE_SIZE, Page, set_next_link
+from ..config import settings
+from ..database import audit, crud
+from ..database.db import get_db
+from ..metrics import TimedRoute
+
+router = APIRouter(
+    prefix="/audit",
+    tags=["audit"],
+    dependencies=[],
+    responses={404: {"description": "Not found"}},
+    route_class=TimedRoute,
+)
+
+
+class ActorMiddleware:
+    """
+    Sets the audit log's actor for each request from the header the
+    authenticating proxy in front of the app puts the user in, see
+    HPCADMIN_AUDIT_ACTOR_HEADER. Clients that can reach the app directly can
+    claim to be anyone.
+    """
+
+    def __init__(self, app, header: str | None = None):
+        self.app = app
+        self.header = (header or settings.audit_actor_header).lower().encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        actor = None
+        for name, value in scope["headers"]:
+            if name == self.header:
+                actor = value.decode("latin-1")
+                break
+        # sync routes get a copy of the context, so it reaches them too
+        token = audit.actor.set(actor)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            audit.actor.reset(token)
+
+
+class AuditPage(Page):
+    # the log only grows, so it's always paged
+    def __init__(
+        self,
+        limit: int = Query(default=100, ge=1, le=MAX_PAGE_SIZE),
+        after: int | None = Query(default=None, ge=0),
+    ):
+        super().__init__(limit=limit, after=after)
+
+
+@router.get("/", response_model=list[schemas.AuditEntry])
+def get_audit(
+    request: Request,
+    response: Response,
+    page: AuditPage = Depends(),
+    filters: schemas.AuditFilter = Query(),
+    db: Session = Depends(get_db),
+):
+    """
+    Who made each change and when, oldest first, `limit` at a time. Entries
+    are written in batches, so the latest changes can take up to
+    HPCADMIN_AUDIT_FLUSH_MS to show up.
+    """
+    entries = crud.get_audit_entries(
+        db=db, limit=page.limit, after=page.after, filters=filters
+    )
+    set_next_link(request, response, entries, page)
+    return entries
@@ -0,0 +1,30 @@
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.orm import Session
+from . import schemas
+from .pagination import MAX_PAGE_SIZE, ndjson_response
+from ..database import crud
+from ..database.db import get_db
+from ..metrics import TimedRoute
+
+router = APIRouter(
+    prefix="/changes",
+    tags=["changes"],
+    dependencies=[],
+    responses={404: {"description": "Not found"}},
+    route_class=TimedRoute,
+)
+
+
+@router.get("/")
+def get_changes(
+    since: int = Query(default=0, ge=0),
+    limit: int | None = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+    db: Session = Depends(get_db),
+):
+    """
+    Stream every change with a sequence number greater than `since`, in
+    order, as newline delimited json. Clients pass the last `seq` they
+    applied as `since` on their next poll.
+    """
+    changes = crud.stream_changes(db=db, since=since, limit=limit)
+    return ndjson_response(changes, schemas.Change)
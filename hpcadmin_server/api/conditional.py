@@ -0,0 +1,38 @@
+import hashlib
+
+from fastapi import Request, Response
+
+from .pagination import wants_ndjson
+
+
+def entity_etag(
+    kind: str, id: int, version: int, fields: tuple[str, ...] | None = None
+) -> str:
+    if not fields:
+        return f'"{kind}-{id}-v{version}"'
+    # a sparse representation is a different one
+    digest = hashlib.sha1(",".join(fields).encode()).hexdigest()[:12]
+    return f'"{kind}-{id}-v{version}-{digest}"'
+
+
+def collection_etag(request: Request, name: str, version: int) -> str:
+    # the same version of a collection renders differently depending on the
+    # route, the page and the representation asked for
+    representation = "ndjson" if wants_ndjson(request) else "json"
+    variant = f"{request.url.path}?{request.url.query}|{representation}"
+    digest = hashlib.sha1(variant.encode()).hexdigest()[:12]
+    return f'"{name}-v{version}-{digest}"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison, so W/ prefixes are ignored
+    return etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
@@ -0,0 +1,144 @@
+import gzip
+import json
+import threading
+from weakref import WeakKeyDictionary
+
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from sqlalchemy.orm import Session
+from . import schemas
+from .conditional import is_not_modified, not_modified
+from ..config import settings
+from ..database import crud
+from ..database.db import get_db
+from ..metrics import TimedRoute
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+router = APIRouter(
+    prefix="/export",
+    tags=["export"],
+    dependencies=[],
+    responses={404: {"description": "Not found"}},
+    route_class=TimedRoute,
+)
+
+MEDIA_TYPES = {
+    schemas.ExportFormat.GROUP: "text/plain",
+    schemas.ExportFormat.JSONL: "application/x-ndjson",
+    schemas.ExportFormat.MSGPACK: "application/msgpack",
+}
+
+
+class Snapshot:
+    """
+    The unix groups as of one pirgs/groups collection version, rendered and
+    compressed on demand and kept until a membership change moves the
+    versions on.
+    """
+
+    def __init__(self, key: tuple[int, ...], unix_groups: list):
+        self.key = key
+        self.rows = [
+            (kind, name, _gid(kind, id), members)
+            for kind, id, name, members in unix_groups
+        ]
+        self._rendered: dict[tuple, bytes] = {}
+        self._lock = threading.Lock()
+
+    def render(self, format: schemas.ExportFormat, encoding: str) -> bytes:
+        with self._lock:
+            if (format, encoding) not in self._rendered:
+                body = self._render(format)
+                if encoding == "gzip":
+                    body = gzip.compress(body)
+                elif encoding == "zstd":
+                    body = zstandard.ZstdCompressor().compress(body)
+                self._rendered[(format, encoding)] = body
+            return self._rendered[(format, encoding)]
+
+    def _render(self, format: schemas.ExportFormat) -> bytes:
+        if format == schemas.ExportFormat.GROUP:
+            lines = [
+                f"{name}:{gid}:{','.join(members)}\n"
+                for _, name, gid, members in self.rows
+            ]
+            return "".join(lines).encode()
+        if format == schemas.ExportFormat.JSONL:
+            lines = [
+                json.dumps(
+                    {"kind": kind, "name": name, "gid": gid, "members": members},
+                    separators=(",", ":"),
+                )
+                + "\n"
+                for kind, name, gid, members in self.rows
+            ]
+            return "".join(lines).encode()
+        return msgpack.packb([list(row) for row in self.rows])
+
+
+def _gid(kind: str, id: int) -> int:
+    if kind == "pirg":
+        return settings.pirg_gid_base + id
+    return settings.group_gid_base + id
+
+
+# one snapshot per engine, so separate databases never share one
+_snapshots: WeakKeyDictionary = WeakKeyDictionary()
+_snapshots_lock = threading.Lock()
+
+
+def get_snapshot(db: Session) -> Snapshot:
+    key = crud.get_collection_versions(db, "pirgs", "groups")
+    engine = db.get_bind()
+    with _snapshots_lock:
+        snapshot = _snapshots.get(engine)
+        if snapshot is None or snapshot.key != key:
+            snapshot = Snapshot(key, crud.get_unix_groups(db))
+            _snapshots[engine] = snapshot
+        return snapshot
+
+
+def _content_encoding(request: Request) -> str:
+    accepted = set()
+    for coding in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = coding.strip().partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(name.strip().lower())
+    if zstandard and "zstd" in accepted:
+        return "zstd"
+    if "gzip" in accepted:
+        return "gzip"
+    return "identity"
+
+
+@router.get("/groups")
+def get_unix_groups(
+    request: Request,
+    format: schemas.ExportFormat = schemas.ExportFormat.GROUP,
+    db: Session = Depends(get_db),
+):
+    if format == schemas.ExportFormat.MSGPACK and msgpack is None:
+        raise HTTPException(status_code=406, detail="msgpack is not installed")
+    snapshot = get_snapshot(db)
+    encoding = _content_encoding(request)
+    versions = "-".join(str(version) for version in snapshot.key)
+    etag = f'"export-{versions}-{format.value}-{encoding}"'
+    headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(
+        content=snapshot.render(format, encoding),
+        media_type=MEDIA_TYPES[format],
+        headers=headers,
+    )
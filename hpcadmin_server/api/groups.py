@@ -1,19 +1,54 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response
 from sqlalchemy.orm import Session
 from . import schemas
+from .conditional import collection_etag, is_not_modified, not_modified
+from .pagination import (
+    Page,
+    fast_json,
+    ndjson_response,
+    rows_response,
+    set_next_link,
+    sparse_fields,
+    wants_ndjson,
+)
 from ..database import crud
 from ..database.db import get_db
-
+from ..metrics import TimedRoute
 
 router = APIRouter(
     prefix="/groups",
     tags=["groups"],
     dependencies=[],
     responses={404: {"description": "Not found"}},
+    route_class=TimedRoute,
 )
 
 
 @router.get("/", response_model=list[schemas.Group])
-async def get_groups(db: Session = Depends(get_db)):
-    groups = crud.get_pirg_groups(db)
+def get_groups(
+    request: Request,
+    response: Response,
+    page: Page = Depends(),
+    fields: tuple[str, ...] | None = Depends(sparse_fields(schemas.Group)),
+    filters: schemas.GroupFilter = Query(),
+    db: Session = Depends(get_db),
+):
+    etag = collection_etag(request, "groups", crud.get_collection_version(db, "groups"))
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    if fields or fast_json():
+        rows = crud.stream_pirg_group_rows(
+            db=db, limit=page.limit, after=page.after, fields=fields, filters=filters
+        )
+        return rows_response(request, response, rows, page, etag)
+    if wants_ndjson(request):
+        groups = crud.stream_pirg_groups(
+            db=db, limit=page.limit, after=page.after, filters=filters
+        )
+        return ndjson_response(groups, schemas.Group, headers={"ETag": etag})
+    groups = crud.get_pirg_groups(
+        db=db, limit=page.limit, after=page.after, filters=filters
+    )
+    set_next_link(request, response, groups, page)
+    response.headers["ETag"] = etag
     return groups
@@ -0,0 +1,180 @@
+"""
+Reading the body of POST /users:import, CSV with a header row or newline
+delimited json, as it arrives.
+
+`read_users` turns the body into (line, user) pairs, validated against
+schemas.UserImport, with a UserImportResult in place of the user for rows
+that aren't valid. `batches` groups those for crud.import_users, so only one
+batch is held in memory however large the upload is.
+"""
+
+import codecs
+import csv
+import json
+from typing import AsyncIterator
+
+import anyio
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+
+from . import schemas
+from .pagination import NDJSON
+
+CSV = "text/csv"
+IMPORT_BATCH_SIZE = 500
+
+Row = tuple[int, schemas.UserImport | schemas.UserImportResult]
+
+
+class BodyStreamingResponse(StreamingResponse):
+    """
+    A StreamingResponse whose content reads the request body. Starlette's
+    listens for the client disconnecting while it streams, which on servers
+    older than ASGI 2.4 takes the body's messages off the queue. Reading the
+    body notices the disconnect anyway, so this one leaves them alone.
+    """
+
+    async def listen_for_disconnect(self, receive):
+        # cancelled once the content is done
+        await anyio.sleep_forever()
+
+
+def import_format(request: Request) -> str:
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type not in (CSV, NDJSON):
+        raise HTTPException(
+            status_code=415, detail=f"Send the users as {CSV} or {NDJSON}"
+        )
+    return content_type
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    # utf-8-sig drops the byte order mark spreadsheets like to start with
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line.removesuffix("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer
+
+
+async def _ndjson_rows(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, dict]]:
+    number = 0
+    async for line in lines:
+        number += 1
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield number, f"Invalid json: {e}"
+            continue
+        yield number, row if isinstance(row, dict) else "Expected a json object"
+
+
+class _Record:
+    """
+    The lines read so far of one csv record, for csv.reader, noting whether
+    it asked for another. It only does that while a quoted field is open, so
+    the record carries on onto the next line.
+    """
+
+    def __init__(self, lines: list[str]):
+        self.lines = iter(lines)
+        self.unfinished = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        try:
+            return next(self.lines)
+        except StopIteration:
+            self.unfinished = True
+            raise
+
+
+async def _csv_rows(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, dict]]:
+    header = None
+    record = []
+    number = start = 0
+    async for line in lines:
+        number += 1
+        if not record:
+            start = number
+        record.append(line + "\n")
+        feed = _Record(record)
+        values = next(csv.reader(feed), [])
+        if feed.unfinished:
+            continue
+        record = []
+        if not values:
+            continue
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+        if len(values) != len(header):
+            yield start, f"Expected {len(header)} columns, got {len(values)}"
+            continue
+        # empty cells are left out, so they take the schema's defaults
+        yield start, {k: v for k, v in zip(header, values) if v != ""}
+    if record:
+        yield start, "Unterminated quoted field"
+
+
+def _describe(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors()
+    )
+
+
+async def read_users(request: Request, content_type: str) -> AsyncIterator[Row]:
+    parse = _csv_rows if content_type == CSV else _ndjson_rows
+    async for line, row in parse(_lines(request.stream())):
+        username = None
+        if isinstance(row, str):
+            detail = row
+        else:
+            try:
+                yield line, schemas.UserImport.model_validate(row)
+                continue
+            except ValidationError as e:
+                detail = _describe(e)
+            if isinstance(row.get("username"), str):
+                username = row["username"]
+        yield line, schemas.UserImportResult(
+            line=line,
+            username=username,
+            status=schemas.UserImportStatus.INVALID,
+            detail=detail,
+        )
+
+
+async def batches(
+    rows: AsyncIterator[Row], size: int | None = None
+) -> AsyncIterator[list[Row]]:
+    """
+    Group `rows` into lists of up to `size` valid users, IMPORT_BATCH_SIZE
+    by default. A username or email seen again starts a new batch, so a
+    repeat is handled like any other user that already exists.
+    """
+    size = size or IMPORT_BATCH_SIZE
+    batch = []
+    seen = set()
+    valid = 0
+    async for line, user in rows:
+        if isinstance(user, schemas.UserImport):
+            keys = {("username", user.username), ("email", user.email)}
+            if valid == size or keys & seen:
+                yield batch
+                batch, seen, valid = [], set(), 0
+            seen |= keys
+            valid += 1
+        batch.append((line, user))
+    if batch:
+        yield batch
@@ -0,0 +1,20 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from ..database import crud
+from ..metrics import metrics
+
+router = APIRouter(
+    prefix="/metrics",
+    tags=["metrics"],
+    dependencies=[],
+)
+
+# the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@router.get("", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(
+        metrics.render(cache_stats=crud.cache.stats()), media_type=CONTENT_TYPE
+    )
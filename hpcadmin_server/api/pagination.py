@@ -0,0 +1,155 @@
+import itertools
+from typing import Iterable, Iterator
+
+import pydantic_core
+from fastapi import HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from ..config import settings
+from .singleflight import SingleFlight
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NDJSON = "application/x-ndjson"
+MAX_PAGE_SIZE = 1000
+# rows per chunk of a streamed response, each of which is a hop through the
+# threadpool for a sync iterator
+STREAM_CHUNK_ROWS = 500
+
+# identical listings being encoded right now, keyed by etag
+flights = SingleFlight()
+
+
+class Page:
+    """
+    Keyset pagination parameters shared by the collection endpoints.
+
+    Rows are ordered by id, `after` is the last id the client has seen and
+    `limit` caps the page size. Leaving `limit` unset returns every row
+    after the cursor.
+    """
+
+    def __init__(
+        self,
+        limit: int | None = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+        after: int | None = Query(default=None, ge=0),
+    ):
+        self.limit = limit
+        self.after = after
+
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON in request.headers.get("accept", "")
+
+
+def set_next_link(request: Request, response: Response, rows: list, page: Page):
+    # a short page means we've reached the end, so there's no next link
+    if page.limit is None or len(rows) < page.limit:
+        return
+    last = rows[-1]
+    after = last["id"] if isinstance(last, dict) else last.id
+    _set_next_link(request, response, after, page)
+
+
+def _set_next_link(request: Request, response: Response, after: int, page: Page):
+    url = request.url.include_query_params(after=after, limit=page.limit)
+    response.headers["Link"] = f'<{url}>; rel="next"'
+
+
+def ndjson_response(
+    rows: Iterable, schema: type[BaseModel], headers: dict[str, str] | None = None
+) -> StreamingResponse:
+    """
+    Stream `rows` as newline delimited json, serializing each one through
+    `schema` as it comes off the cursor.
+    """
+
+    def lines():
+        for row in rows:
+            yield schema.model_validate(row).model_dump_json() + "\n"
+
+    return StreamingResponse(lines(), media_type=NDJSON, headers=headers)
+
+
+def fast_json() -> bool:
+    return orjson is not None and settings.fast_json
+
+
+def _dumps(value) -> bytes:
+    if orjson is None:
+        return pydantic_core.to_json(value)
+    # pydantic writes utc datetimes with a Z suffix
+    return orjson.dumps(value, option=orjson.OPT_UTC_Z)
+
+
+def json_response(value, headers: dict[str, str] | None = None) -> Response:
+    return Response(_dumps(value), media_type="application/json", headers=headers)
+
+
+def sparse_fields(schema: type[BaseModel]):
+    """
+    A dependency parsing `?fields=a,b` into the names of the `schema` fields
+    to return, in the schema's order, or None for all of them. `id` is
+    always included, since it's the pagination cursor.
+    """
+    names = list(schema.model_fields)
+
+    def dependency(
+        fields: str | None = Query(
+            default=None,
+            description=f"Comma separated subset of: {', '.join(names)}",
+        ),
+    ) -> tuple[str, ...] | None:
+        if fields is None:
+            return None
+        wanted = {name.strip() for name in fields.split(",") if name.strip()}
+        unknown = wanted - set(names)
+        if unknown:
+            raise HTTPException(
+                status_code=422, detail=f"Unknown fields: {', '.join(sorted(unknown))}"
+            )
+        return tuple(name for name in names if name in wanted or name == "id")
+
+    return dependency
+
+
+def rows_response(
+    request: Request, response: Response, rows: Iterator[dict], page: Page, etag: str
+) -> Response:
+    """
+    Encode `rows`, already shaped like the route's response schema or the
+    fields asked for of it (see crud.stream_projected), without validating
+    them through it. Streams them as newline delimited json if
+    the client asked for it. Otherwise concurrent requests for the same etag
+    share one encoding, and only the first of them iterates its `rows`.
+    """
+    if wants_ndjson(request):
+
+        def chunks():
+            it = iter(rows)
+            while chunk := list(itertools.islice(it, STREAM_CHUNK_ROWS)):
+                yield b"".join(_dumps(row) + b"\n" for row in chunk)
+
+        return StreamingResponse(chunks(), media_type=NDJSON, headers={"ETag": etag})
+
+    def encode() -> tuple[bytes, int | None]:
+        encoded = list(rows)
+        full = page.limit is not None and len(encoded) == page.limit
+        return _dumps(encoded), encoded[-1]["id"] if full else None
+
+    # the etag covers the collection's version and everything about the
+    # request that changes the body, so requests sharing it can share one
+    # query and encoding. The Link is each request's own, built from its url
+    if settings.single_flight:
+        body, after = flights.do(etag, encode)
+    else:
+        body, after = encode()
+    if after is not None:
+        _set_next_link(request, response, after, page)
+    response.headers["ETag"] = etag
+    # headers set on the injected response aren't copied to one we return
+    return Response(body, media_type="application/json", headers=dict(response.headers))
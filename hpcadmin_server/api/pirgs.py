@@ -1,40 +1,72 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response
 from sqlalchemy.orm import Session
 from . import schemas
+from .conditional import collection_etag, is_not_modified, not_modified
+from .pagination import (
+    Page,
+    fast_json,
+    ndjson_response,
+    rows_response,
+    set_next_link,
+    sparse_fields,
+    wants_ndjson,
+)
 from ..database import crud
-from ..database.db import get_db
-
+from ..database.db import get_db, get_uow
+from ..metrics import TimedRoute
 
 router = APIRouter(
     prefix="/pirgs",
     tags=["pirgs"],
     dependencies=[],
     responses={404: {"description": "Not found"}},
+    route_class=TimedRoute,
 )
 
 
 @router.get("/", response_model=list[schemas.Pirg])
-async def get_pirgs(db: Session = Depends(get_db)):
-    pirgs = crud.get_pirgs(db)
+def get_pirgs(
+    request: Request,
+    response: Response,
+    page: Page = Depends(),
+    fields: tuple[str, ...] | None = Depends(sparse_fields(schemas.Pirg)),
+    filters: schemas.PirgFilter = Query(),
+    db: Session = Depends(get_db),
+):
+    etag = collection_etag(request, "pirgs", crud.get_collection_version(db, "pirgs"))
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    if fields or fast_json():
+        rows = crud.stream_pirg_rows(
+            db=db, limit=page.limit, after=page.after, fields=fields, filters=filters
+        )
+        return rows_response(request, response, rows, page, etag)
+    if wants_ndjson(request):
+        pirgs = crud.stream_pirgs(
+            db=db, limit=page.limit, after=page.after, filters=filters
+        )
+        return ndjson_response(pirgs, schemas.Pirg, headers={"ETag": etag})
+    pirgs = crud.get_pirgs(db=db, limit=page.limit, after=page.after, filters=filters)
+    set_next_link(request, response, pirgs, page)
+    response.headers["ETag"] = etag
     return pirgs
 
 
 @router.post("/", response_model=schemas.Pirg)
-async def post_pirg(pirg_create: schemas.PirgCreate, db: Session = Depends(get_db)):
+def post_pirg(
+    pirg_create: schemas.PirgCreate, db: Session = Depends(get_uow, scope="function")
+):
     db_pirg = crud.get_pirg_by_name(db=db, name=pirg_create.name)
     if db_pirg:
         raise HTTPException(status_code=400, detail="Pirg already exists")
-    if not crud.get_user(db=db, id=pirg_create.owner_id):
-        raise HTTPException(
-            status_code=404, detail=f"Owner id {pirg_create.owner_id} does not exist"
-        )
-    if pirg_create.user_ids:
-        for user_id in pirg_create.user_ids:
-            if not crud.get_user(db=db, id=user_id):
-                raise HTTPException(
-                    status_code=404, detail=f"User id {user_id} does not exist"
-                )
-    return crud.create_pirg(db=db, pirg=pirg_create)
+    try:
+        return crud.create_pirg(db=db, pirg=pirg_create)
+    except crud.UserNotFoundError as e:
+        if pirg_create.owner_id in e.user_ids:
+            detail = f"Owner id {pirg_create.owner_id} does not exist"
+        else:
+            detail = f"User ids {e.user_ids} do not exist"
+        raise HTTPException(status_code=404, detail=detail)
 
 
 ####################
@@ -43,8 +75,10 @@ async def post_pirg(pirg_create: schemas.PirgCreate, db: Session = Depends(get_d
 
 
 @router.post("/{pirg_name}/users", response_model=schemas.Pirg)
-async def post_pirg_users(
-    pirg_name: str, user: schemas.UserId, db: Session = Depends(get_db)
+def post_pirg_users(
+    pirg_name: str,
+    user: schemas.UserId,
+    db: Session = Depends(get_uow, scope="function"),
 ):
     db_pirg = crud.get_pirg_by_name(db=db, name=pirg_name)
     if not db_pirg:
@@ -56,7 +90,9 @@ async def post_pirg_users(
 
 
 @router.delete("/{pirg_name}/users/{user_id}", response_model=schemas.Pirg)
-async def delete_pirg_user(pirg_name: str, user_id: int, db: Session = Depends(get_db)):
+def delete_pirg_user(
+    pirg_name: str, user_id: int, db: Session = Depends(get_uow, scope="function")
+):
     db_pirg = crud.get_pirg_by_name(db=db, name=pirg_name)
     if not db_pirg:
         raise HTTPException(status_code=404, detail="Pirg not found")
@@ -66,41 +102,117 @@ async def delete_pirg_user(pirg_name: str, user_id: int, db: Session = Depends(g
     return crud.remove_user_from_pirg(db=db, pirg=db_pirg, user=db_user)
 
 
+def _membership_results(results: dict) -> list[schemas.MembershipResult]:
+    return [
+        schemas.MembershipResult(user_id=user_id, status=status)
+        for user_id, status in results.items()
+    ]
+
+
+@router.post("/{pirg_name}/users:batch", response_model=list[schemas.MembershipResult])
+def post_pirg_users_batch(
+    pirg_name: str,
+    users: schemas.UserIds,
+    db: Session = Depends(get_uow, scope="function"),
+):
+    db_pirg = crud.get_pirg_by_name(db=db, name=pirg_name)
+    if not db_pirg:
+        raise HTTPException(status_code=404, detail="Pirg not found")
+    results = crud.add_users_to_pirg(db=db, pirg=db_pirg, user_ids=users.user_ids)
+    return _membership_results(results)
+
+
+@router.delete(
+    "/{pirg_name}/users:batch", response_model=list[schemas.MembershipResult]
+)
+def delete_pirg_users_batch(
+    pirg_name: str,
+    users: schemas.UserIds,
+    db: Session = Depends(get_uow, scope="function"),
+):
+    db_pirg = crud.get_pirg_by_name(db=db, name=pirg_name)
+    if not db_pirg:
+        raise HTTPException(status_code=404, detail="Pirg not found")
+    results = crud.remove_users_from_pirg(db=db, pirg=db_pirg, user_ids=users.user_ids)
+    return _membership_results(results)
+
+
 ####################
 # Pirg Groups
 ####################
 
 
 @router.get("/{pirg_name}/groups", response_model=list[schemas.Group])
-async def get_pirg_groups(pirg_name: str, db: Session = Depends(get_db)):
+def get_pirg_groups(
+    pirg_name: str,
+    request: Request,
+    response: Response,
+    page: Page = Depends(),
+    fields: tuple[str, ...] | None = Depends(sparse_fields(schemas.Group)),
+    filters: schemas.GroupFilter = Query(),
+    db: Session = Depends(get_db),
+):
     pirg = crud.get_pirg_by_name(db=db, name=pirg_name)
-    groups = crud.get_pirg_groups(db=db, pirg=pirg)
+    if not pirg:
+        raise HTTPException(status_code=404, detail="Pirg not found")
+    etag = collection_etag(request, "groups", crud.get_collection_version(db, "groups"))
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    if fields or fast_json():
+        rows = crud.stream_pirg_group_rows(
+            db=db,
+            pirg=pirg,
+            limit=page.limit,
+            after=page.after,
+            fields=fields,
+            filters=filters,
+        )
+        return rows_response(request, response, rows, page, etag)
+    if wants_ndjson(request):
+        groups = crud.stream_pirg_groups(
+            db=db, pirg=pirg, limit=page.limit, after=page.after, filters=filters
+        )
+        return ndjson_response(groups, schemas.Group, headers={"ETag": etag})
+    groups = crud.get_pirg_groups(
+        db=db, pirg=pirg, limit=page.limit, after=page.after, filters=filters
+    )
+    set_next_link(request, response, groups, page)
+    response.headers["ETag"] = etag
     return groups
 
 
 @router.post("/{pirg_name}/groups", response_model=schemas.Group)
-async def post_pirg_groups(
-    pirg_name: str, group: schemas.GroupCreate, db: Session = Depends(get_db)
+def post_pirg_groups(
+    pirg_name: str,
+    group: schemas.GroupCreate,
+    db: Session = Depends(get_uow, scope="function"),
 ):
     # make sure the pirg exists
     db_pirg = crud.get_pirg_by_name(db=db, name=pirg_name)
     if not db_pirg:
         raise HTTPException(status_code=404, detail="Pirg not found")
     # make sure the group doesn't already exist
-    db_group = crud.get_pirg_group_by_name(db=db, name=group.name)
+    db_group = crud.get_pirg_group_by_name(db=db, pirg=db_pirg, name=group.name)
     if db_group:
         raise HTTPException(status_code=400, detail="Group already exists")
-    # make sure all the users exist
-    for user_id in group.user_ids:
-        db_user = crud.get_user(db=db, id=user_id)
-        if not db_user:
-            raise HTTPException(status_code=404, detail="User not found")
-    return crud.create_pirg_group(db=db, group=group)
+    # make sure all the users exist, checked in the same query that loads them
+    try:
+        return crud.create_pirg_group(db=db, group=group)
+    except crud.UserNotFoundError as e:
+        raise HTTPException(
+            status_code=404, detail=f"User ids {e.user_ids} do not exist"
+        )
+    except crud.GroupAlreadyExistsError:
+        # group names are unique across pirgs, not just within this one
+        raise HTTPException(status_code=400, detail="Group already exists")
 
 
 @router.post("/{pirg_name}/groups/{group_id}/users", response_model=schemas.Group)
-async def post_pirg_group_users(
-    pirg_name: str, group_id: int, user: schemas.UserId, db: Session = Depends(get_db)
+def post_pirg_group_users(
+    pirg_name: str,
+    group_id: int,
+    user: schemas.UserId,
+    db: Session = Depends(get_uow, scope="function"),
 ):
     db_pirg = crud.get_pirg_by_name(db=db, name=pirg_name)
     if not db_pirg:
@@ -117,8 +229,11 @@ async def post_pirg_group_users(
 @router.delete(
     "/{pirg_name}/groups/{group_id}/users/{user_id}", response_model=schemas.Group
 )
-async def delete_pirg_group_users(
-    pirg_name: str, group_id: int, user_id: int, db: Session = Depends(get_db)
+def delete_pirg_group_users(
+    pirg_name: str,
+    group_id: int,
+    user_id: int,
+    db: Session = Depends(get_uow, scope="function"),
 ):
     db_pirg = crud.get_pirg_by_name(db=db, name=pirg_name)
     if not db_pirg:
@@ -132,9 +247,53 @@ async def delete_pirg_group_users(
     return crud.remove_user_from_pirg_group(db=db, group=db_group, user=db_user)
 
 
+@router.post(
+    "/{pirg_name}/groups/{group_id}/users:batch",
+    response_model=list[schemas.MembershipResult],
+)
+def post_pirg_group_users_batch(
+    pirg_name: str,
+    group_id: int,
+    users: schemas.UserIds,
+    db: Session = Depends(get_uow, scope="function"),
+):
+    db_pirg = crud.get_pirg_by_name(db=db, name=pirg_name)
+    if not db_pirg:
+        raise HTTPException(status_code=404, detail="Pirg not found")
+    db_group = crud.get_pirg_group(db=db, group_id=group_id)
+    if not db_group:
+        raise HTTPException(status_code=404, detail="Group not found")
+    results = crud.add_users_to_pirg_group(
+        db=db, group=db_group, user_ids=users.user_ids
+    )
+    return _membership_results(results)
+
+
+@router.delete(
+    "/{pirg_name}/groups/{group_id}/users:batch",
+    response_model=list[schemas.MembershipResult],
+)
+def delete_pirg_group_users_batch(
+    pirg_name: str,
+    group_id: int,
+    users: schemas.UserIds,
+    db: Session = Depends(get_uow, scope="function"),
+):
+    db_pirg = crud.get_pirg_by_name(db=db, name=pirg_name)
+    if not db_pirg:
+        raise HTTPException(status_code=404, detail="Pirg not found")
+    db_group = crud.get_pirg_group(db=db, group_id=group_id)
+    if not db_group:
+        raise HTTPException(status_code=404, detail="Group not found")
+    results = crud.remove_users_from_pirg_group(
+        db=db, group=db_group, user_ids=users.user_ids
+    )
+    return _membership_results(results)
+
+
 @router.delete("/{pirg_name}/groups/{group_id}", response_model=schemas.SimpleStatus)
-async def delete_pirg_group(
-    pirg_name: str, group_id: int, db: Session = Depends(get_db)
+def delete_pirg_group(
+    pirg_name: str, group_id: int, db: Session = Depends(get_uow, scope="function")
 ):
     db_pirg = crud.get_pirg_by_name(db=db, name=pirg_name)
     if not db_pirg:
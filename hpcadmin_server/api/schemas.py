@@ -1,5 +1,4 @@
-from pydantic import BaseModel, ConfigDict
-from pydantic.dataclasses import dataclass
+from pydantic import BaseModel, ConfigDict, Field
 
 from datetime import datetime
 from enum import Enum
@@ -21,8 +20,9 @@ class SimpleStatus(BaseModel):
     status: Status
 
 
-@dataclass(config=config)
-class UserBase:
+class UserBase(BaseModel):
+    model_config = config
+
     username: str
     firstname: str
     lastname: str
@@ -34,10 +34,27 @@ class UserId(BaseModel):
     user_id: int
 
 
+class UserIds(BaseModel):
+    user_ids: list[int]
+
+
+class MembershipStatus(Enum):
+    ADDED = "added"
+    REMOVED = "removed"
+    UNCHANGED = "unchanged"
+    NOT_FOUND = "not_found"
+
+
+class MembershipResult(BaseModel):
+    user_id: int
+    status: MembershipStatus
+
+
 # Used as a shortened version of a user object
 # to return in json
-@dataclass(config=config)
-class UserSignature:
+class UserSignature(BaseModel):
+    model_config = config
+
     id: int
     username: str
 
@@ -46,13 +63,45 @@ class UserCreate(UserBase):
     sponsor_id: int | None
 
 
-@dataclass(config=config)
-class PirgBase:
+class UserImport(UserCreate):
+    sponsor_id: int | None = None
+    # the sponsor's username, which can be a user created earlier in the same
+    # import. Used instead of sponsor_id when both are given.
+    sponsor: str | None = None
+
+
+class UserImportStatus(Enum):
+    CREATED = "created"
+    UPDATED = "updated"
+    UNCHANGED = "unchanged"
+    # the username is taken and the import isn't an upsert
+    EXISTS = "exists"
+    # the email belongs to a different user
+    CONFLICT = "conflict"
+    SPONSOR_NOT_FOUND = "sponsor_not_found"
+    INVALID = "invalid"
+    # the row's batch couldn't be written and was rolled back
+    ERROR = "error"
+
+
+class UserImportResult(BaseModel):
+    # of the row in the uploaded file, counting a csv header as line 1
+    line: int
+    username: str | None = None
+    status: UserImportStatus
+    id: int | None = None
+    detail: str | None = None
+
+
+class PirgBase(BaseModel):
+    model_config = config
+
     name: str
 
 
-@dataclass(config=config)
-class PirgSignature:
+class PirgSignature(BaseModel):
+    model_config = config
+
     id: int
     name: str
 
@@ -63,8 +112,9 @@ class PirgCreate(PirgBase):
     user_ids: list[int] | None
 
 
-@dataclass(config=config)
-class GroupBase:
+class GroupBase(BaseModel):
+    model_config = config
+
     name: str
 
 
@@ -73,8 +123,9 @@ class GroupCreate(GroupBase):
     user_ids: list[int]
 
 
-@dataclass(config=config)
-class GroupSignature:
+class GroupSignature(BaseModel):
+    model_config = config
+
     id: int
     name: str
 
@@ -114,3 +165,142 @@ class Group(GroupBase):
     users: list[UserSignature]
     created_at: datetime
     updated_at: datetime
+
+
+# Query parameters narrowing the collection routes, translated to SQL in
+# crud. Prefixes are case sensitive, searches aren't.
+class UserFilter(BaseModel):
+    is_pi: bool | None = None
+    sponsor_id: int | None = None
+    # names of a pirg or group the users are members of
+    pirg: str | None = None
+    group: str | None = None
+    username: str | None = Field(default=None, description="Username prefix")
+    updated_since: datetime | None = None
+    q: str | None = Field(
+        default=None,
+        min_length=1,
+        description="Search usernames, names and emails for this substring",
+    )
+
+
+class PirgFilter(BaseModel):
+    name: str | None = Field(default=None, description="Name prefix")
+    owner_id: int | None = None
+    # username of a member
+    user: str | None = None
+    updated_since: datetime | None = None
+
+
+class GroupFilter(BaseModel):
+    name: str | None = Field(default=None, description="Name prefix")
+    pirg: str | None = None
+    # username of a member
+    user: str | None = None
+    updated_since: datetime | None = None
+
+
+class ChangeEntity(Enum):
+    USER = "user"
+    PIRG = "pirg"
+    GROUP = "group"
+
+
+class ChangeAction(Enum):
+    CREATE = "create"
+    UPDATE = "update"
+    DELETE = "delete"
+    ADD = "add"
+    REMOVE = "remove"
+
+
+class MemberRole(Enum):
+    USER = "user"
+    ADMIN = "admin"
+
+
+class Change(BaseModel):
+    model_config = config
+
+    seq: int
+    entity: ChangeEntity
+    entity_id: int
+    name: str
+    action: ChangeAction
+    member_id: int | None
+    role: MemberRole | None
+    created_at: datetime
+
+
+class AuditEntry(BaseModel):
+    model_config = config
+
+    id: int
+    # when the change was made
+    created_at: datetime
+    actor: str | None
+    entity: ChangeEntity
+    entity_id: int
+    name: str
+    action: ChangeAction
+    member_id: int | None
+    # the member's role before and after the change
+    old_role: MemberRole | None
+    new_role: MemberRole | None
+
+
+class AuditFilter(BaseModel):
+    actor: str | None = None
+    entity: ChangeEntity | None = None
+    # the user, pirg or group changed
+    name: str | None = None
+    # username of the member added or removed
+    user: str | None = None
+    since: datetime | None = None
+    until: datetime | None = None
+
+
+class MembershipRole(Enum):
+    OWNER = "owner"
+    ADMIN = "admin"
+    USER = "user"
+    # of a group
+    MEMBER = "member"
+
+
+class Membership(BaseModel):
+    model_config = config
+
+    entity: ChangeEntity
+    entity_id: int
+    name: str
+    role: MembershipRole
+
+
+class SponsorTreeUser(BaseModel):
+    model_config = config
+
+    id: int
+    username: str
+    sponsor_id: int | None
+    # levels away from the user asked about, 1 being direct
+    depth: int
+
+
+class SponseeTree(SponsorTreeUser):
+    sponsees: list["SponseeTree"]
+
+
+class SponsorChain(SponsorTreeUser):
+    sponsor: "SponsorChain | None"
+
+
+class Usernames(BaseModel):
+    usernames: list[str] = Field(max_length=10000)
+
+
+class ExportFormat(Enum):
+    # name:gid:member1,member2 lines, like /etc/group without the password
+    GROUP = "group"
+    JSONL = "jsonl"
+    MSGPACK = "msgpack"
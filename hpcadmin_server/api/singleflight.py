@@ -0,0 +1,67 @@
+"""
+Coalescing identical concurrent reads.
+
+When many clients ask for the same listing at once, `SingleFlight.do` lets
+the first of them run the query and encode the response, and hands the same
+result to the rest as they arrive, instead of each running it again. Nothing
+is kept once the first finishes, so it's not a cache: a request that comes
+in afterwards runs its own.
+
+The sync routes run on the threadpool, so callers wait on a threading.Event.
+"""
+
+import threading
+from typing import Callable, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error: BaseException | None = None
+        # callers waiting on this one
+        self.followers = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, _Call] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        """
+        Return `fn()`, or the result of the call already running for `key`,
+        raising its exception if it failed.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.followers += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value
+
+    def followers(self, key: Hashable) -> int:
+        """
+        How many callers are waiting on the call running for `key`.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            return call.followers if call is not None else 0
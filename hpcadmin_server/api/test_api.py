@@ -0,0 +1,1140 @@
+import dataclasses
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from unittest.mock import MagicMock, patch
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from sqlalchemy import event, update
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+from starlette.background import BackgroundTask
+
+from . import audit, imports, schemas, users, pirgs, groups, changes, export, pagination
+from .singleflight import SingleFlight
+from ..config import Settings
+from ..database import audit as audit_log
+from ..database import crud, models
+from ..database.async_db import create_async_db_engine, get_async_db
+from ..database.db import create_db_engine, get_db, get_uow
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, conn, cursor, statement, *args):
+        # sqlite transactions are begun explicitly, see db._sqlite_transactions
+        if not statement.startswith("BEGIN"):
+            self.count += 1
+
+    @contextmanager
+    def __call__(self):
+        self.count = 0
+        event.listen(self.engine, "before_cursor_execute", self._count)
+        try:
+            yield self
+        finally:
+            event.remove(self.engine, "before_cursor_execute", self._count)
+
+
+class TestApi:
+    def setup_class(self):
+        # file backed so the sync and async engines share one database
+        self.tmpdir = tempfile.mkdtemp()
+        settings = Settings(
+            database_url=f"sqlite:///{os.path.join(self.tmpdir, 'test.db')}"
+        )
+        self.engine = create_db_engine(settings)
+        self.async_engine = create_async_db_engine(settings)
+        self.SessionLocal = sessionmaker(
+            autoflush=False, autocommit=False, bind=self.engine
+        )
+        AsyncSessionLocal = async_sessionmaker(
+            self.async_engine, expire_on_commit=False
+        )
+        models.Base.metadata.create_all(bind=self.engine)
+        # ids are reused between test databases
+        crud.cache.clear()
+        self.db = self.SessionLocal()
+        self.queries = QueryCounter(self.engine)
+
+        def override_get_db():
+            db = self.SessionLocal()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        async def override_get_async_db():
+            async with AsyncSessionLocal() as db:
+                yield db
+
+        app = FastAPI()
+        app.include_router(users.router)
+        app.include_router(pirgs.router)
+        app.include_router(groups.router)
+        app.include_router(changes.router)
+        app.include_router(audit.router)
+        app.include_router(export.router)
+        app.add_middleware(audit.ActorMiddleware)
+        app.dependency_overrides[get_db] = override_get_db
+        app.dependency_overrides[get_async_db] = override_get_async_db
+        self.client = TestClient(app)
+
+    def teardown_class(self):
+        self.db.close()
+        models.Base.metadata.drop_all(bind=self.engine)
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def populate(self, start: int, count: int):
+        # every batch adds a pi, sponsored users, a pirg and a group so that
+        # each relationship serialized by the list endpoints has rows in it
+        pi = crud.create_user(
+            self.db,
+            schemas.UserCreate(
+                username=f"pi{start}",
+                firstname="Pi",
+                lastname="Person",
+                email=f"pi{start}@example.org",
+                is_pi=True,
+                sponsor_id=None,
+            ),
+        )
+        user_ids = []
+        for i in range(start, start + count):
+            u = crud.create_user(
+                self.db,
+                schemas.UserCreate(
+                    username=f"user{i}",
+                    firstname="User",
+                    lastname=f"Number{i}",
+                    email=f"user{i}@example.org",
+                    is_pi=False,
+                    sponsor_id=pi.id,
+                ),
+            )
+            user_ids.append(u.id)
+        p = crud.create_pirg(
+            self.db,
+            schemas.PirgCreate(
+                name=f"pirg{start}",
+                owner_id=pi.id,
+                admin_ids=user_ids[:1],
+                user_ids=user_ids,
+            ),
+        )
+        crud.create_pirg_group(
+            self.db,
+            schemas.GroupCreate(name=f"group{start}", pirg_id=p.id, user_ids=user_ids),
+        )
+        # crud only flushes, the whole batch is committed at once
+        self.db.commit()
+
+    def query_counts(self, query: str = "") -> dict[str, int]:
+        counts = {}
+        for path in ["/users/", "/pirgs/", "/groups/"]:
+            with self.queries() as q:
+                response = self.client.get(path + query)
+            assert response.status_code == 200
+            counts[path] = q.count
+        return counts
+
+    @pytest.mark.parametrize("fast_json", [True, False])
+    def test_list_query_counts_constant(self, fast_json):
+        # the first run adds the rows the rest of the tests read
+        if crud.get_pirg_by_name(self.db, "pirg0") is None:
+            self.populate(start=0, count=3)
+            self.populate(start=100, count=20)
+        # the projected rows, or the schemas loaded through eager_load
+        settings = dataclasses.replace(pagination.settings, fast_json=fast_json)
+        with patch.object(pagination, "settings", settings):
+            # one row with a few members, then every row with all of theirs
+            small = self.query_counts("?limit=1")
+            large = self.query_counts()
+        assert small == large
+
+    def test_list_users_payload(self):
+        response = self.client.get("/users/")
+        user = next(u for u in response.json() if u["username"] == "user0")
+        assert user["sponsor"]["username"] == "pi0"
+        assert [p["name"] for p in user["pirgs"]] == ["pirg0"]
+        assert [g["name"] for g in user["groups"]] == ["group0"]
+
+    def test_list_pirgs_payload(self):
+        response = self.client.get("/pirgs/")
+        pirg = next(p for p in response.json() if p["name"] == "pirg0")
+        assert pirg["owner"]["username"] == "pi0"
+        assert [a["username"] for a in pirg["admins"]] == ["user0"]
+        assert len(pirg["users"]) == 3
+        assert [g["name"] for g in pirg["groups"]] == ["group0"]
+
+    def test_list_pirg_groups_filtered(self):
+        response = self.client.get("/pirgs/pirg100/groups")
+        assert [g["name"] for g in response.json()] == ["group100"]
+
+    def test_list_pirg_groups_pirg_not_found(self):
+        response = self.client.get("/pirgs/nope/groups")
+        assert response.status_code == 404
+
+    def test_list_users_paginated(self):
+        everyone = [u["id"] for u in self.client.get("/users/").json()]
+        seen = []
+        url = "/users/?limit=5"
+        while url:
+            response = self.client.get(url)
+            assert response.status_code == 200
+            assert len(response.json()) <= 5
+            seen.extend(u["id"] for u in response.json())
+            url = response.links.get("next", {}).get("url")
+        assert seen == sorted(everyone)
+
+    def test_list_users_after_cursor(self):
+        response = self.client.get("/users/?after=3&limit=2")
+        assert [u["id"] for u in response.json()] == [4, 5]
+
+    def test_list_limit_too_large(self):
+        response = self.client.get("/pirgs/?limit=100000")
+        assert response.status_code == 422
+
+    def test_list_ndjson_matches_json(self):
+        import json
+
+        for path in ["/users/", "/pirgs/", "/groups/", "/pirgs/pirg0/groups"]:
+            response = self.client.get(path, headers={"Accept": "application/x-ndjson"})
+            assert response.headers["content-type"] == "application/x-ndjson"
+            rows = [json.loads(line) for line in response.text.splitlines()]
+            assert rows == self.client.get(path).json()
+
+    def test_fast_json_matches_schemas(self):
+        # a fixed timestamp with microseconds, to check datetime formatting
+        user = crud.get_user_by_username(self.db, "user0")
+        user.created_at = datetime.datetime(2024, 1, 2, 3, 4, 5, 123456)
+        self.db.commit()
+        slow_settings = dataclasses.replace(pagination.settings, fast_json=False)
+        paths = ["/users/", "/pirgs/", "/groups/", "/pirgs/pirg0/groups"]
+        paths += [f"{path}?limit=2&after=1" for path in paths]
+        for accept in ["application/json", "application/x-ndjson"]:
+            for path in paths:
+                headers = {"Accept": accept}
+                fast = self.client.get(path, headers=headers)
+                with patch.object(pagination, "settings", slow_settings):
+                    slow = self.client.get(path, headers=headers)
+                assert fast.status_code == slow.status_code == 200
+                assert fast.headers["content-type"] == slow.headers["content-type"]
+                assert fast.headers["etag"] == slow.headers["etag"]
+                assert fast.headers.get("link") == slow.headers.get("link")
+                # byte for byte, not just the same json
+                assert fast.content == slow.content
+        user0 = next(
+            u for u in self.client.get("/users/").json() if u["username"] == "user0"
+        )
+        assert user0["created_at"] == "2024-01-02T03:04:05.123456"
+
+    def test_sparse_fields(self):
+        with self.queries() as q:
+            response = self.client.get("/users/?fields=username")
+        assert response.status_code == 200
+        assert all(list(u) == ["username", "id"] for u in response.json())
+        # the collection version and the users, no relationship loads
+        assert q.count == 2
+        response = self.client.get("/pirgs/?fields=users,name")
+        pirg = next(p for p in response.json() if p["name"] == "pirg0")
+        assert list(pirg) == ["name", "id", "users"]
+        assert [list(u) for u in pirg["users"]] == [["id", "username"]] * 3
+        response = self.client.get("/pirgs/pirg0/groups?fields=users")
+        assert [list(g) for g in response.json()] == [["id", "users"]]
+
+    def test_sparse_fields_unknown(self):
+        response = self.client.get("/groups/?fields=name,nope")
+        assert response.status_code == 422
+        assert "nope" in response.json()["detail"]
+
+    def test_sparse_fields_user(self):
+        full = self.client.get("/users/user0")
+        sparse = self.client.get("/users/user0?fields=sponsor,email")
+        assert sparse.json() == {
+            "id": full.json()["id"],
+            "email": "user0@example.org",
+            "sponsor": full.json()["sponsor"],
+        }
+        assert sparse.headers["etag"] != full.headers["etag"]
+        by_id = self.client.get(f"/users/{full.json()['id']}?fields=sponsor,email")
+        assert by_id.json() == sparse.json()
+        assert by_id.headers["etag"] == sparse.headers["etag"]
+        headers = {"If-None-Match": sparse.headers["etag"]}
+        response = self.client.get("/users/user0?fields=email,sponsor", headers=headers)
+        assert response.status_code == 304
+
+    def names(self, path: str, key: str = "username") -> list[str]:
+        response = self.client.get(path)
+        assert response.status_code == 200, response.text
+        return [row[key] for row in response.json()]
+
+    def test_filter_users(self):
+        pi0 = crud.get_user_by_username(self.db, "pi0")
+        assert self.names("/users/?is_pi=true") == ["pi0", "pi100"]
+        assert self.names(f"/users/?sponsor_id={pi0.id}") == ["user0", "user1", "user2"]
+        assert self.names("/users/?pirg=pirg0") == ["user0", "user1", "user2"]
+        assert len(self.names("/users/?group=group100")) == 20
+        assert self.names("/users/?group=nope") == []
+        assert self.names("/users/?pirg=pirg100&username=user11") == [
+            f"user11{i}" for i in range(10)
+        ]
+        # prefixes are literal and case sensitive
+        assert self.names("/users/?username=user_") == []
+        assert self.names("/users/?username=User") == []
+        # the last code point has nothing after it to bound the range with
+        assert self.names("/users/?username=user1\U0010ffff") == []
+        assert len(self.names("/users/?updated_since=2000-01-01T00:00:00Z")) == 25
+        assert self.names("/users/?updated_since=2999-01-01T00:00:00Z") == []
+
+    def test_filter_pirgs_and_groups(self):
+        pi100 = crud.get_user_by_username(self.db, "pi100")
+        assert self.names("/pirgs/?user=user0", "name") == ["pirg0"]
+        assert self.names("/pirgs/?name=pirg1", "name") == ["pirg100"]
+        assert self.names("/groups/?name=\U0010ffff", "name") == []
+        assert self.names(f"/pirgs/?owner_id={pi100.id}", "name") == ["pirg100"]
+        assert self.names("/groups/?pirg=pirg100", "name") == ["group100"]
+        assert self.names("/groups/?user=user0", "name") == ["group0"]
+        assert self.names("/pirgs/pirg0/groups?user=user100", "name") == []
+
+    def test_filters_match_schema_path(self):
+        slow_settings = dataclasses.replace(pagination.settings, fast_json=False)
+        for path in [
+            "/users/?is_pi=false&limit=5&after=2",
+            "/users/?q=number1",
+            "/pirgs/?user=user101",
+            "/groups/?name=group",
+        ]:
+            fast = self.client.get(path)
+            with patch.object(pagination, "settings", slow_settings):
+                slow = self.client.get(path)
+            assert fast.content == slow.content
+            assert fast.headers.get("link") == slow.headers.get("link")
+
+    def test_search_users(self):
+        # substrings of any searched column, ignoring case
+        assert self.names("/users/?q=umber10") == [f"user10{i}" for i in range(10)]
+        assert len(self.names("/users/?q=EXAMPLE.ORG")) == 25
+        # too short for the trigram index, so the columns are scanned instead
+        assert self.names("/users/?q=i1") == ["pi100"]
+        assert self.names("/users/?q=%25") == []
+        assert self.names('/users/?q=a"b') == []
+        response = self.client.get("/users/?q=")
+        assert response.status_code == 422
+
+    def test_search_follows_updates(self):
+        user = crud.get_user_by_username(self.db, "user2")
+        user.firstname = "Zelda"
+        self.db.commit()
+        assert self.names("/users/?q=zeld") == ["user2"]
+        user.firstname = "User"
+        self.db.commit()
+        assert self.names("/users/?q=zeld") == []
+
+    def memberships(self, username: str) -> list[tuple]:
+        response = self.client.get(f"/users/{username}/memberships")
+        assert response.status_code == 200
+        return [(m["entity"], m["name"], m["role"]) for m in response.json()]
+
+    def test_user_memberships(self):
+        assert self.memberships("pi0") == [("pirg", "pirg0", "owner")]
+        assert self.memberships("user0") == [
+            ("group", "group0", "member"),
+            ("pirg", "pirg0", "admin"),
+            ("pirg", "pirg0", "user"),
+        ]
+        assert self.memberships("user1") == [
+            ("group", "group0", "member"),
+            ("pirg", "pirg0", "user"),
+        ]
+        response = self.client.get("/users/nobody/memberships")
+        assert response.status_code == 404
+
+    def test_user_memberships_batch(self):
+        response = self.client.post(
+            "/users/memberships:batch",
+            json={"usernames": ["user1", "nobody", "pi100", "pi100"]},
+        )
+        assert response.status_code == 200
+        body = response.json()
+        assert list(body) == ["user1", "pi100"]
+        assert body["pi100"] == [
+            {"entity": "pirg", "entity_id": 2, "name": "pirg100", "role": "owner"}
+        ]
+        assert len(body["user1"]) == 2
+
+    def test_memberships_follow_writes(self):
+        user = crud.create_user(self.db, self.user_create("joiner"))
+        self.db.commit()
+        assert self.memberships("joiner") == []
+        response = self.client.post("/pirgs/pirg0/users", json={"user_id": user.id})
+        assert response.status_code == 200
+        group = self.client.post(
+            "/pirgs/pirg0/groups",
+            json={"name": "joiners", "pirg_id": 1, "user_ids": [user.id]},
+        ).json()
+        assert self.memberships("joiner") == [
+            ("group", "joiners", "member"),
+            ("pirg", "pirg0", "user"),
+        ]
+        self.client.delete(f"/pirgs/pirg0/groups/{group['id']}")
+        self.client.delete(f"/pirgs/pirg0/users/{user.id}")
+        assert self.memberships("joiner") == []
+
+    def test_sponsees(self):
+        user0_id = crud.get_user_by_username(self.db, "user0").id
+        grand = crud.create_user(self.db, self.user_create("sp_grand"))
+        grand.sponsor_id = user0_id
+        self.db.commit()
+        response = self.client.get("/users/pi0/sponsees")
+        assert [(u["username"], u["depth"]) for u in response.json()] == [
+            ("user0", 1),
+            ("user1", 1),
+            ("user2", 1),
+            ("sp_grand", 2),
+        ]
+        assert response.json()[3]["sponsor_id"] == user0_id
+        response = self.client.get("/users/pi0/sponsees?depth=1")
+        assert len(response.json()) == 3
+        tree = self.client.get("/users/pi0/sponsees?nested=true").json()
+        assert [u["username"] for u in tree] == ["user0", "user1", "user2"]
+        assert [u["username"] for u in tree[0]["sponsees"]] == ["sp_grand"]
+        assert tree[0]["sponsees"][0]["sponsees"] == []
+        assert self.client.get("/users/sp_grand/sponsees").json() == []
+        assert self.client.get("/users/nobody/sponsees").status_code == 404
+
+    def test_sponsors(self):
+        response = self.client.get("/users/sp_grand/sponsors")
+        assert [(u["username"], u["depth"]) for u in response.json()] == [
+            ("user0", 1),
+            ("pi0", 2),
+        ]
+        chain = self.client.get("/users/sp_grand/sponsors?nested=true").json()
+        assert chain["username"] == "user0"
+        assert chain["sponsor"]["username"] == "pi0"
+        assert chain["sponsor"]["sponsor"] is None
+        response = self.client.get("/users/sp_grand/sponsors?depth=1")
+        assert [u["username"] for u in response.json()] == ["user0"]
+        assert self.client.get("/users/pi0/sponsors").json() == []
+        assert self.client.get("/users/pi0/sponsors?nested=true").json() is None
+        assert self.client.get("/users/sp_grand/sponsors?depth=0").status_code == 422
+
+    def test_sponsor_cycle(self):
+        a = crud.create_user(self.db, self.user_create("sp_cycle_a"))
+        b = crud.create_user(self.db, self.user_create("sp_cycle_b"))
+        a.sponsor_id, b.sponsor_id = b.id, a.id
+        self.db.commit()
+        response = self.client.get("/users/sp_cycle_a/sponsees")
+        assert [u["username"] for u in response.json()] == ["sp_cycle_b"]
+        response = self.client.get("/users/sp_cycle_a/sponsors?nested=true")
+        assert response.json()["sponsor"] is None
+
+    def test_pirg_users_batch(self):
+        pirg = self.client.get("/pirgs/?limit=1").json()[0]
+        owner_id = pirg["owner"]["id"]
+        member_id = pirg["users"][0]["id"]
+        outsider_id = self.client.get("/users/").json()[-1]["id"]
+        response = self.client.post(
+            "/pirgs/pirg0/users:batch",
+            json={"user_ids": [owner_id, member_id, outsider_id, 9999]},
+        )
+        assert response.status_code == 200
+        assert response.json() == [
+            {"user_id": owner_id, "status": "unchanged"},
+            {"user_id": member_id, "status": "unchanged"},
+            {"user_id": outsider_id, "status": "added"},
+            {"user_id": 9999, "status": "not_found"},
+        ]
+        response = self.client.request(
+            "DELETE",
+            "/pirgs/pirg0/users:batch",
+            json={"user_ids": [outsider_id, member_id, owner_id]},
+        )
+        assert response.json() == [
+            {"user_id": outsider_id, "status": "removed"},
+            {"user_id": member_id, "status": "removed"},
+            {"user_id": owner_id, "status": "unchanged"},
+        ]
+        pirg = self.client.get("/pirgs/?limit=1").json()[0]
+        assert member_id not in [u["id"] for u in pirg["users"]]
+        assert outsider_id not in [u["id"] for u in pirg["users"]]
+
+    def test_pirg_group_users_batch(self):
+        group = self.client.get("/pirgs/pirg100/groups").json()[0]
+        member_ids = [u["id"] for u in group["users"]]
+        path = f"/pirgs/pirg100/groups/{group['id']}/users:batch"
+        response = self.client.request(
+            "DELETE", path, json={"user_ids": member_ids[:10]}
+        )
+        assert {r["status"] for r in response.json()} == {"removed"}
+        response = self.client.post(path, json={"user_ids": member_ids})
+        statuses = [r["status"] for r in response.json()]
+        assert statuses == ["added"] * 10 + ["unchanged"] * (len(member_ids) - 10)
+        group = self.client.get("/pirgs/pirg100/groups").json()[0]
+        assert sorted(u["id"] for u in group["users"]) == sorted(member_ids)
+
+    def test_batch_query_count_independent_of_size(self):
+        group = self.client.get("/pirgs/pirg100/groups").json()[0]
+        member_ids = [u["id"] for u in group["users"]]
+        path = f"/pirgs/pirg100/groups/{group['id']}/users:batch"
+        counts = []
+        for batch in [member_ids[:1], member_ids[:15]]:
+            with self.queries() as removed:
+                self.client.request("DELETE", path, json={"user_ids": batch})
+            with self.queries() as added:
+                self.client.post(path, json={"user_ids": batch})
+            counts.append((removed.count, added.count))
+        assert counts[0] == counts[1]
+
+    def test_pirg_users_batch_pirg_not_found(self):
+        response = self.client.post("/pirgs/nope/users:batch", json={"user_ids": [1]})
+        assert response.status_code == 404
+
+    def test_post_pirg_resolves_users_in_one_query(self):
+        user_ids = [u["id"] for u in self.client.get("/users/").json()]
+        with self.queries() as q:
+            response = self.client.post(
+                "/pirgs/",
+                json={
+                    "name": "bigpirg",
+                    "owner_id": user_ids[0],
+                    "admin_ids": user_ids[1:3],
+                    "user_ids": user_ids[1:],
+                },
+            )
+        assert response.status_code == 200
+        assert len(response.json()["users"]) == len(user_ids) - 1
+        with self.queries() as small:
+            self.client.post(
+                "/pirgs/",
+                json={
+                    "name": "smallpirg",
+                    "owner_id": user_ids[0],
+                    "admin_ids": user_ids[1:2],
+                    "user_ids": user_ids[1:2],
+                },
+            )
+        assert q.count == small.count
+
+    def test_post_pirg_missing_ids(self):
+        response = self.client.post(
+            "/pirgs/",
+            json={"name": "nopirg", "owner_id": 9999, "admin_ids": [], "user_ids": []},
+        )
+        assert response.status_code == 404
+        assert response.json()["detail"] == "Owner id 9999 does not exist"
+        response = self.client.post(
+            "/pirgs/",
+            json={"name": "nopirg", "owner_id": 1, "admin_ids": [9998], "user_ids": []},
+        )
+        assert response.status_code == 404
+        assert response.json()["detail"] == "User ids [9998] do not exist"
+
+    def test_post_pirg_group_missing_ids(self):
+        response = self.client.post(
+            "/pirgs/pirg0/groups",
+            json={"name": "nogroup", "pirg_id": 1, "user_ids": [1, 9999]},
+        )
+        assert response.status_code == 404
+        assert response.json()["detail"] == "User ids [9999] do not exist"
+
+    def test_post_pirg_group_name_taken_in_other_pirg(self):
+        response = self.client.post(
+            "/pirgs/pirg100/groups",
+            json={"name": "group0", "pirg_id": 2, "user_ids": []},
+        )
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Group already exists"
+
+    def test_get_user_by_id(self):
+        user = self.client.get("/users/?limit=1").json()[0]
+        response = self.client.get(f"/users/{user['id']}")
+        assert response.status_code == 200
+        assert response.json() == user
+
+    def test_get_user_by_username(self):
+        response = self.client.get("/users/user0")
+        assert response.status_code == 200
+        user = response.json()
+        assert user["sponsor"]["username"] == "pi0"
+        assert [g["name"] for g in user["groups"]] == ["group0"]
+
+    def test_get_user_not_found(self):
+        assert self.client.get("/users/9999").status_code == 404
+        assert self.client.get("/users/nobody").status_code == 404
+
+    def test_list_etag_not_modified(self):
+        response = self.client.get("/pirgs/")
+        etag = response.headers["ETag"]
+        with self.queries() as q:
+            response = self.client.get("/pirgs/", headers={"If-None-Match": etag})
+        assert response.status_code == 304 and response.headers["ETag"] == etag
+        # only the collection version was looked up
+        assert q.count == 1
+        # another page of the same collection is a different representation
+        response = self.client.get("/pirgs/?limit=1", headers={"If-None-Match": etag})
+        assert response.status_code == 200 and response.headers["ETag"] != etag
+
+    def test_list_etag_changes_with_membership(self):
+        users_etag = self.client.get("/users/").headers["ETag"]
+        pirgs_etag = self.client.get("/pirgs/").headers["ETag"]
+        groups_etag = self.client.get("/groups/").headers["ETag"]
+        user = self.client.get("/users/user105").json()
+        self.client.post("/pirgs/pirg0/users:batch", json={"user_ids": [user["id"]]})
+        assert self.client.get("/users/").headers["ETag"] != users_etag
+        assert self.client.get("/pirgs/").headers["ETag"] != pirgs_etag
+        assert self.client.get("/groups/").headers["ETag"] == groups_etag
+        # adding them again changes nothing, so the etag stays the same
+        pirgs_etag = self.client.get("/pirgs/").headers["ETag"]
+        self.client.post("/pirgs/pirg0/users:batch", json={"user_ids": [user["id"]]})
+        response = self.client.get("/pirgs/", headers={"If-None-Match": pirgs_etag})
+        assert response.status_code == 304
+
+    def test_concurrent_listings_share_one_query(self):
+        herd = 8
+        solo = self.client.get("/pirgs/?limit=2")
+        etag = solo.headers["ETag"]
+        with self.queries() as q:
+            self.client.get("/pirgs/?limit=2")
+        per_request = q.count
+        stream_pirg_rows = crud.stream_pirg_rows
+
+        def held(*args, **kwargs):
+            # hold the first request's query until the rest are waiting on it
+            deadline = time.monotonic() + 10
+            while pagination.flights.followers(etag) < herd - 1:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+            yield from stream_pirg_rows(*args, **kwargs)
+
+        with (
+            patch.object(crud, "stream_pirg_rows", held),
+            ThreadPoolExecutor(herd) as pool,
+            self.queries() as q,
+        ):
+            responses = list(
+                pool.map(lambda _: self.client.get("/pirgs/?limit=2"), range(herd))
+            )
+        assert {r.content for r in responses} == {solo.content}
+        assert {r.headers["Link"] for r in responses} == {solo.headers["Link"]}
+        # one listing between them, the rest only read the collection version
+        assert q.count == per_request + herd - 1
+
+    def test_single_flight_shares_errors(self):
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+
+        def fail():
+            started.set()
+            release.wait()
+            raise ValueError("query failed")
+
+        with ThreadPoolExecutor(2) as pool:
+            leader = pool.submit(flights.do, "key", fail)
+            started.wait()
+            follower = pool.submit(flights.do, "key", lambda: "unused")
+            while not flights.followers("key"):
+                time.sleep(0.01)
+            release.set()
+            for future in (leader, follower):
+                with pytest.raises(ValueError):
+                    future.result()
+        # nothing is kept once the call is over
+        assert flights.do("key", lambda: "again") == "again"
+
+    def test_audit(self):
+        audit_log.buffer.start(self.engine, flush_ms=60000)
+        try:
+            headers = {"X-Remote-User": "auditor"}
+            response = self.client.post(
+                "/pirgs/",
+                json={
+                    "name": "auditpirg",
+                    "owner_id": 1,
+                    "admin_ids": [],
+                    "user_ids": [],
+                },
+                headers=headers,
+            )
+            assert response.status_code == 200
+            user = self.client.get("/users/user105").json()
+            self.client.post(
+                "/pirgs/auditpirg/users", json={"user_id": user["id"]}, headers=headers
+            )
+            self.client.delete(f"/pirgs/auditpirg/users/{user['id']}")
+            # nothing's written until the buffer flushes
+            assert self.client.get("/audit/?name=auditpirg").json() == []
+        finally:
+            audit_log.buffer.stop()
+
+        entries = self.client.get("/audit/?name=auditpirg").json()
+        assert [(e["action"], e["actor"]) for e in entries] == [
+            ("create", "auditor"),
+            ("add", "auditor"),
+            ("remove", None),
+        ]
+        assert (entries[1]["old_role"], entries[1]["new_role"]) == (None, "user")
+        assert (entries[2]["old_role"], entries[2]["new_role"]) == ("user", None)
+
+        by_user = self.client.get("/audit/?user=user105&actor=auditor").json()
+        assert [e["id"] for e in by_user] == [entries[1]["id"]]
+        response = self.client.get("/audit/?name=auditpirg&limit=2")
+        assert len(response.json()) == 2 and "Link" in response.headers
+        after = response.json()[-1]["id"]
+        response = self.client.get(f"/audit/?name=auditpirg&limit=2&after={after}")
+        assert response.json() == entries[2:] and "Link" not in response.headers
+
+    def test_user_etag(self):
+        response = self.client.get("/users/user106")
+        etag = response.headers["ETag"]
+        user_id = response.json()["id"]
+        for path in [f"/users/{user_id}", "/users/user106"]:
+            response = self.client.get(path, headers={"If-None-Match": etag})
+            assert response.status_code == 304
+        group = self.client.get("/groups/?limit=1").json()[0]
+        self.client.post(
+            f"/pirgs/{group['pirg']['name']}/groups/{group['id']}/users:batch",
+            json={"user_ids": [user_id]},
+        )
+        response = self.client.get(f"/users/{user_id}", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert group["name"] in [g["name"] for g in response.json()["groups"]]
+
+    def changes(self, since: int = 0) -> list[dict]:
+        import json
+
+        response = self.client.get(f"/changes/?since={since}")
+        assert response.headers["content-type"] == "application/x-ndjson"
+        return [json.loads(line) for line in response.text.splitlines()]
+
+    def test_changes_feed(self):
+        changes = self.changes()
+        seqs = [c["seq"] for c in changes]
+        assert seqs == sorted(seqs) and len(seqs) == len(set(seqs))
+        created = [(c["entity"], c["name"]) for c in changes if c["action"] == "create"]
+        assert ("user", "pi0") in created
+        assert ("pirg", "pirg0") in created
+        assert ("group", "group0") in created
+        admins = [c for c in changes if c["role"] == "admin" and c["name"] == "pirg0"]
+        assert len(admins) == 1
+
+    def test_changes_since(self):
+        last = self.changes()[-1]["seq"]
+        assert self.changes(since=last) == []
+        group = self.client.get("/pirgs/pirg0/groups").json()[0]
+        user_id = group["users"][0]["id"]
+        path = f"/pirgs/pirg0/groups/{group['id']}/users:batch"
+        self.client.request("DELETE", path, json={"user_ids": [user_id, 9999]})
+        self.client.delete(f"/pirgs/pirg0/groups/{group['id']}")
+        changes = self.changes(since=last)
+        assert [(c["action"], c["member_id"]) for c in changes[:1]] == [
+            ("remove", user_id)
+        ]
+        assert changes[-1]["action"] == "delete"
+        assert changes[-1]["entity"] == "group" and changes[-1]["name"] == "group0"
+        # the remaining members are removed along with the group
+        assert {c["action"] for c in changes[1:-1]} == {"remove"}
+        assert user_id not in [c["member_id"] for c in changes[1:-1]]
+
+    def test_changes_commit_in_seq_order(self):
+        last = self.changes()[-1]["seq"]
+
+        def create(username: str):
+            with self.SessionLocal() as db:
+                crud.create_user(db, self.user_create(username))
+                db.commit()
+
+        with self.SessionLocal() as db:
+            crud.create_user(db, self.user_create("seq_first"))
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                second = pool.submit(create, "seq_second")
+                # it can't log its change until this one has committed, or
+                # a cursor could move past this one's lower seq
+                time.sleep(0.2)
+                assert not second.done()
+                db.commit()
+                second.result()
+        changes = self.changes(since=last)
+        assert [c["name"] for c in changes] == ["seq_first", "seq_second"]
+
+    def test_changes_locked_on_postgres(self):
+        db = MagicMock()
+        db.get_bind.return_value.dialect.name = "postgresql"
+        change = {"entity": "user", "entity_id": 1, "name": "pg", "action": "create"}
+        crud._write_changes(db, [change])
+        lock = db.execute.call_args_list[0].args[0]
+        assert "pg_advisory_xact_lock" in str(
+            lock.compile(dialect=postgresql.dialect())
+        )
+
+    def test_export_unix_groups(self):
+        response = self.client.get("/export/groups", headers={"Accept-Encoding": ""})
+        assert response.headers["content-type"].startswith("text/plain")
+        lines = response.text.splitlines()
+        pirgs = self.client.get("/pirgs/").json()
+        groups = self.client.get("/groups/").json()
+        assert len(lines) == len(pirgs) + len(groups)
+        for pirg in pirgs:
+            members = {pirg["owner"]["username"]}
+            members |= {u["username"] for u in pirg["admins"] + pirg["users"]}
+            line = f"{pirg['name']}:{100000 + pirg['id']}:{','.join(sorted(members))}"
+            assert line in lines
+        for group in groups:
+            members = sorted(u["username"] for u in group["users"])
+            assert (
+                f"{group['name']}:{500000 + group['id']}:{','.join(members)}" in lines
+            )
+
+    def test_export_formats_agree(self):
+        import msgpack
+
+        text = self.client.get("/export/groups").text.splitlines()
+        jsonl = self.client.get("/export/groups?format=jsonl").text.splitlines()
+        packed = msgpack.unpackb(
+            self.client.get("/export/groups?format=msgpack").content
+        )
+        import json
+
+        rows = [json.loads(line) for line in jsonl]
+        assert [[r["kind"], r["name"], r["gid"], r["members"]] for r in rows] == packed
+        assert [
+            f"{r['name']}:{r['gid']}:{','.join(r['members'])}" for r in rows
+        ] == text
+
+    def test_export_content_encoding(self):
+        import gzip
+        import zstandard
+
+        plain = self.client.get(
+            "/export/groups", headers={"Accept-Encoding": "identity"}
+        )
+        assert "content-encoding" not in plain.headers
+        # read the raw bodies, httpx would otherwise decode them for us
+        with self.client.stream(
+            "GET", "/export/groups", headers={"Accept-Encoding": "gzip"}
+        ) as response:
+            assert response.headers["content-encoding"] == "gzip"
+            assert gzip.decompress(b"".join(response.iter_raw())) == plain.content
+        with self.client.stream(
+            "GET", "/export/groups", headers={"Accept-Encoding": "gzip, zstd"}
+        ) as response:
+            assert response.headers["content-encoding"] == "zstd"
+            body = zstandard.ZstdDecompressor().decompress(
+                b"".join(response.iter_raw())
+            )
+            assert body == plain.content
+
+    def test_export_snapshot_regenerated_on_change(self):
+        first = self.client.get("/export/groups")
+        with self.queries() as q:
+            response = self.client.get("/export/groups")
+        assert response.content == first.content
+        # only the versions are read while the snapshot is current
+        assert q.count == 1
+        response = self.client.get(
+            "/export/groups", headers={"If-None-Match": first.headers["ETag"]}
+        )
+        assert response.status_code == 304
+        user = self.client.get("/users/pi0").json()
+        self.client.post("/pirgs/pirg100/users:batch", json={"user_ids": [user["id"]]})
+        with self.queries() as q:
+            response = self.client.get("/export/groups")
+        # the versions, then one aggregated query for every pirg and group
+        assert q.count == 2
+        assert response.headers["ETag"] != first.headers["ETag"]
+        assert response.content != first.content
+
+    def user_create(self, username: str) -> schemas.UserCreate:
+        return schemas.UserCreate(
+            username=username,
+            firstname="Unit",
+            lastname="Work",
+            email=f"{username}@example.org",
+            is_pi=False,
+            sponsor_id=None,
+        )
+
+    def test_write_response_not_stale(self):
+        with self.SessionLocal.begin() as db:
+            db.execute(
+                update(models.Pirg)
+                .filter_by(name="pirg0")
+                .values(updated_at=datetime.datetime(2000, 1, 1))
+            )
+            user = crud.create_user(db, self.user_create("fresh"))
+            user_id = user.id
+        crud.cache.clear()
+        response = self.client.post("/pirgs/pirg0/users", json={"user_id": user_id})
+        assert response.status_code == 200
+        # the version bump's UPDATE set it after the pirg was loaded
+        assert not response.json()["updated_at"].startswith("2000")
+        listed = self.client.get("/pirgs/?name=pirg0").json()[0]
+        assert response.json()["updated_at"] == listed["updated_at"]
+        self.client.delete(f"/pirgs/pirg0/users/{user_id}")
+
+    def test_one_commit_per_request(self):
+        commits = []
+
+        def committed(connection):
+            commits.append(connection)
+
+        event.listen(self.engine, "commit", committed)
+        try:
+            users = [u["id"] for u in self.client.get("/users/?limit=20").json()]
+            response = self.client.post(
+                "/pirgs/",
+                json={
+                    "name": "uow",
+                    "owner_id": users[0],
+                    "admin_ids": [],
+                    "user_ids": [],
+                },
+            )
+            assert response.status_code == 200
+            response = self.client.post(
+                "/pirgs/uow/users:batch", json={"user_ids": users[1:]}
+            )
+            assert response.status_code == 200
+        finally:
+            event.remove(self.engine, "commit", committed)
+        assert len(commits) == 2
+
+    def test_unit_of_work_rolls_back(self):
+        uow = get_uow(self.SessionLocal())
+        db = next(uow)
+        # the first write is in a savepoint, which mustn't commit anything
+        crud.create_user(db, self.user_create("uow_rollback"))
+        with pytest.raises(RuntimeError):
+            uow.throw(RuntimeError("request failed"))
+        with self.SessionLocal() as db:
+            assert crud.get_user_by_username(db, username="uow_rollback") == None
+
+    def test_concurrent_units_of_work(self):
+        with self.SessionLocal.begin() as db:
+            owner = crud.create_user(db, self.user_create("uow_owner"))
+            crud.create_pirg(
+                db,
+                schemas.PirgCreate(
+                    name="uow_race", owner_id=owner.id, admin_ids=[], user_ids=[]
+                ),
+            )
+            crud.create_user(db, self.user_create("uow_a"))
+            crud.create_user(db, self.user_create("uow_b"))
+        a_read = threading.Event()
+        b_done = threading.Event()
+
+        def add(username: str, between):
+            uow = get_uow(self.SessionLocal())
+            db = next(uow)
+            # both read before they write, as the routes do
+            pirg = crud.get_pirg_by_name(db, name="uow_race")
+            user = crud.get_user_by_username(db, username=username)
+            between()
+            crud.add_user_to_pirg(db, pirg, user)
+            next(uow, None)
+
+        def a():
+            a_read.set()
+            # b commits in here unless it's waiting for a to finish
+            b_done.wait(0.5)
+
+        def b():
+            a_read.wait()
+            add("uow_b", lambda: None)
+            b_done.set()
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            first = pool.submit(add, "uow_a", a)
+            second = pool.submit(b)
+            first.result()
+            second.result()
+        with self.SessionLocal() as db:
+            pirg = crud.get_pirg_by_name(db, name="uow_race")
+            assert {u.username for u in pirg.users} == {"uow_a", "uow_b"}
+
+    def test_duplicate_keeps_transaction(self):
+        with self.SessionLocal() as db:
+            crud.create_user(db, self.user_create("uow_first"))
+            with pytest.raises(crud.UserAlreadyExistsError):
+                crud.create_user(db, self.user_create("uow_first"))
+            crud.create_user(db, self.user_create("uow_second"))
+            db.commit()
+        response = self.client.get("/users/uow_first")
+        assert response.status_code == 200
+        response = self.client.get("/users/uow_second")
+        assert response.status_code == 200
+
+    def import_users(self, body: str, content_type: str, **params) -> list[dict]:
+        response = self.client.post(
+            "/users:import",
+            content=body.encode(),
+            headers={"Content-Type": content_type},
+            params=params,
+        )
+        assert response.status_code == 200
+        return [json.loads(line) for line in response.text.splitlines()]
+
+    def test_import_users_csv(self):
+        body = (
+            "username,firstname,lastname,email,is_pi,sponsor\r\n"
+            "imp_ta,Tim,Aardvark,imp_ta@example.org,false,imp_pi\r\n"
+            'imp_pi,"Prin\ncipal",Investigator,imp_pi@example.org,true,\r\n'
+            "imp_bad,No,Email,,false,\r\n"
+            "imp_cols,Too,Few\r\n"
+            "user1,Taken,Name,imp_user1@example.org,false,\r\n"
+            "imp_dup,Email,Taken,user2@example.org,false,\r\n"
+            "imp_orphan,No,Sponsor,imp_orphan@example.org,false,nobody\r\n"
+        )
+        with self.queries() as q:
+            results = self.import_users(body, imports.CSV)
+        statuses = [(r["line"], r["username"], r["status"]) for r in results]
+        assert statuses == [
+            (2, "imp_ta", "created"),
+            (3, "imp_pi", "created"),
+            (5, "imp_bad", "invalid"),
+            (6, None, "invalid"),
+            (7, "user1", "exists"),
+            (8, "imp_dup", "conflict"),
+            (9, "imp_orphan", "sponsor_not_found"),
+        ]
+        # one lookup, an insert per round of sponsors, the bookkeeping
+        assert q.count <= 6
+        ta = self.client.get("/users/imp_ta").json()
+        pi = self.client.get("/users/imp_pi").json()
+        assert ta["sponsor"]["username"] == "imp_pi"
+        assert pi["firstname"] == "Prin\ncipal" and pi["is_pi"] is True
+        assert ta["id"] == results[0]["id"]
+
+    def test_import_users_csv_stray_quote(self):
+        body = (
+            "username,firstname,lastname,email,is_pi\n"
+            'imp_sq1,Stray,O"Brien,imp_sq1@example.org,false\n'
+            "imp_sq2,Next,Row,imp_sq2@example.org,false\n"
+            'imp_sq3,"Quoted ""in"" full",Row,imp_sq3@example.org,false\n'
+        )
+        results = self.import_users(body, imports.CSV)
+        statuses = [(r["line"], r["username"], r["status"]) for r in results]
+        # a quote inside an unquoted field is just a character, so it doesn't
+        # carry the record onto the lines after it
+        assert statuses == [
+            (2, "imp_sq1", "created"),
+            (3, "imp_sq2", "created"),
+            (4, "imp_sq3", "created"),
+        ]
+        assert self.client.get("/users/imp_sq1").json()["lastname"] == 'O"Brien'
+        sq3 = self.client.get("/users/imp_sq3").json()
+        assert sq3["firstname"] == 'Quoted "in" full'
+
+    def test_import_users_ndjson_upsert(self):
+        users = [
+            {**self.user_create("imp_up").model_dump(), "sponsor_id": None},
+            {"username": "imp_up", "firstname": "Again"},
+            "not an object",
+        ]
+        body = "\n".join(json.dumps(u) for u in users) + "\n{bad json\n"
+        results = self.import_users(body, pagination.NDJSON)
+        assert [r["status"] for r in results] == [
+            "created",
+            "invalid",
+            "invalid",
+            "invalid",
+        ]
+        etag = self.client.get("/users/imp_up").headers["ETag"]
+        changed = {**users[0], "lastname": "Changed"}
+        body = json.dumps(users[0]) + "\n" + json.dumps(changed) + "\n"
+        results = self.import_users(body, pagination.NDJSON)
+        assert [r["status"] for r in results] == ["exists", "exists"]
+        since = self.changes()[-1]["seq"]
+        results = self.import_users(body, pagination.NDJSON, upsert="true")
+        # the repeat starts a new batch, so it sees the first row's write
+        assert [r["status"] for r in results] == ["unchanged", "updated"]
+        response = self.client.get("/users/imp_up")
+        assert response.json()["lastname"] == "Changed"
+        assert response.headers["ETag"] != etag
+        changes = [
+            (c["entity"], c["entity_id"], c["name"], c["action"])
+            for c in self.changes(since)
+        ]
+        assert changes == [("user", results[1]["id"], "imp_up", "update")]
+
+    def test_import_users_batches(self):
+        body = "".join(
+            json.dumps(
+                {
+                    **self.user_create(f"imp_batch{i}").model_dump(),
+                    "sponsor": f"imp_batch{i - 1}" if i else None,
+                }
+            )
+            + "\n"
+            for i in range(7)
+        )
+        with patch.object(imports, "IMPORT_BATCH_SIZE", 3):
+            results = self.import_users(body, pagination.NDJSON)
+        assert {r["status"] for r in results} == {"created"}
+        user = self.client.get("/users/imp_batch6").json()
+        assert user["sponsor"]["username"] == "imp_batch5"
+
+    def test_import_users_failed_batch(self):
+        body = "".join(
+            self.user_create(f"imp_fail{i}").model_dump_json() + "\n" for i in range(6)
+        )
+        import_users = crud.import_users
+        calls = []
+
+        def fail_second(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 2:
+                raise RuntimeError("batch failed")
+            return import_users(**kwargs)
+
+        with (
+            patch.object(imports, "IMPORT_BATCH_SIZE", 2),
+            patch.object(crud, "import_users", fail_second),
+        ):
+            results = self.import_users(body, pagination.NDJSON)
+        # the failed batch is reported, and the rest still imported
+        assert [r["status"] for r in results] == [
+            "created",
+            "created",
+            "error",
+            "error",
+            "created",
+            "created",
+        ]
+        assert self.client.get("/users/imp_fail2").status_code == 404
+        assert self.client.get("/users/imp_fail5").status_code == 200
+
+    def test_body_streaming_response_background(self):
+        ran = []
+        app = FastAPI()
+
+        @app.post("/echo")
+        async def echo(request: Request):
+            return imports.BodyStreamingResponse(
+                request.stream(), background=BackgroundTask(ran.append, True)
+            )
+
+        body = b"x" * 100000
+        response = TestClient(app).post("/echo", content=body)
+        assert response.content == body
+        assert ran == [True]
+
+    def test_import_users_content_type(self):
+        response = self.client.post(
+            "/users:import", content=b"{}", headers={"Content-Type": "text/plain"}
+        )
+        assert response.status_code == 415
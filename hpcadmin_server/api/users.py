@@ -1,39 +1,270 @@
-from fastapi import APIRouter, Depends, HTTPException
+import logging
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from . import schemas
-from ..database import crud
-from ..database.db import get_db
+from . import imports, schemas
+from .conditional import collection_etag, entity_etag, is_not_modified, not_modified
+from .pagination import (
+    Page,
+    fast_json,
+    json_response,
+    ndjson_response,
+    NDJSON,
+    rows_response,
+    set_next_link,
+    sparse_fields,
+    wants_ndjson,
+)
+from ..database import async_crud, crud
+from ..database.async_db import get_async_db
+from ..database.db import begin_write, get_db, get_uow
+from ..metrics import TimedRoute
 
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/users",
     tags=["users"],
     dependencies=[],
     responses={404: {"description": "Not found"}},
+    route_class=TimedRoute,
 )
 
 
 @router.get("/", response_model=list[schemas.User])
-async def get_users(db: Session = Depends(get_db)):
-    users = crud.get_users(db=db)
+def get_users(
+    request: Request,
+    response: Response,
+    page: Page = Depends(),
+    fields: tuple[str, ...] | None = Depends(sparse_fields(schemas.User)),
+    filters: schemas.UserFilter = Query(),
+    db: Session = Depends(get_db),
+):
+    # the version is read first, so the listing is never older than its etag
+    etag = collection_etag(request, "users", crud.get_collection_version(db, "users"))
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    if fields or fast_json():
+        rows = crud.stream_user_rows(
+            db=db, limit=page.limit, after=page.after, fields=fields, filters=filters
+        )
+        return rows_response(request, response, rows, page, etag)
+    if wants_ndjson(request):
+        users = crud.stream_users(
+            db=db, limit=page.limit, after=page.after, filters=filters
+        )
+        return ndjson_response(users, schemas.User, headers={"ETag": etag})
+    users = crud.get_users(db=db, limit=page.limit, after=page.after, filters=filters)
+    set_next_link(request, response, users, page)
+    response.headers["ETag"] = etag
     return users
 
 
 @router.post("/", response_model=schemas.User)
-async def post_user(user_create: schemas.UserCreate, db: Session = Depends(get_db)):
+def post_user(
+    user_create: schemas.UserCreate, db: Session = Depends(get_uow, scope="function")
+):
     db_user = crud.get_user_by_username(db=db, username=user_create.username)
     if db_user:
         raise HTTPException(status_code=400, detail="User already exists")
     return crud.create_user(db=db, user=user_create)
 
 
-@router.get("/{id}", response_model=schemas.User)
-async def get_user_by_id(id: int, db: Session = Depends(get_db)):
-    user = crud.get_user(db=db, id=id)
+def _import_batch(
+    db: Session, rows: list[tuple[int, schemas.UserImport]], upsert: bool
+) -> dict[int, schemas.UserImportResult]:
+    try:
+        begin_write(db)
+        results = crud.import_users(db=db, rows=rows, upsert=upsert)
+        db.commit()
+    except Exception:
+        db.rollback()
+        # the rest of the import goes ahead, rather than the response being
+        # cut off partway
+        logger.exception("Importing a batch of %d users failed", len(rows))
+        return {
+            line: schemas.UserImportResult(
+                line=line,
+                username=user.username,
+                status=schemas.UserImportStatus.ERROR,
+                detail="Writing this row's batch failed",
+            )
+            for line, user in rows
+        }
+    return results
+
+
+@router.post(":import", response_model=list[schemas.UserImportResult])
+async def import_users(
+    request: Request,
+    upsert: bool = Query(default=False, description="Update users that exist"),
+    db: Session = Depends(get_db),
+):
+    """
+    Create users from a CSV (with a header row) or newline delimited json
+    body, named by its Content-Type. The body is read, and the users written,
+    in batches as it arrives, and a result for every row is streamed back as
+    newline delimited json. Each batch is committed on its own, so rerunning
+    an import that failed partway with `upsert` finishes it.
+    """
+    content_type = imports.import_format(request)
+
+    async def report():
+        rows = imports.read_users(request, content_type)
+        async for batch in imports.batches(rows):
+            valid = [row for row in batch if isinstance(row[1], schemas.UserImport)]
+            results = {}
+            if valid:
+                results = await run_in_threadpool(_import_batch, db, valid, upsert)
+            lines = []
+            for line, user in batch:
+                result = results[line] if line in results else user
+                lines.append(result.model_dump_json() + "\n")
+            yield "".join(lines)
+
+    return imports.BodyStreamingResponse(report(), media_type=NDJSON)
+
+
+@router.get("/{id:int}", response_model=schemas.User)
+async def get_user_by_id(
+    id: int,
+    request: Request,
+    response: Response,
+    fields: tuple[str, ...] | None = Depends(sparse_fields(schemas.User)),
+    db: AsyncSession = Depends(get_async_db),
+):
+    # answer revalidations from the version column alone
+    version = await async_crud.get_user_version(db=db, id=id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    etag = entity_etag("user", id, version, fields)
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    if fields:
+        row = await async_crud.get_user_row(db=db, fields=fields, id=id)
+        if row is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        return json_response(row, headers={"ETag": etag})
+    user = await async_crud.get_user(db=db, id=id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    response.headers["ETag"] = entity_etag("user", user.id, user.version)
     return user
 
 
 @router.get("/{username}", response_model=schemas.User)
-async def get_user_by_username(username: str, db: Session = Depends(get_db)):
-    user = crud.get_user_by_username(db=db, username=username)
+async def get_user_by_username(
+    username: str,
+    request: Request,
+    response: Response,
+    fields: tuple[str, ...] | None = Depends(sparse_fields(schemas.User)),
+    db: AsyncSession = Depends(get_async_db),
+):
+    row = await async_crud.get_user_version_by_username(db=db, username=username)
+    if row is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    etag = entity_etag("user", *row, fields)
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    if fields:
+        user = await async_crud.get_user_row(db=db, fields=fields, username=username)
+        if user is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        return json_response(user, headers={"ETag": etag})
+    user = await async_crud.get_user_by_username(db=db, username=username)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    response.headers["ETag"] = entity_etag("user", user.id, user.version)
     return user
+
+
+@router.get("/{username}/memberships", response_model=list[schemas.Membership])
+async def get_user_memberships(username: str, db: AsyncSession = Depends(get_async_db)):
+    """
+    Every pirg the user owns, administers or is a user of, and every group
+    they're a member of.
+    """
+    memberships = await async_crud.get_memberships(db=db, usernames=[username])
+    if username not in memberships:
+        raise HTTPException(status_code=404, detail="User not found")
+    return json_response(memberships[username])
+
+
+# levels the sponsor routes walk at most
+MAX_SPONSOR_DEPTH = 32
+
+
+def _nest_sponsees(rows: list[dict]) -> list[dict]:
+    # rows come nearest first, so everyone's sponsor is placed before them
+    nodes = {}
+    roots = []
+    for row in rows:
+        node = nodes[row["id"]] = {**row, "sponsees": []}
+        parent = nodes.get(row["sponsor_id"])
+        (parent["sponsees"] if parent else roots).append(node)
+    return roots
+
+
+def _nest_sponsors(rows: list[dict]) -> dict | None:
+    node = None
+    for row in reversed(rows):
+        node = {**row, "sponsor": node}
+    return node
+
+
+@router.get(
+    "/{username}/sponsees",
+    response_model=list[schemas.SponsorTreeUser] | list[schemas.SponseeTree],
+)
+async def get_user_sponsees(
+    username: str,
+    depth: int = Query(default=MAX_SPONSOR_DEPTH, ge=1, le=MAX_SPONSOR_DEPTH),
+    nested: bool = False,
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Everyone the user sponsors, directly or through the users they sponsor,
+    up to `depth` levels down. A flat list nearest first, or with `nested`
+    the direct sponsees, each with their own.
+    """
+    rows = await async_crud.get_sponsor_tree(db=db, username=username, depth=depth)
+    if rows is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return json_response(_nest_sponsees(rows) if nested else rows)
+
+
+@router.get(
+    "/{username}/sponsors",
+    response_model=list[schemas.SponsorTreeUser] | schemas.SponsorChain | None,
+)
+async def get_user_sponsors(
+    username: str,
+    depth: int = Query(default=MAX_SPONSOR_DEPTH, ge=1, le=MAX_SPONSOR_DEPTH),
+    nested: bool = False,
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    The user's sponsor, their sponsor's sponsor and so on, up to `depth`
+    levels. A flat list nearest first, or with `nested` the sponsor with
+    theirs nested inside it.
+    """
+    rows = await async_crud.get_sponsor_tree(
+        db=db, username=username, depth=depth, up=True
+    )
+    if rows is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return json_response(_nest_sponsors(rows) if nested else rows)
+
+
+@router.post("/memberships:batch", response_model=dict[str, list[schemas.Membership]])
+async def post_user_memberships_batch(
+    users: schemas.Usernames, db: AsyncSession = Depends(get_async_db)
+):
+    """
+    The memberships of many users at once, keyed by username. Usernames
+    that don't exist are left out.
+    """
+    memberships = await async_crud.get_memberships(db=db, usernames=users.usernames)
+    return json_response(memberships)
@@ -0,0 +1,155 @@
+"""
+The application factory. Importing this, or building an app with
+`create_app`, doesn't touch the database; that waits for the lifespan's
+startup, which checks the schema revision and warms the statement caches.
+"""
+
+import logging
+import sys
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI
+
+from .api import audit, changes, export, groups, metrics, pirgs, users
+from .config import settings
+from .database import async_crud, async_db, crud, db, migrations
+from .database import audit as audit_log
+from .metrics import WARM_UP_EXTENSION, MetricsMiddleware, instrument_engine
+from .metrics import metrics as registry
+
+logger = logging.getLogger(__name__)
+
+ROUTERS = [
+    users.router,
+    pirgs.router,
+    groups.router,
+    changes.router,
+    audit.router,
+    export.router,
+    metrics.router,
+]
+
+# one per router, each cheap to answer
+WARM_UP_PATHS = ["/users/", "/pirgs/", "/groups/", "/changes/"]
+
+# past any real id, so the cursor shapes compile without reading a listing
+_WARM_UP_AFTER = sys.maxsize
+
+
+def warm_up(SessionLocal) -> None:
+    """
+    Run the hot read queries once each, so SQLAlchemy has compiled them and
+    the ORM has configured its mappers before the first request does. Each
+    only reads, and matches at most a row.
+    """
+    with SessionLocal() as session:
+        crud.get_collection_versions(session, "users", "pirgs", "groups")
+        # the unpaginated listings can't be run without reading everything,
+        # so they compile on first use
+        for limit, after in [(1, None), (1, _WARM_UP_AFTER), (None, _WARM_UP_AFTER)]:
+            for rows in [
+                crud.stream_user_rows(session, limit=limit, after=after),
+                crud.stream_pirg_rows(session, limit=limit, after=after),
+                crud.stream_pirg_group_rows(session, limit=limit, after=after),
+            ]:
+                list(rows)
+        crud.get_user(session, id=0)
+        crud.get_user_by_username(session, username="")
+        crud.get_pirg_by_name(session, name="")
+        crud.get_changes(session, since=_WARM_UP_AFTER, limit=1)
+
+
+async def warm_up_async(AsyncSessionLocal) -> None:
+    """
+    The same for the async routes' lookups, since the compiled statement
+    cache is per engine.
+    """
+    async with AsyncSessionLocal() as session:
+        await async_crud.get_user_version(session, id=0)
+        await async_crud.get_user_version_by_username(session, username="")
+        await async_crud.get_user(session, id=0)
+        await async_crud.get_user_by_username(session, username="")
+        await async_crud.get_memberships(session, usernames=[""])
+        await async_crud.get_sponsor_tree(session, username="", depth=1)
+        await async_crud.get_sponsor_tree(session, username="", depth=1, up=True)
+
+
+async def warm_up_requests(app: FastAPI) -> None:
+    """
+    FastAPI sets up an included router's routes, and builds the middleware
+    stack, on the first request that needs them, and looks up where each
+    endpoint is defined on its own first request. Send one small request
+    through each router, so that's done before traffic arrives. They're
+    marked so the metrics leave them out.
+    """
+    for path in WARM_UP_PATHS:
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0", "spec_version": "2.4"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "root_path": "",
+            "query_string": b"limit=1",
+            "headers": [(b"host", b"warm-up")],
+            "server": None,
+            "client": None,
+            "extensions": {WARM_UP_EXTENSION: {}},
+        }
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            pass
+
+        await app(scope, receive, send)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # fail fast if the database can't be reached
+    db.check_connection(db.engine)
+    if db._is_memory_sqlite(db.engine.url):
+        # nothing outlives the process, so there's nothing to migrate ahead
+        migrations.upgrade(db.engine)
+    else:
+        migrations.check(db.engine)
+    if settings.audit:
+        audit_log.buffer.start(db.engine)
+    if settings.warm_up:
+        start = time.perf_counter()
+        warm_up(db.SessionLocal)
+        if async_db.async_engine is not None:
+            await warm_up_async(async_db.AsyncSessionLocal)
+        await warm_up_requests(app)
+        logger.info("Warmed up in %.1fms", (time.perf_counter() - start) * 1000)
+    yield
+    # write out the buffered audit entries while the engine is still there
+    audit_log.buffer.stop()
+    db.engine.dispose()
+    if async_db.async_engine is not None:
+        await async_db.async_engine.dispose()
+
+
+def _instrument(engine, name: str) -> None:
+    # apps share the module's engines, which only need hooking once
+    if name not in registry.engines:
+        instrument_engine(engine, name)
+
+
+def create_app() -> FastAPI:
+    _instrument(db.engine, "sync")
+    if async_db.async_engine is not None:
+        _instrument(async_db.async_engine.sync_engine, "async")
+
+    app = FastAPI(lifespan=lifespan)
+    app.add_middleware(audit.ActorMiddleware)
+    app.add_middleware(MetricsMiddleware)
+
+    for router in ROUTERS:
+        app.include_router(router)
+    return app
@@ -0,0 +1,118 @@
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .crud import eager_load, sponsor_tree_query, stream_projected
+from .models import User, Membership
+from ..api import schemas
+
+# Async counterparts of the lookups in crud. Async sessions can't lazy load
+# once the handler has returned, so everything the response schema walks is
+# loaded up front.
+
+
+#####
+# Users
+#####
+
+
+async def get_user(db: AsyncSession, id: int) -> User | None:
+    query = select(User).filter_by(id=id).options(*eager_load(User, schemas.User))
+    return await db.scalar(query)
+
+
+async def get_user_row(
+    db: AsyncSession, fields: tuple[str, ...] | None = None, **filters
+) -> dict | None:
+    # a single user projected like crud.stream_user_rows, for sparse fields
+    def project(session):
+        where = tuple(getattr(User, k) == v for k, v in filters.items())
+        rows = list(
+            stream_projected(session, User, schemas.User, where=where, fields=fields)
+        )
+        return rows[0] if rows else None
+
+    return await db.run_sync(project)
+
+
+async def get_user_version(db: AsyncSession, id: int) -> int | None:
+    return await db.scalar(select(User.version).filter_by(id=id))
+
+
+async def get_user_version_by_username(
+    db: AsyncSession, username: str
+) -> tuple[int, int] | None:
+    row = await db.execute(select(User.id, User.version).filter_by(username=username))
+    return row.first()
+
+
+async def get_user_by_username(db: AsyncSession, username: str) -> User | None:
+    query = (
+        select(User)
+        .filter_by(username=username)
+        .options(*eager_load(User, schemas.User))
+    )
+    return await db.scalar(query)
+
+
+async def get_sponsor_tree(
+    db: AsyncSession, username: str, depth: int, up: bool = False
+) -> list[dict] | None:
+    """
+    The users below `username` in the sponsor hierarchy, or above it with
+    `up`, nearest first, as dicts shaped like
+    schemas.SponsorTreeUser. None if there's
+    no such user.
+    """
+    rows = (await db.execute(sponsor_tree_query(username, depth, up))).all()
+    if not rows:
+        return None
+    # a cycle would bring users round again, further down
+    seen = set()
+    tree = []
+    for row in rows:
+        if row.id not in seen:
+            seen.add(row.id)
+            tree.append(row._asdict())
+    return tree[1:]
+
+
+# usernames per query, well under sqlite's bound parameter limit
+MEMBERSHIP_BATCH_SIZE = 1000
+
+
+async def get_memberships(
+    db: AsyncSession, usernames: list[str]
+) -> dict[str, list[dict]]:
+    """
+    What each of `usernames` is effectively a member of, straight from the
+    memberships table, as dicts shaped like schemas.Membership. Usernames
+    that don't exist are left out.
+    """
+    usernames = list(dict.fromkeys(usernames))
+    results = {}
+    for start in range(0, len(usernames), MEMBERSHIP_BATCH_SIZE):
+        batch = usernames[start : start + MEMBERSHIP_BATCH_SIZE]
+        query = (
+            select(
+                User.username,
+                Membership.entity,
+                Membership.entity_id,
+                Membership.name,
+                Membership.role,
+            )
+            .outerjoin(Membership, Membership.user_id == User.id)
+            .where(User.username.in_(batch))
+            .order_by(User.id, Membership.entity, Membership.entity_id, Membership.role)
+        )
+        for username, entity, entity_id, name, role in await db.execute(query):
+            memberships = results.setdefault(username, [])
+            if entity is not None:
+                memberships.append(
+                    {
+                        "entity": entity,
+                        "entity_id": entity_id,
+                        "name": name,
+                        "role": role,
+                    }
+                )
+    return results
@@ -0,0 +1,92 @@
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from ..config import Settings, settings
+from . import db
+from .db import _is_memory_sqlite, _set_sqlite_pragmas
+
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "postgresql": "asyncpg",
+}
+
+
+def async_url(database_url: str):
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for {backend} databases")
+    if _is_memory_sqlite(url):
+        # the sync and async engines would each see their own empty database
+        raise ValueError("The async engine needs a file or server database")
+    return url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+
+
+def create_async_db_engine(settings: Settings) -> AsyncEngine:
+    url = async_url(settings.database_url)
+    engine = create_async_engine(
+        url,
+        pool_size=settings.pool_size,
+        max_overflow=settings.max_overflow,
+        pool_timeout=settings.pool_timeout,
+        pool_pre_ping=settings.pool_pre_ping,
+        pool_recycle=settings.pool_recycle,
+        echo=settings.echo,
+    )
+    if url.get_backend_name() == "sqlite":
+        event.listen(engine.sync_engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+
+async def check_async_connection(engine: AsyncEngine) -> None:
+    async with engine.connect() as connection:
+        await connection.execute(text("SELECT 1"))
+
+
+# objects are handed to the response serializer after the session is done
+# with them, so they must not be expired on commit
+AsyncSessionLocal = async_sessionmaker(expire_on_commit=False)
+async_engine = None
+if not _is_memory_sqlite(make_url(settings.database_url)):
+    async_engine = create_async_db_engine(settings)
+    AsyncSessionLocal.configure(bind=async_engine)
+
+
+class ThreadedSession:
+    """
+    The part of AsyncSession that async_crud uses, over a sync Session, each
+    query run in the threadpool. Results are buffered there, so nothing
+    touches the connection from the event loop.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    async def scalar(self, statement):
+        return await run_in_threadpool(self.session.scalar, statement)
+
+    async def execute(self, statement):
+        def execute():
+            return self.session.execute(statement).freeze()()
+
+        return await run_in_threadpool(execute)
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await run_in_threadpool(fn, self.session, *args, **kwargs)
+
+
+async def get_async_db():
+    if async_engine is None:
+        # an in-memory database is only reachable through the sync engine's
+        # one connection
+        with db.SessionLocal() as session:
+            yield ThreadedSession(session)
+        return
+    async with AsyncSessionLocal() as session:
+        yield session
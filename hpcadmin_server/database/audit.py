@@ -0,0 +1,160 @@
+"""
+The audit log: who made each create, delete and membership change, and when.
+
+crud records an entry with each change it writes to the change log, stamped
+with the time and the current `actor`. Entries are held on the session until
+it commits, and dropped if it rolls back. Then they go to `buffer`, whose
+thread writes them in multi-row inserts once `batch_size` have built up or
+`flush_ms` has passed, so write requests don't wait on the audit table.
+`stop` writes whatever is left, and the app calls it on shutdown. Entries
+still buffered when a process is killed outright are lost; the change log
+still has those changes, without the actor.
+
+Nothing is recorded unless the buffer has been started, so scripts and tests
+that don't want an audit log don't collect one in memory.
+"""
+
+import contextvars
+import logging
+import threading
+from datetime import datetime, timezone
+
+from sqlalchemy import event, insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from .models import AuditEntry
+
+logger = logging.getLogger(__name__)
+
+# who is making the changes, set for each request from the header the
+# authenticating proxy sets, see api/audit.py. Scripts can set it themselves
+actor: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+    "hpcadmin_audit_actor", default=None
+)
+
+# where a session's entries wait for it to commit
+_PENDING = "hpcadmin_audit"
+
+
+def record(db: Session, entries: list[dict]) -> None:
+    """
+    Add `entries`, with AuditEntry's columns other than the id, actor and
+    time, to the log once `db` commits.
+    """
+    if not entries or not buffer.running:
+        return
+    now = datetime.now(timezone.utc)
+    who = actor.get()
+    db.info.setdefault(_PENDING, []).extend(
+        {**entry, "actor": who, "created_at": now} for entry in entries
+    )
+
+
+# crud's savepoints only wrap adding a row, never recording its change, so
+# only the outer transaction's end matters
+@event.listens_for(Session, "after_commit")
+def _committed(session: Session) -> None:
+    entries = session.info.pop(_PENDING, None)
+    if entries:
+        buffer.add(entries)
+
+
+@event.listens_for(Session, "after_rollback")
+def _rolled_back(session: Session) -> None:
+    session.info.pop(_PENDING, None)
+
+
+class AuditBuffer:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._entries = []
+        self._thread = None
+        self._stopping = False
+        self.engine = None
+        self.batch_size = settings.audit_batch_size
+        self.flush_ms = settings.audit_flush_ms
+        self.max_entries = settings.audit_max_buffer
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(
+        self,
+        engine: Engine,
+        batch_size: int = settings.audit_batch_size,
+        flush_ms: int = settings.audit_flush_ms,
+        max_entries: int = settings.audit_max_buffer,
+    ) -> None:
+        self.engine = engine
+        self.batch_size = batch_size
+        self.flush_ms = flush_ms
+        self.max_entries = max_entries
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="audit", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the thread and write what's left.
+        """
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+        if not self.flush():
+            with self._cond:
+                lost, self._entries = len(self._entries), []
+            logger.error("Lost %d audit entries at shutdown", lost)
+
+    def add(self, entries: list[dict]) -> None:
+        with self._cond:
+            self._entries.extend(entries)
+            overflow = len(self._entries) - self.max_entries
+            if overflow > 0:
+                del self._entries[:overflow]
+                logger.error("Audit buffer full, dropped %d entries", overflow)
+            if len(self._entries) >= self.batch_size:
+                self._cond.notify()
+
+    def flush(self) -> bool:
+        """
+        Write everything buffered now, returning False if it couldn't be, in
+        which case it's kept for the next try.
+        """
+        with self._cond:
+            entries, self._entries = self._entries, []
+        if not entries:
+            return True
+        try:
+            with self.engine.begin() as connection:
+                for i in range(0, len(entries), self.batch_size):
+                    chunk = entries[i : i + self.batch_size]
+                    # one INSERT with a VALUES row per entry
+                    connection.execute(insert(AuditEntry).values(chunk))
+        except Exception:
+            logger.exception("Writing %d audit entries failed", len(entries))
+            with self._cond:
+                self._entries[:0] = entries
+            return False
+        return True
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if not self._stopping and len(self._entries) < self.batch_size:
+                    self._cond.wait(self.flush_ms / 1000)
+                if self._stopping:
+                    return
+            if not self.flush():
+                # wait out the interval rather than retrying straight away
+                with self._cond:
+                    self._cond.wait(self.flush_ms / 1000)
+
+
+buffer = AuditBuffer()
@@ -0,0 +1,140 @@
+import abc
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+
+class CacheBackend(abc.ABC):
+    """
+    Storage for the lookup cache. Values are plain dicts of column values, so
+    a shared backend (memcached, redis, ...) only has to be able to
+    serialize those, and can be swapped in by implementing these methods.
+    """
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Any | None: ...
+
+    @abc.abstractmethod
+    def set(self, key: str, value: Any) -> None: ...
+
+    @abc.abstractmethod
+    def delete(self, *keys: str) -> None: ...
+
+    @abc.abstractmethod
+    def clear(self) -> None: ...
+
+    def __len__(self) -> int:
+        return 0
+
+
+class NullCache(CacheBackend):
+    def get(self, key: str) -> Any | None:
+        return None
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+    def delete(self, *keys: str) -> None:
+        pass
+
+    def clear(self) -> None:
+        pass
+
+
+class MemoryCache(CacheBackend):
+    """
+    In-process LRU cache with a time to live. Other workers don't see this
+    process' invalidations, so the ttl bounds how stale a lookup can get
+    when running more than one.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys: str) -> None:
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class Cache:
+    """
+    Counts hits, misses and invalidations on top of any backend.
+
+    A value read from the database before a change commits can reach `set`
+    after the change's invalidation, and would then be served until the ttl
+    runs out. So `generation` counts invalidations, and a `set` given the
+    generation from before its value was loaded is skipped if anything has
+    been invalidated since.
+    """
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any | None:
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any, generation: int | None = None) -> None:
+        with self._lock:
+            if generation is None or generation == self.generation:
+                self.backend.set(key, value)
+
+    def invalidate(self, *keys: str) -> None:
+        with self._lock:
+            self.generation += 1
+            self.invalidations += len(keys)
+            self.backend.delete(*keys)
+
+    def clear(self) -> None:
+        self.backend.clear()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "size": len(self.backend),
+        }
@@ -1,8 +1,688 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import select
+import functools
+import sys
+import types
+import typing
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Iterator
 
-from .models import User, Pirg, Group
+from sqlalchemy.orm import (
+    Session,
+    aliased,
+    joinedload,
+    make_transient_to_detached,
+    selectinload,
+)
+from sqlalchemy import (
+    Table,
+    and_,
+    delete,
+    event,
+    insert,
+    inspect,
+    func,
+    literal,
+    literal_column,
+    or_,
+    select,
+    text,
+    union,
+    union_all,
+    update,
+)
+from sqlalchemy.exc import IntegrityError
+
+from . import audit
+from .cache import Cache, MemoryCache, NullCache
+from .models import (
+    User,
+    Pirg,
+    Group,
+    CollectionVersion,
+    AuditEntry,
+    Change,
+    Membership,
+    USER_SEARCH_COLUMNS,
+    USER_SEARCH_TABLE,
+    pirg_user_association_table,
+    pirg_admin_association_table,
+    group_user_association_table,
+)
 from ..api import schemas
+from ..config import settings
+
+#####
+# Loader strategies
+#####
+
+
+def _schema_fields(schema: type) -> dict:
+    # pydantic dataclasses and models both keep their fields here
+    return getattr(schema, "__pydantic_fields__", None) or {}
+
+
+def _nested_schema(annotation) -> type | None:
+    # unwrap list[X] and X | None down to X, if X is itself a schema
+    if typing.get_origin(annotation) in (list, typing.Union, types.UnionType):
+        for arg in typing.get_args(annotation):
+            nested = _nested_schema(arg)
+            if nested:
+                return nested
+        return None
+    if isinstance(annotation, type) and _schema_fields(annotation):
+        return annotation
+    return None
+
+
+def _loaders(model, schema: type, path=None) -> list:
+    relationships = inspect(model).relationships
+    options = []
+    for name, field in _schema_fields(schema).items():
+        if name not in relationships:
+            continue
+        rel = relationships[name]
+        attr = getattr(model, name)
+        if path is None:
+            # collections are fetched with one extra SELECT ... IN per
+            # relationship, scalar references are joined into the main query
+            loader = selectinload(attr) if rel.uselist else joinedload(attr)
+        else:
+            loader = path.selectinload(attr) if rel.uselist else path.joinedload(attr)
+        options.append(loader)
+        nested = _nested_schema(field.annotation)
+        if nested:
+            options.extend(_loaders(rel.mapper.class_, nested, loader))
+    return options
+
+
+@functools.cache
+def eager_load(model, schema: type) -> tuple:
+    """
+    Return the loader options needed to serialize `model` rows as `schema`
+    without any lazy loads. The relationships are taken from the schema's
+    fields, so adding a relationship field to a response schema is enough
+    for the list endpoints to start loading it up front.
+    """
+    return tuple(_loaders(model, schema))
+
+
+#####
+# Pagination
+#####
+
+STREAM_BATCH_SIZE = 500
+
+
+def _paginate(query, model, limit: int | None = None, after: int | None = None):
+    # keyset pagination on the primary key, so every page is an index range
+    # scan no matter how deep into the collection the cursor is
+    query = query.order_by(model.id)
+    if after is not None:
+        query = query.where(model.id > after)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def _stream(db: Session, query, batch_size: int = STREAM_BATCH_SIZE):
+    # yield_per fetches and builds the rows in batches on a server side
+    # cursor instead of materializing the whole result up front
+    return db.scalars(query.execution_options(yield_per=batch_size))
+
+
+#####
+# Projections
+#####
+
+
+@functools.cache
+def _projection(model, schema: type, fields: tuple | None = None) -> tuple:
+    # a query for the model's columns, with its scalar relationships outer
+    # joined in, and how to build each of the schema's fields: ("column",
+    # index), ("one", (index, columns)) or ("many", (relationship, columns)).
+    # `fields` narrows both to some of the schema's fields
+    only = fields
+    mapper = inspect(model)
+    columns = [model.id]
+    joins = []
+    fields = []
+    for name, field in _schema_fields(schema).items():
+        if only is not None and name not in only:
+            continue
+        if name in mapper.column_attrs:
+            fields.append((name, "column", len(columns)))
+            columns.append(getattr(model, name))
+            continue
+        nested = _nested_schema(field.annotation)
+        if name not in mapper.relationships or nested is None:
+            raise ValueError(f"Can't project {schema.__name__}.{name}")
+        rel = mapper.relationships[name]
+        nested_columns = tuple(_schema_fields(nested))
+        if rel.uselist:
+            fields.append((name, "many", (rel, nested_columns)))
+            continue
+        # the target's id tells a missing row apart from one of nulls
+        target = aliased(rel.mapper.class_)
+        joins.append(getattr(model, name).of_type(target))
+        fields.append((name, "one", (len(columns), nested_columns)))
+        columns += [target.id, *(getattr(target, c) for c in nested_columns)]
+    query = select(*columns)
+    for join in joins:
+        query = query.outerjoin(join)
+    return query, tuple(fields)
+
+
+def _project_many(db: Session, model, name: str, rel, columns: tuple, ids: list):
+    # one query per collection for the whole batch, like selectinload
+    target = aliased(rel.mapper.class_)
+    query = (
+        select(model.id, *(getattr(target, c) for c in columns))
+        .join(getattr(model, name).of_type(target))
+        .where(model.id.in_(ids))
+        .order_by(model.id, target.id)
+    )
+    values = defaultdict(list)
+    for parent_id, *row in db.execute(query):
+        values[parent_id].append(dict(zip(columns, row)))
+    return values
+
+
+def _project_batch(db: Session, model, fields: tuple, rows) -> list[dict]:
+    ids = [row[0] for row in rows]
+    related = {
+        name: _project_many(db, model, name, *arg, ids)
+        for name, kind, arg in fields
+        if kind == "many"
+    }
+    results = []
+    for row in rows:
+        result = {}
+        for name, kind, arg in fields:
+            if kind == "column":
+                result[name] = row[arg]
+            elif kind == "one":
+                index, columns = arg
+                values = row[index + 1 : index + 1 + len(columns)]
+                result[name] = (
+                    None if row[index] is None else dict(zip(columns, values))
+                )
+            else:
+                result[name] = related[name].get(row[0], [])
+        results.append(result)
+    return results
+
+
+def stream_projected(
+    db: Session,
+    model,
+    schema: type,
+    limit: int | None = None,
+    after: int | None = None,
+    where: tuple = (),
+    fields: tuple[str, ...] | None = None,
+    batch_size: int = STREAM_BATCH_SIZE,
+) -> Iterator[dict]:
+    """
+    Yield `model` rows as plain dicts shaped like `schema`, selecting only
+    the columns it has, so they can be encoded without building ORM objects
+    or validating them. Rows come off the cursor `batch_size` at a time, and
+    each collection in the schema is one query per batch. Passing `fields`
+    selects and loads just those of the schema's fields.
+    """
+    query, plan = _projection(model, schema, fields)
+    query = _paginate(query.where(*where), model, limit=limit, after=after)
+    result = db.execute(query.execution_options(yield_per=batch_size))
+    for rows in result.partitions():
+        yield from _project_batch(db, model, plan, rows)
+
+
+#####
+# Filters
+#####
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _prefix(column, prefix: str):
+    # the range is what the column's btree index answers, LIKE alone can't
+    # use it in sqlite (case insensitive) or postgres (unless C collated).
+    # The LIKE keeps it exact under collations that sort oddly
+    where = [column >= prefix, column.startswith(prefix, autoescape=True)]
+    # nothing sorts after the last code point, so there's no upper bound
+    if prefix[-1] != chr(sys.maxunicode):
+        where.append(column < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+    return and_(*where)
+
+
+def _since(db: Session, column, since: datetime):
+    # sqlite stores naive utc timestamps
+    if since.tzinfo is not None and db.get_bind().dialect.name != "postgresql":
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return column >= since
+
+
+def _search_users(db: Session, q: str):
+    """
+    Users with `q` anywhere in one of USER_SEARCH_COLUMNS, ignoring case,
+    through the index from models.create_user_search.
+    """
+    dialect = db.get_bind().dialect.name
+    # the trigram tokenizer matches a quoted string as a substring, but only
+    # one of at least three characters
+    if dialect == "sqlite" and len(q) >= 3:
+        phrase = '"' + q.replace('"', '""') + '"'
+        fts = select(literal_column("rowid")).select_from(text(USER_SEARCH_TABLE))
+        match = text(f"{USER_SEARCH_TABLE} MATCH :search").bindparams(search=phrase)
+        return User.id.in_(fts.where(match))
+    pattern = f"%{_escape_like(q)}%"
+    return or_(
+        *(getattr(User, c).ilike(pattern, escape="\\") for c in USER_SEARCH_COLUMNS)
+    )
+
+
+#####
+# Lookup cache
+#####
+
+cache = Cache(
+    MemoryCache(maxsize=settings.cache_size, ttl=settings.cache_ttl)
+    if settings.cache_size
+    else NullCache()
+)
+
+# keys of rows changed by the session's current transaction
+_PENDING_INVALIDATIONS = "cache_invalidations"
+
+
+def _row_key(model, id: int) -> str:
+    return f"{model.__tablename__}:{id}"
+
+
+def _cache_row(obj, generation: int) -> None:
+    # only the row's columns are cached, relationships still load lazily from
+    # whichever session the row ends up in
+    values = {c.key: getattr(obj, c.key) for c in inspect(type(obj)).column_attrs}
+    cache.set(_row_key(type(obj), obj.id), values, generation)
+
+
+def _from_cache(db: Session, model, values: dict):
+    existing = db.identity_map.get(db.identity_key(model, values["id"]))
+    if existing is not None:
+        return existing
+    obj = model(**values)
+    make_transient_to_detached(obj)
+    return db.merge(obj, load=False)
+
+
+def _bypass_cache(db: Session) -> bool:
+    # a session with uncommitted changes must see its own writes
+    return bool(db.info.get(_PENDING_INVALIDATIONS))
+
+
+def _get_cached(db: Session, model, id: int, query):
+    if _bypass_cache(db):
+        return db.scalar(query)
+    values = cache.get(_row_key(model, id))
+    if values is not None:
+        return _from_cache(db, model, values)
+    # read before the row, so a change committed while it loads isn't
+    # cached over, see Cache
+    generation = cache.generation
+    obj = db.scalar(query)
+    if obj is not None:
+        _cache_row(obj, generation)
+    return obj
+
+
+def _get_cached_by(db: Session, model, key: str, query, matches):
+    # natural keys only map to the primary key, so invalidating a row by id
+    # covers every way of looking it up
+    if _bypass_cache(db):
+        return db.scalar(query)
+    id = cache.get(key)
+    if id is not None:
+        values = cache.get(_row_key(model, id))
+        if values is not None and matches(values):
+            return _from_cache(db, model, values)
+    generation = cache.generation
+    obj = db.scalar(query)
+    if obj is not None:
+        cache.set(key, obj.id, generation)
+        _cache_row(obj, generation)
+    return obj
+
+
+def _invalidate(db: Session, model, *ids: int) -> None:
+    db.info.setdefault(_PENDING_INVALIDATIONS, set()).update(
+        _row_key(model, id) for id in ids
+    )
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _invalidate_pending(session: Session) -> None:
+    # invalidating once the transaction ends means the new row is what gets
+    # read next. A lookup that read the old row before the commit doesn't
+    # cache it after this, see Cache
+    keys = session.info.pop(_PENDING_INVALIDATIONS, None)
+    if keys:
+        cache.invalidate(*keys)
+
+
+#####
+# Versions
+#####
+
+
+def get_collection_version(db: Session, name: str) -> int:
+    return db.scalar(select(CollectionVersion.version).filter_by(name=name)) or 0
+
+
+def get_collection_versions(db: Session, *names: str) -> tuple[int, ...]:
+    query = select(CollectionVersion.name, CollectionVersion.version).where(
+        CollectionVersion.name.in_(names)
+    )
+    versions = dict(db.execute(query).all())
+    return tuple(versions.get(name, 0) for name in names)
+
+
+def _bump(db: Session, model, *ids: int) -> None:
+    # versions are what the api's etags are made of, so anything that changes
+    # a row's representation, memberships included, has to bump them
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return
+    # the UPDATE also sets updated_at. Objects already loaded, such as the one
+    # a route is about to return, get the new version and have updated_at
+    # expired, so the response doesn't show the old ones
+    db.execute(
+        update(model)
+        .where(model.id.in_(ids))
+        .values(version=model.version + 1)
+        .execution_options(synchronize_session="evaluate")
+    )
+    _invalidate(db, model, *ids)
+
+
+def _bump_collections(db: Session, *names: str) -> None:
+    db.execute(
+        update(CollectionVersion)
+        .where(CollectionVersion.name.in_(names))
+        .values(version=CollectionVersion.version + 1)
+    )
+
+
+def _changed(results: dict[int, schemas.MembershipStatus]) -> list[int]:
+    return [
+        user_id
+        for user_id, status in results.items()
+        if status in (schemas.MembershipStatus.ADDED, schemas.MembershipStatus.REMOVED)
+    ]
+
+
+#####
+# Change log
+#####
+
+
+def _log(
+    db: Session,
+    entity: schemas.ChangeEntity,
+    entity_id: int,
+    name: str,
+    action: schemas.ChangeAction,
+) -> None:
+    changes = [
+        {
+            "entity": entity.value,
+            "entity_id": entity_id,
+            "name": name,
+            "action": action.value,
+        }
+    ]
+    _write_changes(db, changes)
+
+
+def _log_members(
+    db: Session,
+    entity: schemas.ChangeEntity,
+    entity_id: int,
+    name: str,
+    action: schemas.ChangeAction,
+    member_ids: list[int],
+    role: schemas.MemberRole = schemas.MemberRole.USER,
+) -> None:
+    if not member_ids:
+        return
+    changes = [
+        {
+            "entity": entity.value,
+            "entity_id": entity_id,
+            "name": name,
+            "action": action.value,
+            "member_id": member_id,
+            "role": role.value,
+        }
+        for member_id in member_ids
+    ]
+    _write_changes(db, changes)
+
+
+# any constant will do, as long as nothing else takes the same advisory lock
+CHANGE_LOG_LOCK = 0x6368616E676573
+
+
+def _write_changes(db: Session, changes: list[dict]) -> None:
+    # seq is assigned when a row is inserted, not when it's committed, so a
+    # transaction that inserts first and commits last would show up behind a
+    # cursor that has already moved past it. Only one transaction at a time
+    # may have uncommitted changes: on postgres they queue on a lock held
+    # until commit, sqlite only has one writer anyway.
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(select(func.pg_advisory_xact_lock(CHANGE_LOG_LOCK)))
+    db.execute(insert(Change), changes)
+    _audit(db, changes)
+
+
+def _audit(db: Session, changes: list[dict]) -> None:
+    # the audit log has the member's role before and after, rather than the
+    # role added or removed
+    entries = []
+    for change in changes:
+        role = change.get("role")
+        action = schemas.ChangeAction(change["action"])
+        entries.append(
+            {
+                "entity": change["entity"],
+                "entity_id": change["entity_id"],
+                "name": change["name"],
+                "action": change["action"],
+                "member_id": change.get("member_id"),
+                "old_role": role if action == schemas.ChangeAction.REMOVE else None,
+                "new_role": role if action == schemas.ChangeAction.ADD else None,
+            }
+        )
+    audit.record(db, entries)
+
+
+def _changes_query(since: int = 0, limit: int | None = None):
+    query = select(Change).where(Change.seq > since).order_by(Change.seq)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def get_changes(db: Session, since: int = 0, limit: int | None = None):
+    return db.scalars(_changes_query(since=since, limit=limit)).fetchall()
+
+
+def stream_changes(db: Session, since: int = 0, limit: int | None = None):
+    return _stream(db, _changes_query(since=since, limit=limit))
+
+
+#####
+# Audit log
+#####
+
+
+def _audit_filters(db: Session, filters: schemas.AuditFilter | None) -> tuple:
+    if filters is None:
+        return ()
+    where = []
+    if filters.actor is not None:
+        where.append(AuditEntry.actor == filters.actor)
+    if filters.entity is not None:
+        where.append(AuditEntry.entity == filters.entity.value)
+    if filters.name is not None:
+        where.append(AuditEntry.name == filters.name)
+    if filters.user is not None:
+        user_id = select(User.id).filter_by(username=filters.user).scalar_subquery()
+        where.append(AuditEntry.member_id == user_id)
+    if filters.since is not None:
+        where.append(_since(db, AuditEntry.created_at, filters.since))
+    if filters.until is not None:
+        where.append(~_since(db, AuditEntry.created_at, filters.until))
+    return tuple(where)
+
+
+def get_audit_entries(
+    db: Session,
+    limit: int | None = None,
+    after: int | None = None,
+    filters: schemas.AuditFilter | None = None,
+) -> list[AuditEntry]:
+    query = select(AuditEntry).where(*_audit_filters(db, filters))
+    return db.scalars(_paginate(query, AuditEntry, limit=limit, after=after)).all()
+
+
+#####
+# Effective memberships
+#####
+
+
+def _record_memberships(
+    db: Session,
+    entity: schemas.ChangeEntity,
+    entity_id: int,
+    name: str,
+    role: schemas.MembershipRole,
+    action: schemas.ChangeAction,
+    user_ids: list[int],
+) -> None:
+    # called with the users whose membership actually changed, so adds never
+    # collide with an existing row
+    if not user_ids:
+        return
+    if action == schemas.ChangeAction.ADD:
+        db.execute(
+            insert(Membership),
+            [
+                {
+                    "user_id": user_id,
+                    "entity": entity.value,
+                    "entity_id": entity_id,
+                    "name": name,
+                    "role": role.value,
+                }
+                for user_id in user_ids
+            ],
+        )
+        return
+    db.execute(
+        delete(Membership).where(
+            Membership.entity == entity.value,
+            Membership.entity_id == entity_id,
+            Membership.role == role.value,
+            Membership.user_id.in_(user_ids),
+        )
+    )
+
+
+#####
+# Memberships
+#####
+
+
+def _memberships(
+    db: Session, table: Table, column: str, parent_id: int, user_ids: list[int]
+) -> dict[int, bool]:
+    # one query tells us both which of the ids are real users and which of
+    # those are already in the association table, keyed by user id
+    member = table.c.user_id
+    query = (
+        select(User.id, member)
+        .outerjoin(table, and_(member == User.id, table.c[column] == parent_id))
+        .where(User.id.in_(user_ids))
+    )
+    return {user_id: member_id is not None for user_id, member_id in db.execute(query)}
+
+
+def _add_members(
+    db: Session,
+    table: Table,
+    column: str,
+    parent_id: int,
+    user_ids: list[int],
+    skip: frozenset[int] = frozenset(),
+) -> dict[int, schemas.MembershipStatus]:
+    user_ids = list(dict.fromkeys(user_ids))
+    memberships = _memberships(db, table, column, parent_id, user_ids)
+    results = {}
+    added = []
+    for user_id in user_ids:
+        if user_id not in memberships:
+            results[user_id] = schemas.MembershipStatus.NOT_FOUND
+        elif memberships[user_id] or user_id in skip:
+            results[user_id] = schemas.MembershipStatus.UNCHANGED
+        else:
+            results[user_id] = schemas.MembershipStatus.ADDED
+            added.append(user_id)
+    if added:
+        db.execute(
+            insert(table).from_select(
+                ["user_id", column],
+                select(User.id, literal(parent_id)).where(User.id.in_(added)),
+            )
+        )
+    return results
+
+
+def _expire_members(
+    db: Session, parent, attribute: str, backref: str, user_ids: list[int]
+) -> None:
+    # the set based writes go around the orm, so collections it has already
+    # loaded on either side are reloaded the next time they're used
+    db.expire(parent, [attribute])
+    for user_id in user_ids:
+        user = db.identity_map.get(db.identity_key(User, user_id))
+        if user is not None:
+            db.expire(user, [backref])
+
+
+def _remove_members(
+    db: Session, table: Table, column: str, parent_id: int, user_ids: list[int]
+) -> dict[int, schemas.MembershipStatus]:
+    user_ids = list(dict.fromkeys(user_ids))
+    memberships = _memberships(db, table, column, parent_id, user_ids)
+    results = {}
+    removed = []
+    for user_id in user_ids:
+        if user_id not in memberships:
+            results[user_id] = schemas.MembershipStatus.NOT_FOUND
+        elif not memberships[user_id]:
+            results[user_id] = schemas.MembershipStatus.UNCHANGED
+        else:
+            results[user_id] = schemas.MembershipStatus.REMOVED
+            removed.append(user_id)
+    if removed:
+        db.execute(
+            delete(table).where(
+                table.c[column] == parent_id, table.c.user_id.in_(removed)
+            )
+        )
+    return results
 
 
 #####
@@ -11,9 +691,10 @@ from ..api import schemas
 
 
 class UserNotFoundError(Exception):
-    def __init__(self, msg: str = ""):
+    def __init__(self, msg: str = "", user_ids: list[int] | None = None):
         if not msg:
             msg = "User not found"
+        self.user_ids = user_ids or []
         super().__init__(msg)
 
 
@@ -24,16 +705,135 @@ class UserAlreadyExistsError(Exception):
         super().__init__(msg)
 
 
-def get_users(db: Session):
-    return db.scalars(select(User)).fetchall()
+def _user_filters(db: Session, filters: schemas.UserFilter | None) -> tuple:
+    if filters is None:
+        return ()
+    where = []
+    if filters.is_pi is not None:
+        where.append(User.is_pi == filters.is_pi)
+    if filters.sponsor_id is not None:
+        where.append(User.sponsor_id == filters.sponsor_id)
+    if filters.pirg is not None:
+        member = pirg_user_association_table.c
+        pirg_id = select(Pirg.id).filter_by(name=filters.pirg).scalar_subquery()
+        where.append(
+            User.id.in_(select(member.user_id).where(member.pirg_id == pirg_id))
+        )
+    if filters.group is not None:
+        member = group_user_association_table.c
+        group_id = select(Group.id).filter_by(name=filters.group).scalar_subquery()
+        where.append(
+            User.id.in_(select(member.user_id).where(member.group_id == group_id))
+        )
+    if filters.username:
+        where.append(_prefix(User.username, filters.username))
+    if filters.updated_since is not None:
+        where.append(_since(db, User.updated_at, filters.updated_since))
+    if filters.q:
+        where.append(_search_users(db, filters.q))
+    return tuple(where)
+
+
+def _users_query(limit: int | None = None, after: int | None = None, where: tuple = ()):
+    query = select(User).options(*eager_load(User, schemas.User)).where(*where)
+    return _paginate(query, User, limit=limit, after=after)
+
+
+def get_users(
+    db: Session,
+    limit: int | None = None,
+    after: int | None = None,
+    filters: schemas.UserFilter | None = None,
+):
+    query = _users_query(limit, after, _user_filters(db, filters))
+    return db.scalars(query).fetchall()
+
+
+def stream_users(
+    db: Session,
+    limit: int | None = None,
+    after: int | None = None,
+    filters: schemas.UserFilter | None = None,
+):
+    return _stream(db, _users_query(limit, after, _user_filters(db, filters)))
+
+
+def stream_user_rows(
+    db: Session,
+    limit: int | None = None,
+    after: int | None = None,
+    fields: tuple[str, ...] | None = None,
+    filters: schemas.UserFilter | None = None,
+) -> Iterator[dict]:
+    return stream_projected(
+        db,
+        User,
+        schemas.User,
+        limit=limit,
+        after=after,
+        where=_user_filters(db, filters),
+        fields=fields,
+    )
 
 
 def get_user(db: Session, id: int) -> User:
-    return db.scalar(select(User).filter_by(id=id))
+    return _get_cached(db, User, id, select(User).filter_by(id=id))
 
 
 def get_user_by_username(db: Session, username: str) -> User:
-    return db.scalar(select(User).filter_by(username=username))
+    return _get_cached_by(
+        db,
+        User,
+        f"users:username:{username}",
+        select(User).filter_by(username=username),
+        lambda values: values["username"] == username,
+    )
+
+
+def resolve_users(db: Session, user_ids: list[int]) -> tuple[list[User], list[int]]:
+    """
+    Look up every id in `user_ids` with a single query. Returns the users
+    that were found, in the order their ids were given, and the ids that
+    don't exist.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return [], []
+    found = {u.id: u for u in db.scalars(select(User).where(User.id.in_(user_ids)))}
+    users = [found[user_id] for user_id in user_ids if user_id in found]
+    missing = [user_id for user_id in user_ids if user_id not in found]
+    return users, missing
+
+
+def sponsor_tree_query(username: str, depth: int, up: bool = False):
+    """
+    One recursive query for the users `username` sponsors, directly or
+    through others, to `depth` levels, or with `up` for the chain of users
+    sponsoring them. Each row is (id, username, sponsor_id, depth), the user
+    asked about being depth 0. Walking down is a lookup on the sponsor_id
+    index per level. The depth bound also stops a cycle in the data from
+    recursing forever.
+    """
+    tree = (
+        select(User.id, User.username, User.sponsor_id, literal(0).label("depth"))
+        .where(User.username == username)
+        .cte("sponsor_tree", recursive=True)
+    )
+    other = aliased(User)
+    link = other.id == tree.c.sponsor_id if up else other.sponsor_id == tree.c.id
+    tree = tree.union_all(
+        select(other.id, other.username, other.sponsor_id, tree.c.depth + 1).where(
+            link, tree.c.depth < depth
+        )
+    )
+    return select(tree).order_by(tree.c.depth, tree.c.id)
+
+
+def _require_users(db: Session, user_ids: list[int]) -> dict[int, User]:
+    users, missing = resolve_users(db, user_ids)
+    if missing:
+        raise UserNotFoundError(f"User ids {missing} not found", user_ids=missing)
+    return {u.id: u for u in users}
 
 
 def create_user(db: Session, user: schemas.UserCreate) -> User:
@@ -45,16 +845,146 @@ def create_user(db: Session, user: schemas.UserCreate) -> User:
         sponsor_id=user.sponsor_id,
         is_pi=user.is_pi,
     )
-    db.add(db_user)
     try:
-        db.commit()
-    except:
-        db.rollback()
+        # a savepoint, so a duplicate only undoes this and not the rest of
+        # the caller's transaction
+        with db.begin_nested():
+            db.add(db_user)
+    except IntegrityError:
         raise UserAlreadyExistsError(f"User {user.username} already exists")
-    db.refresh(db_user)
+    _bump_collections(db, "users")
+    _log(
+        db,
+        schemas.ChangeEntity.USER,
+        db_user.id,
+        db_user.username,
+        schemas.ChangeAction.CREATE,
+    )
     return db_user
 
 
+# the columns an import sets, compared to tell an update from a no-op
+_IMPORT_COLUMNS = ("firstname", "lastname", "email", "sponsor_id", "is_pi")
+
+
+def import_users(
+    db: Session, rows: list[tuple[int, schemas.UserImport]], upsert: bool = False
+) -> dict[int, schemas.UserImportResult]:
+    """
+    Create, or with `upsert` update, a batch of users from (line, user) rows
+    in a handful of statements, returning a result for each line.
+
+    Sponsors can be given by username, and those created in the same batch
+    are inserted first, so a sponsor only has to exist or come earlier in the
+    batch. Each username and email may appear once per batch.
+    """
+    Import = schemas.UserImportStatus
+    Action = schemas.ChangeAction
+    results = {}
+    sponsor_names = {u.sponsor for _, u in rows if u.sponsor is not None}
+    sponsor_ids = {u.sponsor_id for _, u in rows if u.sponsor_id is not None}
+    existing = db.execute(
+        select(
+            User.id, User.username, *(getattr(User, c) for c in _IMPORT_COLUMNS)
+        ).where(
+            or_(
+                User.username.in_({u.username for _, u in rows} | sponsor_names),
+                User.email.in_({u.email for _, u in rows}),
+                User.id.in_(sponsor_ids),
+            )
+        )
+    ).all()
+    by_username = {row.username: row for row in existing}
+    by_email = {row.email: row for row in existing}
+    ids = {row.username: row.id for row in existing}
+    known_ids = set(ids.values())
+
+    def result(line: int, user, status, id=None, detail=None):
+        results[line] = schemas.UserImportResult(
+            line=line, username=user.username, status=status, id=id, detail=detail
+        )
+
+    pending = []
+    for line, user in rows:
+        current = by_username.get(user.username)
+        owner = by_email.get(user.email)
+        if owner is not None and (current is None or owner.id != current.id):
+            detail = f"Email {user.email} belongs to {owner.username}"
+            result(line, user, Import.CONFLICT, detail=detail)
+        elif current is not None and not upsert:
+            result(line, user, Import.EXISTS, id=current.id)
+        else:
+            pending.append((line, user, current))
+
+    # (id, username, action) of each user written, for the change log
+    written = []
+    # each round writes the rows whose sponsor exists by now, which makes the
+    # users they sponsor ready for the next
+    while pending:
+        ready = []
+        waiting = []
+        for line, user, current in pending:
+            if user.sponsor is not None:
+                sponsor_id = ids.get(user.sponsor)
+                found = sponsor_id is not None
+            else:
+                sponsor_id = user.sponsor_id
+                found = sponsor_id is None or sponsor_id in known_ids
+            values = user.model_dump(include=set(_IMPORT_COLUMNS))
+            values["sponsor_id"] = sponsor_id
+            target = ready if found else waiting
+            target.append((line, user, current, values))
+        if not ready:
+            break
+        inserts = [
+            (line, user, values) for line, user, current, values in ready if not current
+        ]
+        if inserts:
+            returned = db.execute(
+                insert(User).returning(User.id, User.username),
+                [{"username": user.username, **values} for _, user, values in inserts],
+            )
+            ids.update({username: id for id, username in returned})
+            known_ids.update(ids.values())
+            for line, user, _ in inserts:
+                written.append((ids[user.username], user.username, Action.CREATE))
+                result(line, user, Import.CREATED, id=ids[user.username])
+        changes = []
+        for line, user, current, values in ready:
+            if not current:
+                continue
+            if all(getattr(current, c) == values[c] for c in _IMPORT_COLUMNS):
+                result(line, user, Import.UNCHANGED, id=current.id)
+                continue
+            changes.append({"id": current.id, **values})
+            written.append((current.id, user.username, Action.UPDATE))
+            result(line, user, Import.UPDATED, id=current.id)
+        if changes:
+            db.execute(update(User), changes)
+        pending = [(line, user, current) for line, user, current, _ in waiting]
+
+    for line, user, _ in pending:
+        sponsor = user.sponsor if user.sponsor is not None else user.sponsor_id
+        result(
+            line, user, Import.SPONSOR_NOT_FOUND, detail=f"Sponsor {sponsor} not found"
+        )
+
+    _bump(db, User, *(id for id, _, action in written if action == Action.UPDATE))
+    if written:
+        _bump_collections(db, "users")
+        changes = [
+            {
+                "entity": schemas.ChangeEntity.USER.value,
+                "entity_id": id,
+                "name": username,
+                "action": action.value,
+            }
+            for id, username, action in written
+        ]
+        _write_changes(db, changes)
+    return results
+
+
 #####
 # Pirgs
 #####
@@ -67,68 +997,170 @@ class PirgAlreadyExistsError(Exception):
         super().__init__(msg)
 
 
-def get_pirgs(db: Session):
-    return db.scalars(select(Pirg)).fetchall()
+def _pirg_filters(db: Session, filters: schemas.PirgFilter | None) -> tuple:
+    if filters is None:
+        return ()
+    where = []
+    if filters.name:
+        where.append(_prefix(Pirg.name, filters.name))
+    if filters.owner_id is not None:
+        where.append(Pirg.owner_id == filters.owner_id)
+    if filters.user is not None:
+        member = pirg_user_association_table.c
+        user_id = select(User.id).filter_by(username=filters.user).scalar_subquery()
+        where.append(
+            Pirg.id.in_(select(member.pirg_id).where(member.user_id == user_id))
+        )
+    if filters.updated_since is not None:
+        where.append(_since(db, Pirg.updated_at, filters.updated_since))
+    return tuple(where)
+
+
+def _pirgs_query(limit: int | None = None, after: int | None = None, where: tuple = ()):
+    query = select(Pirg).options(*eager_load(Pirg, schemas.Pirg)).where(*where)
+    return _paginate(query, Pirg, limit=limit, after=after)
+
+
+def get_pirgs(
+    db: Session,
+    limit: int | None = None,
+    after: int | None = None,
+    filters: schemas.PirgFilter | None = None,
+):
+    query = _pirgs_query(limit, after, _pirg_filters(db, filters))
+    return db.scalars(query).fetchall()
+
+
+def stream_pirgs(
+    db: Session,
+    limit: int | None = None,
+    after: int | None = None,
+    filters: schemas.PirgFilter | None = None,
+):
+    return _stream(db, _pirgs_query(limit, after, _pirg_filters(db, filters)))
+
+
+def stream_pirg_rows(
+    db: Session,
+    limit: int | None = None,
+    after: int | None = None,
+    fields: tuple[str, ...] | None = None,
+    filters: schemas.PirgFilter | None = None,
+) -> Iterator[dict]:
+    return stream_projected(
+        db,
+        Pirg,
+        schemas.Pirg,
+        limit=limit,
+        after=after,
+        where=_pirg_filters(db, filters),
+        fields=fields,
+    )
 
 
 def get_pirg(db: Session, pirg_id: int) -> Pirg:
-    return db.scalar(select(Pirg).filter_by(id=pirg_id))
+    return _get_cached(db, Pirg, pirg_id, select(Pirg).filter_by(id=pirg_id))
 
 
 def get_pirg_by_name(db: Session, name: str) -> Pirg:
-    return db.scalar(select(Pirg).filter_by(name=name))
+    return _get_cached_by(
+        db,
+        Pirg,
+        f"pirgs:name:{name}",
+        select(Pirg).filter_by(name=name),
+        lambda values: values["name"] == name,
+    )
 
 
 def create_pirg(db: Session, pirg: schemas.PirgCreate) -> Pirg:
-    # user objects should have been checked by the pirgs endpoint prior to
-    # being enumerated here, so they should always be valid users
+    # the owner, users and admins are all resolved in one query, raising
+    # UserNotFoundError before anything is written if any of them are missing
     #
     # we skip adding users or admins if they are the owner of the pirg
-    users = []
-    if pirg.user_ids:
-        users = [
-            db.scalar(select(User).filter_by(id=user_id))
-            for user_id in pirg.user_ids
-            if user_id != pirg.owner_id
-        ]
-    admins = []
-    if pirg.admin_ids:
-        admins = [
-            db.scalar(select(User).filter_by(id=user_id))
-            for user_id in pirg.admin_ids
-            if user_id != pirg.owner_id
-        ]
-    db_pirg = Pirg(
-        name=pirg.name,
-        owner_id=pirg.owner_id,
-        admins=admins,
-        users=users,
-    )
-    db.add(db_pirg)
+    user_ids = list(dict.fromkeys(pirg.user_ids or []))
+    admin_ids = list(dict.fromkeys(pirg.admin_ids or []))
+    found = _require_users(db, [pirg.owner_id, *user_ids, *admin_ids])
+    users = [found[user_id] for user_id in user_ids if user_id != pirg.owner_id]
+    admins = [found[user_id] for user_id in admin_ids if user_id != pirg.owner_id]
+    db_pirg = Pirg(name=pirg.name, owner_id=pirg.owner_id)
     try:
-        db.commit()
-    except:
-        db.rollback()
+        with db.begin_nested():
+            # added before it's put in the members' collections, or the
+            # backrefs would find it outside the session
+            db.add(db_pirg)
+            db_pirg.admins.extend(admins)
+            db_pirg.users.extend(users)
+    except IntegrityError:
         raise PirgAlreadyExistsError(f"Pirg {pirg.name} already exists")
-    db.refresh(db_pirg)
+    # members see the new pirg in their own listing
+    _bump(db, User, *(u.id for u in users))
+    _bump_collections(db, "pirgs", "users")
+    entity = (schemas.ChangeEntity.PIRG, db_pirg.id, db_pirg.name)
+    _log(db, *entity, schemas.ChangeAction.CREATE)
+    _log_members(db, *entity, schemas.ChangeAction.ADD, [u.id for u in users])
+    _log_members(
+        db,
+        *entity,
+        schemas.ChangeAction.ADD,
+        [u.id for u in admins],
+        role=schemas.MemberRole.ADMIN,
+    )
+    for role, members in [
+        (schemas.MembershipRole.OWNER, [pirg.owner_id]),
+        (schemas.MembershipRole.ADMIN, [u.id for u in admins]),
+        (schemas.MembershipRole.USER, [u.id for u in users]),
+    ]:
+        _record_memberships(db, *entity, role, schemas.ChangeAction.ADD, members)
     return db_pirg
 
 
+def _touch_pirg_members(
+    db: Session, pirg: Pirg, action: schemas.ChangeAction, user_ids: list[int]
+) -> None:
+    if not user_ids:
+        return
+    _bump(db, Pirg, pirg.id)
+    _bump(db, User, *user_ids)
+    _bump_collections(db, "pirgs", "users")
+    entity = (schemas.ChangeEntity.PIRG, pirg.id, pirg.name)
+    _log_members(db, *entity, action, user_ids)
+    _record_memberships(db, *entity, schemas.MembershipRole.USER, action, user_ids)
+    _expire_members(db, pirg, "users", "pirgs", user_ids)
+
+
+def add_users_to_pirg(
+    db: Session, pirg: Pirg, user_ids: list[int]
+) -> dict[int, schemas.MembershipStatus]:
+    # the owner is never added as a user of their own pirg
+    results = _add_members(
+        db,
+        pirg_user_association_table,
+        "pirg_id",
+        pirg.id,
+        user_ids,
+        skip=frozenset({pirg.owner_id}),
+    )
+    _touch_pirg_members(db, pirg, schemas.ChangeAction.ADD, _changed(results))
+    return results
+
+
+def remove_users_from_pirg(
+    db: Session, pirg: Pirg, user_ids: list[int]
+) -> dict[int, schemas.MembershipStatus]:
+    results = _remove_members(
+        db, pirg_user_association_table, "pirg_id", pirg.id, user_ids
+    )
+    _touch_pirg_members(db, pirg, schemas.ChangeAction.REMOVE, _changed(results))
+    return results
+
+
 def add_user_to_pirg(db: Session, pirg: Pirg, user: User) -> Pirg:
-    if user.id == pirg.owner_id:
-        return pirg
-    pirg.users.append(user)
-    db.add(pirg)
-    db.commit()
-    db.refresh(pirg)
+    add_users_to_pirg(db, pirg=pirg, user_ids=[user.id])
     return pirg
 
 
 def remove_user_from_pirg(db: Session, pirg: Pirg, user: User) -> Pirg:
-    pirg.users = [pu for pu in pirg.users if pu.id != user.id]
-    db.add(pirg)
-    db.commit()
-    db.refresh(pirg)
+    remove_users_from_pirg(db, pirg=pirg, user_ids=[user.id])
     return pirg
 
 
@@ -151,55 +1183,227 @@ class GroupAlreadyExistsError(Exception):
         super().__init__(msg)
 
 
-def get_pirg_groups(db: Session):
-    return db.scalars(select(Group)).fetchall()
+def _group_filters(
+    db: Session, pirg: Pirg | None, filters: schemas.GroupFilter | None
+) -> tuple:
+    where = [Group.pirg_id == pirg.id] if pirg else []
+    if filters is None:
+        return tuple(where)
+    if filters.name:
+        where.append(_prefix(Group.name, filters.name))
+    if filters.pirg is not None:
+        pirg_id = select(Pirg.id).filter_by(name=filters.pirg).scalar_subquery()
+        where.append(Group.pirg_id == pirg_id)
+    if filters.user is not None:
+        member = group_user_association_table.c
+        user_id = select(User.id).filter_by(username=filters.user).scalar_subquery()
+        where.append(
+            Group.id.in_(select(member.group_id).where(member.user_id == user_id))
+        )
+    if filters.updated_since is not None:
+        where.append(_since(db, Group.updated_at, filters.updated_since))
+    return tuple(where)
+
+
+def _pirg_groups_query(
+    limit: int | None = None, after: int | None = None, where: tuple = ()
+):
+    query = select(Group).options(*eager_load(Group, schemas.Group)).where(*where)
+    return _paginate(query, Group, limit=limit, after=after)
+
+
+def get_pirg_groups(
+    db: Session,
+    pirg: Pirg | None = None,
+    limit: int | None = None,
+    after: int | None = None,
+    filters: schemas.GroupFilter | None = None,
+):
+    query = _pirg_groups_query(limit, after, _group_filters(db, pirg, filters))
+    return db.scalars(query).fetchall()
+
+
+def stream_pirg_groups(
+    db: Session,
+    pirg: Pirg | None = None,
+    limit: int | None = None,
+    after: int | None = None,
+    filters: schemas.GroupFilter | None = None,
+):
+    where = _group_filters(db, pirg, filters)
+    return _stream(db, _pirg_groups_query(limit, after, where))
+
+
+def stream_pirg_group_rows(
+    db: Session,
+    pirg: Pirg | None = None,
+    limit: int | None = None,
+    after: int | None = None,
+    fields: tuple[str, ...] | None = None,
+    filters: schemas.GroupFilter | None = None,
+) -> Iterator[dict]:
+    return stream_projected(
+        db,
+        Group,
+        schemas.Group,
+        limit=limit,
+        after=after,
+        where=_group_filters(db, pirg, filters),
+        fields=fields,
+    )
 
 
 def get_pirg_group(db: Session, group_id: int) -> Group:
-    return db.scalar(select(Group).filter_by(id=group_id))
+    return _get_cached(db, Group, group_id, select(Group).filter_by(id=group_id))
 
 
 def get_pirg_group_by_name(db: Session, pirg: Pirg, name: str) -> Group:
-    return db.scalar(select(Group).filter_by(name=name, pirg_id=pirg.id))
+    return _get_cached_by(
+        db,
+        Group,
+        f"groups:name:{pirg.id}:{name}",
+        select(Group).filter_by(name=name, pirg_id=pirg.id),
+        lambda values: values["name"] == name and values["pirg_id"] == pirg.id,
+    )
 
 
 def create_pirg_group(db: Session, group: schemas.GroupCreate) -> Group:
-    users = []
-    for user_id in group.user_ids:
-        db_user = db.scalar(select(User).filter_by(id=user_id))
-        if not db_user:
-            raise UserNotFoundError(f"User id {user_id} not found")
-        users.append(db_user)
-    db_group = Group(name=group.name, pirg_id=group.pirg_id, users=users)
-    db.add(db_group)
+    users = list(_require_users(db, group.user_ids).values())
+    db_group = Group(name=group.name, pirg_id=group.pirg_id)
     try:
-        db.commit()
-    except:
-        db.rollback()
+        with db.begin_nested():
+            # before the members, as in create_pirg
+            db.add(db_group)
+            db_group.users.extend(users)
+    except IntegrityError:
         raise GroupAlreadyExistsError(f"Pirg Group {group.name} already exists")
-    db.refresh(db_group)
+    _bump(db, Pirg, group.pirg_id)
+    _bump(db, User, *(u.id for u in users))
+    _bump_collections(db, "groups", "pirgs", "users")
+    entity = (schemas.ChangeEntity.GROUP, db_group.id, db_group.name)
+    _log(db, *entity, schemas.ChangeAction.CREATE)
+    _log_members(db, *entity, schemas.ChangeAction.ADD, [u.id for u in users])
+    _record_memberships(
+        db,
+        *entity,
+        schemas.MembershipRole.MEMBER,
+        schemas.ChangeAction.ADD,
+        [u.id for u in users],
+    )
     return db_group
 
 
+def _touch_group_members(
+    db: Session, group: Group, action: schemas.ChangeAction, user_ids: list[int]
+) -> None:
+    if not user_ids:
+        return
+    _bump(db, Group, group.id)
+    _bump(db, User, *user_ids)
+    _bump_collections(db, "groups", "users")
+    entity = (schemas.ChangeEntity.GROUP, group.id, group.name)
+    _log_members(db, *entity, action, user_ids)
+    _record_memberships(db, *entity, schemas.MembershipRole.MEMBER, action, user_ids)
+    _expire_members(db, group, "users", "groups", user_ids)
+
+
+def add_users_to_pirg_group(
+    db: Session, group: Group, user_ids: list[int]
+) -> dict[int, schemas.MembershipStatus]:
+    results = _add_members(
+        db, group_user_association_table, "group_id", group.id, user_ids
+    )
+    _touch_group_members(db, group, schemas.ChangeAction.ADD, _changed(results))
+    return results
+
+
+def remove_users_from_pirg_group(
+    db: Session, group: Group, user_ids: list[int]
+) -> dict[int, schemas.MembershipStatus]:
+    results = _remove_members(
+        db, group_user_association_table, "group_id", group.id, user_ids
+    )
+    _touch_group_members(db, group, schemas.ChangeAction.REMOVE, _changed(results))
+    return results
+
+
 def add_user_to_pirg_group(db: Session, group: Group, user: User) -> Group:
-    if user in group.users:
-        return group
-    group.users.append(user)
-    db.add(group)
-    db.commit()
-    db.refresh(group)
+    add_users_to_pirg_group(db, group=group, user_ids=[user.id])
     return group
 
 
 def remove_user_from_pirg_group(db: Session, group: Group, user: User) -> Group:
-    group.users = [gu for gu in group.users if gu.id != user.id]
-    db.add(group)
-    db.commit()
-    db.refresh(group)
+    remove_users_from_pirg_group(db, group=group, user_ids=[user.id])
     return group
 
 
 def delete_pirg_group(db: Session, group: Group) -> None:
+    member = group_user_association_table.c
+    user_ids = db.scalars(
+        select(member.user_id).where(member.group_id == group.id)
+    ).all()
+    _bump(db, Pirg, group.pirg_id)
+    _bump(db, User, *user_ids)
+    _bump_collections(db, "groups", "pirgs", "users")
+    entity = (schemas.ChangeEntity.GROUP, group.id, group.name)
+    _log_members(db, *entity, schemas.ChangeAction.REMOVE, user_ids)
+    _log(db, *entity, schemas.ChangeAction.DELETE)
+    _record_memberships(
+        db,
+        *entity,
+        schemas.MembershipRole.MEMBER,
+        schemas.ChangeAction.REMOVE,
+        user_ids,
+    )
+    _invalidate(db, Group, group.id)
     db.delete(group)
-    db.commit()
+    db.flush()
     return None
+
+
+#####
+# Unix groups
+#####
+
+
+def _string_agg(db: Session, column):
+    if db.get_bind().dialect.name == "postgresql":
+        return func.string_agg(column, literal(","))
+    return func.group_concat(column, ",")
+
+
+def get_unix_groups(db: Session) -> list[tuple[str, int, str, list[str]]]:
+    """
+    Every pirg and then every group with its members' usernames, as
+    (kind, id, name, members) tuples, aggregated in a single query straight
+    from the association tables. A pirg's members are its owner, admins and
+    users.
+    """
+    pirg_members = union(
+        select(Pirg.id.label("pirg_id"), Pirg.owner_id.label("user_id")),
+        select(
+            pirg_user_association_table.c.pirg_id,
+            pirg_user_association_table.c.user_id,
+        ),
+        select(
+            pirg_admin_association_table.c.pirg_id,
+            pirg_admin_association_table.c.user_id,
+        ),
+    ).subquery()
+    member = group_user_association_table.c
+    query = union_all(
+        select(literal("pirg"), Pirg.id, Pirg.name, _string_agg(db, User.username))
+        .join(pirg_members, pirg_members.c.pirg_id == Pirg.id)
+        .join(User, User.id == pirg_members.c.user_id)
+        .group_by(Pirg.id, Pirg.name),
+        select(literal("group"), Group.id, Group.name, _string_agg(db, User.username))
+        .outerjoin(group_user_association_table, member.group_id == Group.id)
+        .outerjoin(User, User.id == member.user_id)
+        .group_by(Group.id, Group.name),
+    )
+    unix_groups = [
+        (kind, id, name, sorted(members.split(",")) if members else [])
+        for kind, id, name, members in db.execute(query)
+    ]
+    unix_groups.sort(key=lambda g: (g[0] != "pirg", g[1]))
+    return unix_groups
@@ -1,13 +1,107 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+import re
 
-SQLALCHEMY_DATABASE_URL = "sqlite://"
+from fastapi import Depends
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
+from sqlalchemy.pool import StaticPool
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    echo=True,
-)
+from ..config import Settings, settings
+
+
+def _is_memory_sqlite(url) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers carry on while a writer commits, and with WAL
+    # synchronous=NORMAL only fsyncs at checkpoints instead of every commit
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+# statements that leave the database as it is
+_READS = re.compile(r"\s*(SELECT|WITH|PRAGMA|EXPLAIN)\b", re.IGNORECASE)
+
+# the connection execution option that begins a write transaction, see
+# begin_write
+_IMMEDIATE = "hpcadmin_begin_immediate"
+
+
+def _sqlite_transactions(engine: Engine) -> None:
+    # pysqlite only starts a transaction in front of the first write, so a
+    # SAVEPOINT issued before that starts one of its own and releasing it
+    # commits everything. Turn its handling off and begin them ourselves.
+    #
+    # A transaction that has read holds a snapshot, and once someone else
+    # commits it can't be upgraded to a write: its first write fails with
+    # "database is locked" straight away, without waiting out the busy
+    # timeout. So writers take the write lock up front with BEGIN IMMEDIATE,
+    # and other transactions only begin in front of their first write or
+    # SAVEPOINT, so their reads never pin a snapshot that can go stale.
+    @event.listens_for(engine, "connect")
+    def _autocommit(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def _begin(connection):
+        if connection.get_execution_options().get(_IMMEDIATE):
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _begin_before_write(conn, cursor, statement, parameters, context, many):
+        if (
+            conn.in_transaction()
+            and not cursor.connection.in_transaction
+            and not _READS.match(statement)
+        ):
+            cursor.execute("BEGIN IMMEDIATE")
+
+
+def create_db_engine(settings: Settings) -> Engine:
+    url = make_url(settings.database_url)
+    if _is_memory_sqlite(url):
+        # a single shared connection, otherwise every pooled connection
+        # would get its own empty in-memory database
+        engine = create_engine(
+            url,
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+            echo=settings.echo,
+        )
+        _sqlite_transactions(engine)
+        return engine
+    connect_args = {}
+    if url.get_backend_name() == "sqlite":
+        connect_args["check_same_thread"] = False
+    engine = create_engine(
+        url,
+        connect_args=connect_args,
+        pool_size=settings.pool_size,
+        max_overflow=settings.max_overflow,
+        pool_timeout=settings.pool_timeout,
+        pool_pre_ping=settings.pool_pre_ping,
+        pool_recycle=settings.pool_recycle,
+        echo=settings.echo,
+    )
+    if url.get_backend_name() == "sqlite":
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+        _sqlite_transactions(engine)
+    return engine
+
+
+def check_connection(engine: Engine) -> None:
+    """
+    Check out a connection and run a trivial query, so a bad url or an
+    unreachable database fails at startup rather than on the first request.
+    """
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+
+
+engine = create_db_engine(settings)
 SessionLocal = sessionmaker(autoflush=False, autocommit=False, bind=engine)
 
 Base = declarative_base()
@@ -19,3 +113,38 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+def begin_write(db: Session) -> None:
+    """
+    Begin `db`'s transaction holding sqlite's write lock, so it waits its
+    turn behind other writers instead of failing when one of them commits
+    between its reads and its writes. Call it before `db` runs anything.
+    Other databases take their locks as rows are written.
+    """
+    db.connection(execution_options={_IMMEDIATE: True})
+
+
+def get_uow(db: Session = Depends(get_db)):
+    """
+    Wraps a request in one transaction, for routes that write. crud only
+    flushes, so everything the route does is committed here together, or
+    rolled back if it raises.
+
+    Use it as `Depends(get_uow, scope="function")`, so the commit happens
+    before the response goes out and a failed commit is reported as an
+    error rather than after a 200. Scripts get the same from
+    `with SessionLocal.begin() as db:` and `begin_write(db)`.
+    """
+    begin_write(db)
+    # with scope="function" this exits once the response is serialized, so
+    # that runs inside the transaction, before the commit. crud expires
+    # whatever its set based writes leave stale, so it's read back then.
+    # Nothing reads the session after the commit, so it needn't expire it all
+    db.expire_on_commit = False
+    try:
+        yield db
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
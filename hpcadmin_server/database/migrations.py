@@ -0,0 +1,338 @@
+"""
+Versioned schema migrations.
+
+The database records the last revision applied in `schema_version`, and
+`upgrade` applies every revision after it in order. Startup only compares
+that number against `HEAD`, so workers never run DDL or reflect the schema;
+migrating is a separate step:
+
+    python -m hpcadmin_server.database.migrations upgrade
+
+Each revision is written so it's a no-op when its change is already there,
+since a database created from the current models already has everything the
+earlier revisions add. Revisions that need to touch existing rows do it in a
+`backfill`, which runs in short transactions of `batch_size` rows each so a
+large table is never write locked for long.
+"""
+
+import argparse
+from dataclasses import dataclass
+from typing import Callable
+
+from sqlalchemy import (
+    Column,
+    Connection,
+    Engine,
+    Integer,
+    MetaData,
+    Table,
+    delete,
+    func,
+    insert,
+    inspect,
+    literal,
+    select,
+    text,
+    update,
+)
+
+from . import models
+from .models import MEMBERSHIP_TABLES
+
+BATCH_SIZE = 1000
+
+# kept out of the models' metadata, it describes the schema rather than being
+# part of it
+schema_version_table = Table(
+    "schema_version",
+    MetaData(),
+    Column("version", Integer, nullable=False),
+)
+
+
+class SchemaOutOfDateError(Exception):
+    def __init__(self, current: int, head: int):
+        self.current = current
+        self.head = head
+        super().__init__(
+            f"Database schema is at revision {current}, expected {head}. "
+            "Run `python -m hpcadmin_server.database.migrations upgrade`"
+        )
+
+
+@dataclass(frozen=True)
+class Revision:
+    version: int
+    description: str
+    # schema changes, run in one transaction
+    upgrade: Callable[[Connection], None] | None = None
+    # called with a connection and a batch size until it returns 0, each
+    # call in its own transaction. It must only pick up rows that still need
+    # changing, so an interrupted backfill carries on where it left off.
+    backfill: Callable[[Connection, int], int] | None = None
+
+
+REVISIONS: list[Revision] = []
+
+
+def revision(version: int, description: str, backfill=None):
+    def register(upgrade):
+        REVISIONS.append(Revision(version, description, upgrade, backfill))
+        return upgrade
+
+    return register
+
+
+#####
+# Revisions
+#####
+
+
+def _has_column(connection: Connection, table: str, column: str) -> bool:
+    return any(c["name"] == column for c in inspect(connection).get_columns(table))
+
+
+@revision(1, "users, pirgs, groups and their memberships")
+def _initial(connection):
+    for table in [
+        models.User.__table__,
+        models.Pirg.__table__,
+        models.Group.__table__,
+        *MEMBERSHIP_TABLES,
+    ]:
+        table.create(connection, checkfirst=True)
+
+
+@revision(2, "row and collection versions")
+def _versions(connection):
+    for table in ["users", "pirgs", "groups"]:
+        if not _has_column(connection, table, "version"):
+            # a constant default is filled in without rewriting the table
+            connection.execute(
+                text(
+                    f"ALTER TABLE {table} "
+                    "ADD COLUMN version INTEGER NOT NULL DEFAULT 1"
+                )
+            )
+    models.CollectionVersion.__table__.create(connection, checkfirst=True)
+
+
+@revision(3, "change log")
+def _change_log(connection):
+    models.Change.__table__.create(connection, checkfirst=True)
+
+
+def dedupe_memberships(connection: Connection, batch_size: int) -> int:
+    """
+    Delete up to `batch_size` duplicate memberships, keeping the first row of
+    each (parent, user) pair, and return how many went.
+    """
+    deleted = 0
+    for table in MEMBERSHIP_TABLES:
+        parent = table.c[_parent_column(table)]
+        keep = select(func.min(table.c.id)).group_by(parent, table.c.user_id)
+        duplicates = (
+            select(table.c.id)
+            .where(table.c.id.not_in(keep))
+            .limit(batch_size - deleted)
+        )
+        result = connection.execute(delete(table).where(table.c.id.in_(duplicates)))
+        deleted += result.rowcount
+        if deleted >= batch_size:
+            break
+    return deleted
+
+
+def _parent_column(table: Table) -> str:
+    return next(c.name for c in table.c if c.name not in ("id", "user_id"))
+
+
+@revision(4, "dedupe memberships", backfill=dedupe_memberships)
+def _dedupe(connection):
+    pass
+
+
+def _create_indexes(connection: Connection, tables: list[Table]) -> None:
+    for table in tables:
+        existing = {i["name"] for i in inspect(connection).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+
+
+@revision(5, "unique membership indexes")
+def _membership_indexes(connection):
+    _create_indexes(connection, MEMBERSHIP_TABLES)
+
+
+def _index_user_search(connection: Connection, batch_size: int) -> int:
+    # sqlite's fts5 rebuild is a single statement, so this is one batch
+    if inspect(connection).has_table("users"):
+        models.rebuild_user_search(connection)
+    return 0
+
+
+@revision(6, "filter and search indexes", backfill=_index_user_search)
+def _filter_indexes(connection):
+    _create_indexes(
+        connection,
+        [models.User.__table__, models.Pirg.__table__, models.Group.__table__],
+    )
+    models.create_user_search(connection)
+
+
+def membership_sources() -> list:
+    """
+    What the memberships table holds, derived from the owner column and the
+    association tables, as selects of (user_id, entity, entity_id, name,
+    role).
+    """
+    pirg_admins = models.pirg_admin_association_table.c
+    pirg_users = models.pirg_user_association_table.c
+    group_users = models.group_user_association_table.c
+    Pirg, Group = models.Pirg, models.Group
+    return [
+        select(Pirg.owner_id, literal("pirg"), Pirg.id, Pirg.name, literal("owner")),
+        select(
+            pirg_admins.user_id,
+            literal("pirg"),
+            Pirg.id,
+            Pirg.name,
+            literal("admin"),
+        ).join(Pirg, Pirg.id == pirg_admins.pirg_id),
+        select(
+            pirg_users.user_id, literal("pirg"), Pirg.id, Pirg.name, literal("user")
+        ).join(Pirg, Pirg.id == pirg_users.pirg_id),
+        select(
+            group_users.user_id,
+            literal("group"),
+            Group.id,
+            Group.name,
+            literal("member"),
+        ).join(Group, Group.id == group_users.group_id),
+    ]
+
+
+def backfill_memberships(connection: Connection, batch_size: int) -> int:
+    """
+    Insert up to `batch_size` of the rows `membership_sources` gives that
+    aren't in the memberships table yet.
+    """
+    m = models.Membership
+    columns = ["user_id", "entity", "entity_id", "name", "role"]
+    for source in membership_sources():
+        user_id, entity, entity_id, _, role = source.selected_columns
+        present = (
+            select(m.id)
+            .where(
+                m.user_id == user_id,
+                m.entity == entity,
+                m.entity_id == entity_id,
+                m.role == role,
+            )
+            .exists()
+        )
+        missing = source.where(~present).limit(batch_size)
+        inserted = connection.execute(insert(m).from_select(columns, missing))
+        if inserted.rowcount:
+            return inserted.rowcount
+    return 0
+
+
+@revision(7, "effective memberships", backfill=backfill_memberships)
+def _memberships(connection):
+    models.Membership.__table__.create(connection, checkfirst=True)
+
+
+@revision(8, "outbox delivery cursors")
+def _delivery_cursors(connection):
+    models.DeliveryCursor.__table__.create(connection, checkfirst=True)
+
+
+@revision(9, "audit log")
+def _audit_log(connection):
+    models.AuditEntry.__table__.create(connection, checkfirst=True)
+
+
+HEAD = REVISIONS[-1].version
+
+
+#####
+# Running
+#####
+
+
+def current_version(connection: Connection) -> int:
+    if not inspect(connection).has_table(schema_version_table.name):
+        return 0
+    return connection.scalar(select(schema_version_table.c.version)) or 0
+
+
+def _stamp(connection: Connection, version: int) -> None:
+    schema_version_table.create(connection, checkfirst=True)
+    if connection.execute(
+        update(schema_version_table).values(version=version)
+    ).rowcount:
+        return
+    connection.execute(schema_version_table.insert().values(version=version))
+
+
+def run_backfill(engine: Engine, backfill, batch_size: int = BATCH_SIZE) -> int:
+    total = 0
+    while True:
+        with engine.begin() as connection:
+            changed = backfill(connection, batch_size)
+        total += changed
+        if changed == 0:
+            return total
+
+
+def upgrade(engine: Engine, batch_size: int = BATCH_SIZE) -> int:
+    """
+    Apply every revision the database hasn't seen yet, returning the revision
+    it ends up at.
+    """
+    with engine.connect() as connection:
+        current = current_version(connection)
+    for rev in REVISIONS:
+        if rev.version <= current:
+            continue
+        if rev.upgrade is not None:
+            with engine.begin() as connection:
+                rev.upgrade(connection)
+        if rev.backfill is not None:
+            run_backfill(engine, rev.backfill, batch_size)
+        # stamped on its own, after the backfill, so an interrupted revision
+        # is run again from the top
+        with engine.begin() as connection:
+            _stamp(connection, rev.version)
+    return HEAD
+
+
+def check(engine: Engine) -> None:
+    """
+    Raise SchemaOutOfDateError unless the database is at HEAD.
+    """
+    with engine.connect() as connection:
+        current = current_version(connection)
+    if current != HEAD:
+        raise SchemaOutOfDateError(current, HEAD)
+
+
+def main():
+    from .db import engine
+
+    parser = argparse.ArgumentParser(
+        prog="python -m hpcadmin_server.database.migrations"
+    )
+    parser.add_argument("command", choices=["upgrade", "current"])
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    if args.command == "upgrade":
+        upgrade(engine, args.batch_size)
+    with engine.connect() as connection:
+        print(f"revision {current_version(connection)} of {HEAD}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,41 @@
 from typing import Optional
-from sqlalchemy import String, ForeignKey, Boolean, TIMESTAMP, Column, Table, Integer
+from sqlalchemy import (
+    String,
+    ForeignKey,
+    Boolean,
+    TIMESTAMP,
+    Column,
+    Index,
+    Table,
+    Integer,
+    event,
+    insert,
+    text,
+)
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.sql import func
 
 from .db import Base
 
+
+def _membership_indexes(name: str, parent: str) -> list[Index]:
+    # one index per direction, so both "members of this pirg/group" and "what
+    # is this user a member of" are index lookups. Each covers both columns,
+    # so neither needs to touch the table, and being unique they also keep a
+    # user from being a member twice.
+    return [
+        Index(f"ix_{name}_{parent}_user", parent, "user_id", unique=True),
+        Index(f"ix_{name}_user_{parent}", "user_id", parent, unique=True),
+    ]
+
+
 pirg_user_association_table = Table(
     "pirg_user_association_table",
     Base.metadata,
     Column("id", Integer, primary_key=True),
     Column("user_id", Integer, ForeignKey("users.id")),
     Column("pirg_id", Integer, ForeignKey("pirgs.id")),
+    *_membership_indexes("pirg_user", "pirg_id"),
 )
 
 pirg_admin_association_table = Table(
@@ -19,6 +44,7 @@ pirg_admin_association_table = Table(
     Column("id", Integer, primary_key=True),
     Column("user_id", Integer, ForeignKey("users.id")),
     Column("pirg_id", Integer, ForeignKey("pirgs.id")),
+    *_membership_indexes("pirg_admin", "pirg_id"),
 )
 
 group_user_association_table = Table(
@@ -27,8 +53,15 @@ group_user_association_table = Table(
     Column("id", Integer, primary_key=True),
     Column("group_id", Integer, ForeignKey("groups.id")),
     Column("user_id", Integer, ForeignKey("users.id")),
+    *_membership_indexes("group_user", "group_id"),
 )
 
+MEMBERSHIP_TABLES = [
+    pirg_user_association_table,
+    pirg_admin_association_table,
+    group_user_association_table,
+]
+
 
 class User(Base):
     __tablename__ = "users"
@@ -37,22 +70,33 @@ class User(Base):
     firstname: Mapped[str] = mapped_column(String(255))
     lastname: Mapped[str] = mapped_column(String(255))
     email: Mapped[str] = mapped_column(String(255), unique=True)
+    # collections are ordered by id, so responses are stable
     pirgs: Mapped[list["Pirg"]] = relationship(
-        secondary=pirg_user_association_table, back_populates="users"
+        secondary=pirg_user_association_table,
+        back_populates="users",
+        order_by="Pirg.id",
     )
     groups: Mapped[list["Group"]] = relationship(
-        secondary=group_user_association_table, back_populates="users"
+        secondary=group_user_association_table,
+        back_populates="users",
+        order_by="Group.id",
     )
     sponsor_id: Mapped[Optional[int]] = mapped_column(
-        ForeignKey("users.id"), nullable=True
+        ForeignKey("users.id"), nullable=True, index=True
     )
     sponsor: Mapped[Optional["User"]] = relationship(remote_side=[id])
-    is_pi: Mapped[bool] = mapped_column(Boolean, default=False)
+    is_pi: Mapped[bool] = mapped_column(Boolean, default=False, index=True)
+    # bumped whenever anything in the user's api representation changes,
+    # including memberships, and used as its etag
+    version: Mapped[int] = mapped_column(Integer, default=1, server_default="1")
     created_at: Mapped[str] = mapped_column(
         TIMESTAMP(timezone=True), server_default=func.now()
     )
     updated_at: Mapped[str] = mapped_column(
-        TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.now()
+        TIMESTAMP(timezone=True),
+        server_default=func.now(),
+        onupdate=func.now(),
+        index=True,
     )
 
 
@@ -60,18 +104,28 @@ class Pirg(Base):
     __tablename__ = "pirgs"
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(255), unique=True)
-    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
     owner: Mapped["User"] = relationship()
-    admins: Mapped[list["User"]] = relationship(secondary=pirg_admin_association_table)
+    admins: Mapped[list["User"]] = relationship(
+        secondary=pirg_admin_association_table, order_by="User.id"
+    )
     users: Mapped[list["User"]] = relationship(
-        secondary=pirg_user_association_table, back_populates="pirgs"
+        secondary=pirg_user_association_table,
+        back_populates="pirgs",
+        order_by="User.id",
     )
-    groups: Mapped[list["Group"]] = relationship(back_populates="pirg")
+    groups: Mapped[list["Group"]] = relationship(
+        back_populates="pirg", order_by="Group.id"
+    )
+    version: Mapped[int] = mapped_column(Integer, default=1, server_default="1")
     created_at: Mapped[str] = mapped_column(
         TIMESTAMP(timezone=True), server_default=func.now()
     )
     updated_at: Mapped[str] = mapped_column(
-        TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.now()
+        TIMESTAMP(timezone=True),
+        server_default=func.now(),
+        onupdate=func.now(),
+        index=True,
     )
 
 
@@ -79,14 +133,195 @@ class Group(Base):
     __tablename__ = "groups"
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(255), unique=True)
-    pirg_id: Mapped[int] = mapped_column(ForeignKey("pirgs.id"))
+    pirg_id: Mapped[int] = mapped_column(ForeignKey("pirgs.id"), index=True)
     pirg: Mapped["Pirg"] = relationship(back_populates="groups")
     users: Mapped[list["User"]] = relationship(
-        secondary=group_user_association_table, back_populates="groups"
+        secondary=group_user_association_table,
+        back_populates="groups",
+        order_by="User.id",
     )
+    version: Mapped[int] = mapped_column(Integer, default=1, server_default="1")
     created_at: Mapped[str] = mapped_column(
         TIMESTAMP(timezone=True), server_default=func.now()
     )
+    updated_at: Mapped[str] = mapped_column(
+        TIMESTAMP(timezone=True),
+        server_default=func.now(),
+        onupdate=func.now(),
+        index=True,
+    )
+
+
+# Search over users for /users/?q=, kept up to date by the database itself.
+# SQLite gets an FTS5 index with the trigram tokenizer, which finds
+# substrings of three or more characters, and postgres a pg_trgm index that
+# answers ILIKE '%...%' on each column. Elsewhere searches scan the table.
+USER_SEARCH_COLUMNS = ["username", "firstname", "lastname", "email"]
+USER_SEARCH_TABLE = "users_fts"
+
+
+def _sqlite_user_search() -> list[str]:
+    columns = ", ".join(USER_SEARCH_COLUMNS)
+    new = ", ".join(f"new.{c}" for c in USER_SEARCH_COLUMNS)
+    old = ", ".join(f"old.{c}" for c in USER_SEARCH_COLUMNS)
+    fts = USER_SEARCH_TABLE
+    insert = f"INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new});"
+    delete = (
+        f"INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old});"
+    )
+    return [
+        # external content, so the text isn't stored twice
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({columns}, "
+        "content='users', content_rowid='id', tokenize='trigram')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON users "
+        f"BEGIN {insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON users "
+        f"BEGIN {delete} END",
+        # version bumps don't touch the searched columns, so they're skipped
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_update "
+        f"AFTER UPDATE OF {columns} ON users BEGIN {delete} {insert} END",
+    ]
+
+
+def _postgresql_user_search() -> list[str]:
+    columns = ", ".join(f"{c} gin_trgm_ops" for c in USER_SEARCH_COLUMNS)
+    return [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        f"CREATE INDEX IF NOT EXISTS ix_users_search ON users USING gin ({columns})",
+    ]
+
+
+def create_user_search(connection) -> None:
+    statements = {
+        "sqlite": _sqlite_user_search,
+        "postgresql": _postgresql_user_search,
+    }.get(connection.dialect.name)
+    for statement in statements() if statements else []:
+        connection.execute(text(statement))
+
+
+def rebuild_user_search(connection) -> None:
+    # only needed when the index is added to a table that already has rows
+    if connection.dialect.name == "sqlite":
+        fts = USER_SEARCH_TABLE
+        connection.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+
+
+@event.listens_for(User.__table__, "after_create")
+def _create_user_search(target, connection, **kw):
+    create_user_search(connection)
+
+
+@event.listens_for(User.__table__, "before_drop")
+def _drop_user_search(target, connection, **kw):
+    if connection.dialect.name == "sqlite":
+        connection.execute(text(f"DROP TABLE IF EXISTS {USER_SEARCH_TABLE}"))
+
+
+# Versions of the /users/, /pirgs/ and /groups/ collections as a whole, bumped
+# by every change that shows up in their listings
+COLLECTIONS = ["users", "pirgs", "groups"]
+
+
+class CollectionVersion(Base):
+    __tablename__ = "collection_versions"
+    name: Mapped[str] = mapped_column(String(255), primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, default=1)
+
+
+@event.listens_for(CollectionVersion.__table__, "after_create")
+def _seed_collection_versions(target, connection, **kw):
+    connection.execute(insert(target), [{"name": name} for name in COLLECTIONS])
+
+
+class Change(Base):
+    """
+    Append-only log of creates, deletes and membership changes, read by sync
+    agents through /changes. Transactions that write changes take turns, see
+    crud._write_changes, so they commit in `seq` order and it doubles as the
+    agents' cursor.
+    """
+
+    __tablename__ = "changes"
+    seq: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    entity: Mapped[str] = mapped_column(String(32))
+    entity_id: Mapped[int] = mapped_column(Integer)
+    # kept so deletes can be applied without the row they refer to
+    name: Mapped[str] = mapped_column(String(255))
+    action: Mapped[str] = mapped_column(String(32))
+    member_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    role: Mapped[Optional[str]] = mapped_column(String(32), nullable=True)
+    created_at: Mapped[str] = mapped_column(
+        TIMESTAMP(timezone=True), server_default=func.now()
+    )
+
+
+class Membership(Base):
+    """
+    Everything each user is effectively a member of, one row per pirg or
+    group and role: owner, admin and user of pirgs, member of groups. It
+    duplicates the owner column and the association tables, so a user's
+    access can be answered from one index range without unioning them, and
+    the crud writes keep it in step with them.
+    """
+
+    __tablename__ = "memberships"
+    __table_args__ = (
+        # covers the lookup by user, in the order it's returned
+        Index(
+            "ix_memberships_user", "user_id", "entity", "entity_id", "role", unique=True
+        ),
+        Index("ix_memberships_entity", "entity", "entity_id"),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    # "pirg" or "group"
+    entity: Mapped[str] = mapped_column(String(32))
+    entity_id: Mapped[int] = mapped_column(Integer)
+    name: Mapped[str] = mapped_column(String(255))
+    role: Mapped[str] = mapped_column(String(32))
+
+
+class DeliveryCursor(Base):
+    """
+    How far through the change log each outbox target has been delivered,
+    see outbox.py. The change log is written in the same transaction as the
+    change itself, which makes it the outbox.
+    """
+
+    __tablename__ = "delivery_cursors"
+    target: Mapped[str] = mapped_column(String(64), primary_key=True)
+    # the last change delivered
+    seq: Mapped[int] = mapped_column(Integer, default=0)
     updated_at: Mapped[str] = mapped_column(
         TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.now()
     )
+
+
+class AuditEntry(Base):
+    """
+    Who made each create, delete and membership change, and when. The change
+    log has the same changes, but not who made them; these are buffered and
+    written in batches by audit.py rather than in the change's transaction.
+    """
+
+    __tablename__ = "audit_log"
+    __table_args__ = (
+        # each GET /audit filter is a range of one of these, in id order
+        Index("ix_audit_log_name", "name", "id"),
+        Index("ix_audit_log_actor", "actor", "id"),
+        Index("ix_audit_log_member", "member_id", "id"),
+        Index("ix_audit_log_created_at", "created_at"),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    # when the change was made, not when the entry was written
+    created_at: Mapped[str] = mapped_column(TIMESTAMP(timezone=True))
+    actor: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    entity: Mapped[str] = mapped_column(String(32))
+    entity_id: Mapped[int] = mapped_column(Integer)
+    name: Mapped[str] = mapped_column(String(255))
+    action: Mapped[str] = mapped_column(String(32))
+    member_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    # the member's role before and after, None where they weren't a member
+    old_role: Mapped[Optional[str]] = mapped_column(String(32), nullable=True)
+    new_role: Mapped[Optional[str]] = mapped_column(String(32), nullable=True)
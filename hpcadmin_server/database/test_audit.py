@@ -0,0 +1,151 @@
+import itertools
+import os
+import shutil
+import tempfile
+import time
+
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import sessionmaker
+
+from . import audit, crud, models
+from ..api import schemas
+from ..config import Settings
+from .db import create_db_engine
+
+# usernames stay unique across the class's tests
+_numbers = itertools.count(1)
+
+
+def _wait_for(condition, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class TestAuditBuffer:
+    def setup_class(self):
+        # file backed, so the buffer's thread has its own connection
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine = create_db_engine(
+            Settings(database_url=f"sqlite:///{os.path.join(self.tmpdir, 'a.db')}")
+        )
+        models.Base.metadata.create_all(bind=self.engine)
+        crud.cache.clear()
+        self.SessionLocal = sessionmaker(autoflush=False, bind=self.engine)
+
+    def teardown_class(self):
+        audit.buffer.stop()
+        models.Base.metadata.drop_all(bind=self.engine)
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+        crud.cache.clear()
+
+    def teardown_method(self):
+        audit.buffer.stop()
+
+    def create_user(self, db) -> models.User:
+        number = next(_numbers)
+        return crud.create_user(
+            db,
+            schemas.UserCreate(
+                username=f"audited{number}",
+                firstname="Audited",
+                lastname="Test",
+                email=f"audited{number}@example.com",
+                is_pi=False,
+                sponsor_id=None,
+            ),
+        )
+
+    def entries(self) -> list[models.AuditEntry]:
+        with self.SessionLocal() as db:
+            return db.scalars(
+                select(models.AuditEntry).order_by(models.AuditEntry.id)
+            ).all()
+
+    def count(self) -> int:
+        with self.SessionLocal() as db:
+            return db.scalar(select(func.count()).select_from(models.AuditEntry))
+
+    def test_not_recorded_unless_started(self):
+        with self.SessionLocal.begin() as db:
+            self.create_user(db)
+        assert not audit.buffer._entries
+
+    def test_recorded_on_commit_only(self):
+        audit.buffer.start(self.engine, flush_ms=60000)
+        start = self.count()
+        with self.SessionLocal() as db:
+            self.create_user(db)
+            db.rollback()
+        token = audit.actor.set("alice")
+        try:
+            with self.SessionLocal.begin() as db:
+                user = self.create_user(db)
+                pirg = crud.create_pirg(
+                    db,
+                    schemas.PirgCreate(
+                        name="auditpirg", owner_id=user.id, admin_ids=[], user_ids=[]
+                    ),
+                )
+                member = self.create_user(db)
+                crud.add_user_to_pirg(db, pirg, member)
+                crud.remove_user_from_pirg(db, pirg, member)
+                member_id = member.id
+        finally:
+            audit.actor.reset(token)
+        # nothing is written until a threshold is reached
+        assert self.count() == start
+        audit.buffer.stop()
+
+        entries = self.entries()[start:]
+        assert [(e.entity, e.action) for e in entries] == [
+            ("user", "create"),
+            ("pirg", "create"),
+            ("user", "create"),
+            ("pirg", "add"),
+            ("pirg", "remove"),
+        ]
+        assert {e.actor for e in entries} == {"alice"}
+        add, remove = entries[-2:]
+        assert add.member_id == remove.member_id == member_id
+        assert (add.old_role, add.new_role) == (None, "user")
+        assert (remove.old_role, remove.new_role) == ("user", None)
+        assert all(e.created_at is not None for e in entries)
+
+    def test_flushes_on_size_in_one_insert(self):
+        inserts = []
+
+        def count(conn, cursor, statement, *args):
+            if statement.startswith("INSERT INTO audit_log"):
+                inserts.append(statement)
+
+        audit.buffer.start(self.engine, batch_size=3, flush_ms=60000)
+        start = self.count()
+        event.listen(self.engine, "before_cursor_execute", count)
+        try:
+            with self.SessionLocal.begin() as db:
+                for _ in range(3):
+                    self.create_user(db)
+            _wait_for(lambda: self.count() == start + 3)
+        finally:
+            event.remove(self.engine, "before_cursor_execute", count)
+        assert len(inserts) == 1
+
+    def test_flushes_on_time(self):
+        audit.buffer.start(self.engine, batch_size=1000, flush_ms=20)
+        start = self.count()
+        with self.SessionLocal.begin() as db:
+            self.create_user(db)
+        _wait_for(lambda: self.count() == start + 1)
+
+    def test_full_buffer_drops_oldest(self):
+        audit.buffer.start(self.engine, flush_ms=60000, max_entries=2)
+        audit.buffer.add([{"name": "first"}, {"name": "second"}])
+        audit.buffer.add([{"name": "third"}])
+        assert [e["name"] for e in audit.buffer._entries] == ["second", "third"]
+        # not writable, so they're left for the next attempt
+        assert not audit.buffer.flush()
+        assert len(audit.buffer._entries) == 2
+        audit.buffer._entries.clear()
@@ -0,0 +1,148 @@
+import time
+from unittest.mock import patch
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from . import crud, models
+from .cache import Cache, MemoryCache
+
+
+class TestMemoryCache:
+    def test_lru_eviction(self):
+        c = MemoryCache(maxsize=2, ttl=60)
+        c.set("a", 1)
+        c.set("b", 2)
+        assert c.get("a") == 1
+        c.set("c", 3)
+        # b was the least recently used
+        assert c.get("b") == None and c.get("a") == 1 and c.get("c") == 3
+
+    def test_ttl_expiry(self):
+        c = MemoryCache(maxsize=10, ttl=0.01)
+        c.set("a", 1)
+        time.sleep(0.02)
+        assert c.get("a") == None and len(c) == 0
+
+    def test_stats(self):
+        c = Cache(MemoryCache(maxsize=10, ttl=60))
+        c.get("a")
+        c.set("a", 1)
+        c.get("a")
+        c.invalidate("a")
+        assert c.stats() == {"hits": 1, "misses": 1, "invalidations": 1, "size": 0}
+
+    def test_set_after_invalidation_skipped(self):
+        c = Cache(MemoryCache(maxsize=10, ttl=60))
+        generation = c.generation
+        # the value was loaded before this invalidation, so it may be stale
+        c.invalidate("a")
+        c.set("a", 1, generation)
+        assert c.get("a") == None
+        c.set("a", 2, c.generation)
+        assert c.get("a") == 2
+
+
+class TestCachedLookups:
+    def setup_class(self):
+        self.engine = create_engine(
+            "sqlite://",
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        self.SessionLocal = sessionmaker(
+            autoflush=False, autocommit=False, bind=self.engine
+        )
+        models.Base.metadata.create_all(bind=self.engine)
+        crud.cache.clear()
+        self.queries = 0
+
+        def count(*args):
+            self.queries += 1
+
+        event.listen(self.engine, "before_cursor_execute", count)
+
+        from ..api import schemas
+
+        with self.SessionLocal() as db:
+            for name in ["alice", "bob"]:
+                crud.create_user(
+                    db,
+                    schemas.UserCreate(
+                        username=name,
+                        firstname=name,
+                        lastname="Cached",
+                        email=f"{name}@example.org",
+                        is_pi=name == "alice",
+                        sponsor_id=None,
+                    ),
+                )
+            crud.create_pirg(
+                db,
+                schemas.PirgCreate(
+                    name="cached", owner_id=1, admin_ids=[], user_ids=[]
+                ),
+            )
+            db.commit()
+
+    def teardown_class(self):
+        models.Base.metadata.drop_all(bind=self.engine)
+        crud.cache.clear()
+
+    def lookup(self, fn, **kwargs):
+        # each lookup gets its own session, like separate requests would
+        with self.SessionLocal() as db:
+            before = self.queries
+            obj = fn(db, **kwargs)
+            assert obj != None
+            return obj.id, self.queries - before
+
+    def test_get_user_read_through(self):
+        assert self.lookup(crud.get_user, id=1) == (1, 1)
+        assert self.lookup(crud.get_user, id=1) == (1, 0)
+
+    def test_get_user_by_username_shares_row(self):
+        # the row is already cached by id, only the name has to be resolved
+        assert self.lookup(crud.get_user_by_username, username="alice") == (1, 1)
+        assert self.lookup(crud.get_user_by_username, username="alice") == (1, 0)
+
+    def test_cached_object_lazy_loads(self):
+        with self.SessionLocal() as db:
+            u = crud.get_user(db, id=1)
+            assert u.username == "alice" and u.pirgs == []
+
+    def test_membership_change_invalidates(self):
+        assert self.lookup(crud.get_pirg_by_name, name="cached") == (1, 1)
+        assert self.lookup(crud.get_pirg_by_name, name="cached") == (1, 0)
+        with self.SessionLocal() as db:
+            p = crud.get_pirg_by_name(db, name="cached")
+            crud.add_users_to_pirg(db, pirg=p, user_ids=[2])
+            db.commit()
+        _, queries = self.lookup(crud.get_pirg_by_name, name="cached")
+        assert queries == 1
+        with self.SessionLocal() as db:
+            p = crud.get_pirg_by_name(db, name="cached")
+            assert [u.username for u in p.users] == ["bob"]
+
+    def test_stats_counted(self):
+        stats = crud.cache.stats()
+        assert stats["hits"] > 0 and stats["misses"] > 0
+        # the pirg and bob, whose versions were bumped
+        assert stats["invalidations"] == 2
+
+    def test_row_loaded_before_commit_not_cached(self):
+        crud.cache.invalidate(crud._row_key(models.User, 2))
+        with self.SessionLocal() as db:
+            scalar = db.scalar
+
+            def commit_while_loading(query):
+                # another session commits bob and invalidates him after the
+                # old row was read
+                obj = scalar(query)
+                crud.cache.invalidate(crud._row_key(models.User, 2))
+                return obj
+
+            with patch.object(db, "scalar", commit_while_loading):
+                crud.get_user(db, id=2)
+        assert self.lookup(crud.get_user, id=2) == (2, 1)
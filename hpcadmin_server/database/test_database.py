@@ -1,4 +1,7 @@
+import warnings
+
 from sqlalchemy import create_engine
+from sqlalchemy.exc import SAWarning
 from sqlalchemy.orm import sessionmaker, declarative_base
 from . import models
 from . import crud
@@ -19,6 +22,8 @@ class TestDatabase:
         self.Base = declarative_base()
         self.db = self.SessionLocal()
         models.Base.metadata.create_all(bind=self.engine)
+        # ids are reused between test databases
+        crud.cache.clear()
 
     def teardown_class(self):
         self.Base.metadata.drop_all(bind=self.engine)
@@ -312,3 +317,39 @@ class TestDatabase:
 
         pg = get_pirg_group(self.db, group_id=1)
         assert pg == None
+
+    def test_resolve_users(self):
+        from .crud import resolve_users
+
+        users, missing = resolve_users(self.db, [3, 99, 1, 3])
+        assert [u.id for u in users] == [3, 1] and missing == [99]
+
+    def test_create_pirg_missing_admin(self):
+        from ..api import schemas
+        from .crud import create_pirg, get_pirg_by_name
+
+        s = schemas.PirgCreate(
+            name="missing", owner_id=1, admin_ids=[98, 2], user_ids=[99]
+        )
+        with pytest.raises(crud.UserNotFoundError) as e:
+            create_pirg(self.db, s)
+        assert e.value.user_ids == [99, 98]
+        assert get_pirg_by_name(self.db, "missing") == None
+
+    def test_create_pirg_members_in_session(self):
+        from ..api import schemas
+        from .crud import create_pirg, create_pirg_group, get_user
+
+        # the members are already loaded, which made the backrefs warn that
+        # the new pirg and group weren't in the session yet
+        users = [get_user(self.db, id=2), get_user(self.db, id=3)]
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", SAWarning)
+            s = schemas.PirgCreate(
+                name="loaded", owner_id=1, admin_ids=[2], user_ids=[2, 3]
+            )
+            p = create_pirg(self.db, s)
+            gc = schemas.GroupCreate(name="loadedgroup", pirg_id=p.id, user_ids=[3])
+            pg = create_pirg_group(self.db, group=gc)
+        assert p in users[0].pirgs and p in users[1].pirgs
+        assert pg in users[1].groups
@@ -0,0 +1,205 @@
+from sqlalchemy import create_engine, insert, inspect, select, text
+from sqlalchemy.pool import StaticPool
+import pytest
+from . import models
+from . import migrations
+
+
+def _plan(connection, query) -> str:
+    compiled = query.compile(connection, compile_kwargs={"literal_binds": True})
+    rows = connection.execute(text(f"EXPLAIN QUERY PLAN {compiled}"))
+    return "\n".join(row.detail for row in rows)
+
+
+class TestMigrations:
+    def setup_class(self):
+        self.engine = create_engine(
+            "sqlite://",
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        models.Base.metadata.create_all(bind=self.engine)
+
+    def teardown_class(self):
+        models.Base.metadata.drop_all(bind=self.engine)
+
+    def test_membership_lookups_use_indexes(self):
+        pirg_users = models.pirg_user_association_table
+        group_users = models.group_user_association_table
+        with self.engine.connect() as connection:
+            # what User.pirgs and Pirg.users load
+            plan = _plan(
+                connection,
+                select(models.Pirg.id)
+                .join(pirg_users, pirg_users.c.pirg_id == models.Pirg.id)
+                .where(pirg_users.c.user_id == 1),
+            )
+            assert "USING COVERING INDEX ix_pirg_user_user_pirg_id" in plan
+            plan = _plan(
+                connection,
+                select(pirg_users.c.user_id).where(pirg_users.c.pirg_id == 1),
+            )
+            assert "USING COVERING INDEX ix_pirg_user_pirg_id_user" in plan
+            plan = _plan(
+                connection,
+                select(group_users.c.group_id).where(group_users.c.user_id == 1),
+            )
+            assert "USING COVERING INDEX ix_group_user_user_group_id" in plan
+
+    def test_filters_use_indexes(self):
+        from sqlalchemy.orm import Session
+        from . import crud
+        from ..api import schemas
+
+        def plan(**filters) -> str:
+            where = crud._user_filters(db, schemas.UserFilter(**filters))
+            return _plan(connection, select(models.User.id).where(*where))
+
+        with self.engine.connect() as connection, Session(self.engine) as db:
+            assert "INDEX ix_users_sponsor_id" in plan(sponsor_id=1)
+            assert "INDEX ix_users_updated_at" in plan(
+                updated_since="2024-01-01T00:00:00"
+            )
+            assert "INDEX sqlite_autoindex_users_1" in plan(username="tim")
+            assert "VIRTUAL TABLE INDEX" in plan(q="timmy")
+            assert "INDEX ix_pirg_user_pirg_id_user" in plan(pirg="hpc")
+
+    def test_sponsees_use_index(self):
+        from . import crud
+
+        with self.engine.connect() as connection:
+            plan = _plan(connection, crud.sponsor_tree_query("timmyt", depth=5))
+            assert "INDEX ix_users_sponsor_id" in plan
+
+    def test_audit_filters_use_indexes(self):
+        from sqlalchemy.orm import Session
+        from . import crud
+        from ..api import schemas
+
+        def plan(**filters) -> str:
+            where = crud._audit_filters(db, schemas.AuditFilter(**filters))
+            query = select(models.AuditEntry.id).where(*where)
+            return _plan(connection, crud._paginate(query, models.AuditEntry, 100))
+
+        with self.engine.connect() as connection, Session(self.engine) as db:
+            assert "INDEX ix_audit_log_name" in plan(name="hpcrcf")
+            assert "INDEX ix_audit_log_actor" in plan(actor="alice")
+            assert "INDEX ix_audit_log_member" in plan(user="timmyt")
+            assert "INDEX ix_audit_log_created_at" in plan(
+                since="2024-01-01T00:00:00", until="2024-02-01T00:00:00"
+            )
+
+    def test_create_all_is_at_head(self):
+        # revisions skip what's already there, so this only stamps it
+        assert migrations.upgrade(self.engine) == migrations.HEAD
+        migrations.check(self.engine)
+
+
+# the tables as they were before any revision, which is what an unversioned
+# database is assumed to have
+LEGACY_SCHEMA = [
+    """CREATE TABLE users (
+        id INTEGER PRIMARY KEY, username VARCHAR(255) UNIQUE,
+        firstname VARCHAR(255), lastname VARCHAR(255), email VARCHAR(255) UNIQUE,
+        sponsor_id INTEGER REFERENCES users (id), is_pi BOOLEAN,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""",
+    """CREATE TABLE pirgs (
+        id INTEGER PRIMARY KEY, name VARCHAR(255) UNIQUE,
+        owner_id INTEGER REFERENCES users (id),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""",
+    """CREATE TABLE groups (
+        id INTEGER PRIMARY KEY, name VARCHAR(255) UNIQUE,
+        pirg_id INTEGER REFERENCES pirgs (id),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""",
+    """CREATE TABLE pirg_user_association_table (
+        id INTEGER PRIMARY KEY, user_id INTEGER, pirg_id INTEGER)""",
+    """CREATE TABLE pirg_admin_association_table (
+        id INTEGER PRIMARY KEY, user_id INTEGER, pirg_id INTEGER)""",
+    """CREATE TABLE group_user_association_table (
+        id INTEGER PRIMARY KEY, group_id INTEGER, user_id INTEGER)""",
+]
+
+
+class TestLegacyMigrations:
+    def setup_class(self):
+        self.engine = create_engine(
+            "sqlite://",
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        with self.engine.begin() as connection:
+            for statement in LEGACY_SCHEMA:
+                connection.execute(text(statement))
+            connection.execute(
+                text(
+                    "INSERT INTO users (username, firstname, lastname, email, is_pi)"
+                    " VALUES ('timmyt', 'Timmy', 'Test', 'timmyt@gmail.com', 0)"
+                )
+            )
+            connection.execute(
+                text("INSERT INTO pirgs (name, owner_id) VALUES ('hpcrcf', 1)")
+            )
+            connection.execute(
+                text("INSERT INTO groups (name, pirg_id) VALUES ('hpcrcf.gpu', 1)")
+            )
+            connection.execute(
+                insert(models.group_user_association_table),
+                [
+                    {"group_id": 1, "user_id": 1},
+                    {"group_id": 1, "user_id": 1},
+                    {"group_id": 1, "user_id": 2},
+                    {"group_id": 2, "user_id": 1},
+                    {"group_id": 1, "user_id": 1},
+                    {"group_id": 1, "user_id": 2},
+                ],
+            )
+
+    def test_check_refuses_unmigrated(self):
+        with pytest.raises(migrations.SchemaOutOfDateError) as e:
+            migrations.check(self.engine)
+        assert e.value.current == 0 and e.value.head == migrations.HEAD
+
+    def test_upgrade(self):
+        # one duplicate per batch, so the dedupe takes several transactions
+        migrations.upgrade(self.engine, batch_size=1)
+        migrations.check(self.engine)
+        table = models.group_user_association_table
+        with self.engine.connect() as connection:
+            assert connection.scalar(select(models.User.version)) == 1
+            assert connection.scalar(select(models.CollectionVersion.version)) == 1
+            rows = connection.execute(
+                select(table.c.id, table.c.group_id, table.c.user_id).order_by(
+                    table.c.id
+                )
+            ).all()
+            assert [tuple(row) for row in rows] == [(1, 1, 1), (3, 1, 2), (4, 2, 1)]
+            indexes = inspect(connection).get_indexes(table.name)
+            assert {i["name"] for i in indexes} == {i.name for i in table.indexes}
+            # the rows already there were indexed for search
+            match = "SELECT rowid FROM users_fts WHERE users_fts MATCH 'imm'"
+            assert connection.execute(text(match)).scalars().all() == [1]
+            # and their memberships resolved, the missing group 2 skipped
+            m = models.Membership
+            rows = connection.execute(
+                select(m.user_id, m.entity, m.entity_id, m.name, m.role).order_by(
+                    m.user_id, m.entity
+                )
+            ).all()
+            assert [tuple(row) for row in rows] == [
+                (1, "group", 1, "hpcrcf.gpu", "member"),
+                (1, "pirg", 1, "hpcrcf", "owner"),
+                (2, "group", 1, "hpcrcf.gpu", "member"),
+            ]
+
+    def test_backfill_batches(self):
+        calls = []
+
+        def backfill(connection, batch_size):
+            calls.append(batch_size)
+            return batch_size if len(calls) < 3 else 0
+
+        assert migrations.run_backfill(self.engine, backfill, batch_size=10) == 20
+        assert calls == [10, 10, 10]
@@ -0,0 +1,422 @@
+"""
+Per-request timing and SQL instrumentation, exposed in the Prometheus text
+format on /metrics.
+
+`MetricsMiddleware` opens a `RequestStats` for every request, which the
+engine hooks from `instrument_engine` add each statement's time to and
+`TimedRoute` marks when the endpoint returned, so the time spent turning its
+result into a response can be told apart. Once the response is sent the
+totals go into a `Metrics` registry under the route's path template, and
+requests over the configured latency or query count are logged along with
+their slowest statements.
+"""
+
+import contextvars
+import functools
+import heapq
+import inspect
+import logging
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# how many of a request's statements are kept for the slow request log
+SLOWEST_STATEMENTS = 3
+# the ASGI scope extension marking the requests the app sends itself at
+# startup, which aren't counted
+WARM_UP_EXTENSION = "hpcadmin.warm_up"
+
+
+@dataclass
+class RequestStats:
+    start: float = field(default_factory=time.perf_counter)
+    queries: int = 0
+    db_seconds: float = 0.0
+    endpoint_done: float | None = None
+    response_ready: float | None = None
+    # (seconds, statement) min-heap of the slowest statements
+    slowest: list = field(default_factory=list)
+
+    def add_statement(self, seconds: float, statement: str) -> None:
+        self.queries += 1
+        self.db_seconds += seconds
+        entry = (seconds, statement)
+        if len(self.slowest) < SLOWEST_STATEMENTS:
+            heapq.heappush(self.slowest, entry)
+        else:
+            heapq.heappushpop(self.slowest, entry)
+
+    @property
+    def serialization_seconds(self) -> float:
+        if self.endpoint_done is None or self.response_ready is None:
+            return 0.0
+        return max(0.0, self.response_ready - self.endpoint_done)
+
+
+# set by the middleware for the length of a request, and copied into the
+# threadpool along with the rest of the context for sync routes
+_current: contextvars.ContextVar[RequestStats | None] = contextvars.ContextVar(
+    "hpcadmin_request_stats", default=None
+)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((repr(bound), total))
+        result.append(("+Inf", self.count))
+        return result
+
+
+class Metrics:
+    """
+    The collected metrics, keyed by label values.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.durations = defaultdict(Histogram)
+        self.queries = defaultdict(int)
+        self.db_seconds = defaultdict(float)
+        self.serialization_seconds = defaultdict(float)
+        self.checkouts = defaultdict(Histogram)
+        self.engines = {}
+
+    def observe_request(
+        self, method: str, route: str, status: int, stats: RequestStats, duration
+    ) -> None:
+        key = (method, route)
+        with self._lock:
+            self.requests[(method, route, str(status))] += 1
+            self.durations[key].observe(duration)
+            self.queries[key] += stats.queries
+            self.db_seconds[key] += stats.db_seconds
+            self.serialization_seconds[key] += stats.serialization_seconds
+
+    def observe_checkout(self, engine: str, seconds: float) -> None:
+        with self._lock:
+            self.checkouts[(engine,)].observe(seconds)
+
+    def render(self, cache_stats: dict[str, int] | None = None) -> str:
+        lines = []
+        with self._lock:
+            _counter(
+                lines,
+                "hpcadmin_http_requests_total",
+                "Requests by route template and status",
+                ("method", "route", "status"),
+                self.requests,
+            )
+            _histogram(
+                lines,
+                "hpcadmin_http_request_duration_seconds",
+                "Time from receiving a request to sending the last of its body",
+                ("method", "route"),
+                self.durations,
+            )
+            _counter(
+                lines,
+                "hpcadmin_http_request_queries_total",
+                "SQL statements run by requests",
+                ("method", "route"),
+                self.queries,
+            )
+            _counter(
+                lines,
+                "hpcadmin_http_request_db_seconds_total",
+                "Time requests spent executing SQL",
+                ("method", "route"),
+                self.db_seconds,
+            )
+            _counter(
+                lines,
+                "hpcadmin_http_request_serialization_seconds_total",
+                "Time from an endpoint returning to its response being ready",
+                ("method", "route"),
+                self.serialization_seconds,
+            )
+            _histogram(
+                lines,
+                "hpcadmin_db_pool_checkout_seconds",
+                "Time spent getting a connection from the pool",
+                ("engine",),
+                self.checkouts,
+            )
+            checked_out = {}
+            overflow = {}
+            for name, engine in self.engines.items():
+                pool = engine.pool
+                if hasattr(pool, "checkedout"):
+                    checked_out[(name,)] = pool.checkedout()
+                    overflow[(name,)] = max(0, pool.overflow())
+            _gauge(
+                lines,
+                "hpcadmin_db_pool_checked_out",
+                "Connections currently checked out",
+                ("engine",),
+                checked_out,
+            )
+            _gauge(
+                lines,
+                "hpcadmin_db_pool_overflow",
+                "Connections open beyond pool_size",
+                ("engine",),
+                overflow,
+            )
+        if cache_stats is not None:
+            for stat in ["hits", "misses", "invalidations"]:
+                _counter(
+                    lines,
+                    f"hpcadmin_cache_{stat}_total",
+                    f"Lookup cache {stat}",
+                    (),
+                    {(): cache_stats[stat]},
+                )
+            _gauge(
+                lines,
+                "hpcadmin_cache_entries",
+                "Entries in the lookup cache",
+                (),
+                {(): cache_stats["size"]},
+            )
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _header(lines: list, name: str, help: str, kind: str) -> None:
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} {kind}")
+
+
+def _counter(lines, name, help, label_names, values) -> None:
+    _header(lines, name, help, "counter")
+    for labels, value in sorted(values.items()):
+        lines.append(f"{name}{_labels(label_names, labels)} {value}")
+
+
+def _gauge(lines, name, help, label_names, values) -> None:
+    _header(lines, name, help, "gauge")
+    for labels, value in sorted(values.items()):
+        lines.append(f"{name}{_labels(label_names, labels)} {value}")
+
+
+def _histogram(lines, name, help, label_names, values) -> None:
+    _header(lines, name, help, "histogram")
+    for labels, histogram in sorted(values.items()):
+        for bound, count in histogram.cumulative():
+            le = _labels(label_names, labels, f'le="{bound}"')
+            lines.append(f"{name}_bucket{le} {count}")
+        lines.append(f"{name}_sum{_labels(label_names, labels)} {histogram.sum}")
+        lines.append(f"{name}_count{_labels(label_names, labels)} {histogram.count}")
+
+
+metrics = Metrics()
+
+
+#####
+# SQLAlchemy hooks
+#####
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+    # kept on the statement's own context, so one that raises, and never
+    # reaches _after_cursor_execute, leaves nothing behind on the connection
+    context._query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, many):
+    elapsed = time.perf_counter() - context._query_start
+    stats = _current.get()
+    # sqlite transactions are begun explicitly, see db._sqlite_transactions
+    if stats is not None and not statement.startswith("BEGIN"):
+        stats.add_statement(elapsed, statement)
+
+
+def instrument_engine(engine: Engine, name: str, registry: Metrics = metrics) -> None:
+    """
+    Attribute `engine`'s statements to the request running them, and time
+    how long getting a connection from its pool takes. Pass an async
+    engine's `sync_engine`.
+    """
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    # the pool has no event for before a checkout starts waiting, so the
+    # engine's raw_connection, which every Connection gets its connection from,
+    # is timed instead. Wrapping the engine rather than the pool also keeps
+    # the timing when dispose() replaces the pool.
+    raw_connection = engine.raw_connection
+
+    @functools.wraps(raw_connection)
+    def timed_raw_connection():
+        start = time.perf_counter()
+        try:
+            return raw_connection()
+        finally:
+            registry.observe_checkout(name, time.perf_counter() - start)
+
+    engine.raw_connection = timed_raw_connection
+    registry.engines[name] = engine
+
+
+#####
+# FastAPI hooks
+#####
+
+
+class TimedRoute(APIRoute):
+    """
+    Marks when the endpoint returns and when its response has been built,
+    which brackets FastAPI's validation and serialization of the result.
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, _mark_done(endpoint), **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def timed_handler(request):
+            response = await handler(request)
+            stats = _current.get()
+            if stats is not None:
+                stats.response_ready = time.perf_counter()
+            return response
+
+        return timed_handler
+
+
+def _mark_done(endpoint):
+    def done():
+        stats = _current.get()
+        if stats is not None:
+            stats.endpoint_done = time.perf_counter()
+
+    if inspect.iscoroutinefunction(endpoint):
+
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                done()
+
+    else:
+
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                done()
+
+    return wrapper
+
+
+class MetricsMiddleware:
+    """
+    Plain ASGI rather than BaseHTTPMiddleware, so streamed responses are
+    timed to their last chunk and aren't buffered.
+    """
+
+    def __init__(
+        self,
+        app,
+        registry: Metrics = metrics,
+        slow_request_ms: int | None = None,
+        slow_request_queries: int | None = None,
+    ):
+        self.app = app
+        self.registry = registry
+        self.slow_request_ms = (
+            settings.slow_request_ms if slow_request_ms is None else slow_request_ms
+        )
+        self.slow_request_queries = (
+            settings.slow_request_queries
+            if slow_request_queries is None
+            else slow_request_queries
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or WARM_UP_EXTENSION in scope.get("extensions", {}):
+            return await self.app(scope, receive, send)
+        stats = RequestStats()
+        token = _current.set(stats)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            duration = time.perf_counter() - stats.start
+            route = scope.get("route")
+            template = route.path if route is not None else "unmatched"
+            self.registry.observe_request(
+                scope["method"], template, status, stats, duration
+            )
+            self._log_if_slow(scope["method"], template, status, stats, duration)
+
+    def _log_if_slow(self, method, route, status, stats: RequestStats, duration):
+        slow = self.slow_request_ms and duration * 1000 >= self.slow_request_ms
+        chatty = (
+            self.slow_request_queries and stats.queries >= self.slow_request_queries
+        )
+        if not (slow or chatty):
+            return
+        statements = "".join(
+            f"\n  {seconds * 1000:.1f}ms {' '.join(statement.split())[:300]}"
+            for seconds, statement in sorted(stats.slowest, reverse=True)
+        )
+        logger.warning(
+            "Slow request %s %s %s: %.1fms, %d queries, %.1fms in the database%s",
+            method,
+            route,
+            status,
+            duration * 1000,
+            stats.queries,
+            stats.db_seconds * 1000,
+            statements,
+        )
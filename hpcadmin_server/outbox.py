@@ -0,0 +1,316 @@
+"""
+Pushes the change log to the systems that mirror the directory, such as
+LDAP, Slurm accounts and filesystem ACLs.
+
+crud writes every change to the change log in the same transaction as the
+change itself, which makes the log a transactional outbox. Each target is a
+`Sink` with its own cursor in the delivery_cursors table. The `Dispatcher`
+reads the changes past each target's cursor in batches and coalesces them,
+keeping only the last change to each member of each pirg or group. It
+delivers the batches on a bounded thread pool and advances a cursor once its
+sink has accepted the batch. A sink that fails is retried with exponential
+backoff without holding up the others. Delivery is at least once, so sinks
+have to be idempotent. Changes become visible in `seq` order, see
+crud._write_changes, so a cursor never moves past one still to commit.
+
+    python -m hpcadmin_server.outbox
+
+runs it on its own, delivering to the targets in HPCADMIN_OUTBOX_SINKS. Run
+one per database. A target new to the table starts from the latest change,
+not the beginning of the log.
+"""
+
+import abc
+import argparse
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+
+import httpx
+from sqlalchemy import func, insert, select, update
+
+from .api import schemas
+from .config import settings
+from .database import crud
+from .database.models import Change, DeliveryCursor
+
+logger = logging.getLogger(__name__)
+
+
+#####
+# Sinks
+#####
+
+
+class Sink(abc.ABC):
+    """
+    A target for the change log. `deliver` gets the coalesced changes as
+    dicts shaped like schemas.Change, oldest first, and raises if they
+    weren't accepted.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    @abc.abstractmethod
+    def deliver(self, changes: list[dict]) -> None: ...
+
+
+class FileSink(Sink):
+    """
+    Appends the changes to a file as newline delimited json, for tests and
+    for scripts that tail it.
+    """
+
+    def __init__(self, name: str, path: str):
+        super().__init__(name)
+        self.path = path
+
+    def deliver(self, changes: list[dict]) -> None:
+        with open(self.path, "a") as f:
+            f.write("".join(json.dumps(change) + "\n" for change in changes))
+
+
+class HttpSink(Sink):
+    """
+    POSTs each batch as newline delimited json, and treats anything but a
+    2xx response as a failure.
+    """
+
+    def __init__(self, name: str, url: str, timeout: float = 10.0, client=None):
+        super().__init__(name)
+        self.url = url
+        self.client = client or httpx.Client(timeout=timeout)
+
+    def deliver(self, changes: list[dict]) -> None:
+        body = "".join(json.dumps(change) + "\n" for change in changes)
+        response = self.client.post(
+            self.url,
+            content=body.encode(),
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        response.raise_for_status()
+
+
+def parse_sinks(spec: str) -> list[Sink]:
+    """
+    Sinks from a comma separated list of name=url, where the url is
+    file:///path or http(s)://...
+    """
+    sinks = []
+    for entry in filter(None, (e.strip() for e in spec.split(","))):
+        name, sep, url = entry.partition("=")
+        if not sep or not name:
+            raise ValueError(f"Expected name=url, got {entry!r}")
+        scheme = urlsplit(url).scheme
+        if scheme == "file":
+            sinks.append(FileSink(name, urlsplit(url).path))
+        elif scheme in ("http", "https"):
+            sinks.append(HttpSink(name, url))
+        else:
+            raise ValueError(f"Unsupported sink url {url!r}")
+    return sinks
+
+
+#####
+# Dispatching
+#####
+
+
+def coalesce(changes: list[dict]) -> list[dict]:
+    """
+    Keep only the last change to each membership, or to each entity for its
+    creates, updates and deletes, in the order those were made. Adding
+    someone and then removing them leaves just the removal, which is all the
+    target needs to end up the same. An update doesn't replace an earlier
+    change to the same entity, since the target reads what it has now either
+    way, and a create it never saw would be lost.
+    """
+    last = {}
+    for change in changes:
+        key = (
+            change["entity"],
+            change["entity_id"],
+            change["member_id"],
+            change["role"],
+        )
+        if change["action"] == schemas.ChangeAction.UPDATE.value and key in last:
+            continue
+        # re-inserting moves the key to the end, keeping the order of the
+        # changes that are kept
+        last.pop(key, None)
+        last[key] = change
+    return list(last.values())
+
+
+@dataclass
+class _Backoff:
+    attempts: int = 0
+    # clock() time before which the sink isn't retried
+    retry_at: float = 0.0
+
+
+class Dispatcher:
+    def __init__(
+        self,
+        SessionLocal,
+        sinks: list[Sink],
+        batch_size: int = settings.outbox_batch_size,
+        workers: int = settings.outbox_workers,
+        backoff_base: float = 1.0,
+        backoff_max: float = settings.outbox_backoff_max,
+        clock=time.monotonic,
+    ):
+        self.SessionLocal = SessionLocal
+        self.sinks = sinks
+        self.batch_size = batch_size
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.clock = clock
+        self.backoff = {sink.name: _Backoff() for sink in sinks}
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(1, min(workers, len(sinks))),
+            thread_name_prefix="outbox",
+        )
+        self._stop = threading.Event()
+        self._thread = None
+
+    def cursors(self) -> dict[str, int]:
+        with self.SessionLocal.begin() as db:
+            cursors = dict(
+                db.execute(select(DeliveryCursor.target, DeliveryCursor.seq)).all()
+            )
+            new = [sink.name for sink in self.sinks if sink.name not in cursors]
+            if new:
+                latest = db.scalar(select(func.coalesce(func.max(Change.seq), 0)))
+                db.execute(
+                    insert(DeliveryCursor),
+                    [{"target": name, "seq": latest} for name in new],
+                )
+                cursors.update({name: latest for name in new})
+        return cursors
+
+    def run_once(self) -> int:
+        """
+        Deliver one batch to every sink that isn't backing off, returning how
+        many changes were delivered across them. Only the pool's threads wait
+        on the sinks; the database is read and the cursors moved from here,
+        so it's one connection however many sinks there are.
+        """
+        cursors = self.cursors()
+        now = self.clock()
+        due = [s for s in self.sinks if self.backoff[s.name].retry_at <= now]
+        batches = {}
+        with self.SessionLocal() as db:
+            for sink in due:
+                after = cursors[sink.name]
+                # sinks that are caught up share a cursor, and so a batch
+                if after not in batches:
+                    batches[after] = [
+                        schemas.Change.model_validate(change).model_dump(mode="json")
+                        for change in crud.get_changes(
+                            db, since=after, limit=self.batch_size
+                        )
+                    ]
+        futures = {
+            sink.name: self.executor.submit(
+                self._deliver, sink, batches[cursors[sink.name]]
+            )
+            for sink in due
+            if batches[cursors[sink.name]]
+        }
+        delivered = {name: f.result() for name, f in futures.items() if f.result()}
+        if not delivered:
+            return 0
+        with self.SessionLocal.begin() as db:
+            for name, changes in delivered.items():
+                db.execute(
+                    update(DeliveryCursor)
+                    .where(DeliveryCursor.target == name)
+                    .values(seq=changes[-1]["seq"])
+                )
+        return sum(len(changes) for changes in delivered.values())
+
+    def _deliver(self, sink: Sink, changes: list[dict]) -> list[dict] | None:
+        """
+        Returns `changes` once the sink has taken them, None if it failed.
+        """
+        backoff = self.backoff[sink.name]
+        try:
+            sink.deliver(coalesce(changes))
+        except Exception as e:
+            backoff.attempts += 1
+            delay = min(
+                self.backoff_max, self.backoff_base * 2 ** (backoff.attempts - 1)
+            )
+            backoff.retry_at = self.clock() + delay
+            logger.warning(
+                "Delivering %d changes to %s failed (attempt %d), retrying in %.0fs: %s",
+                len(changes),
+                sink.name,
+                backoff.attempts,
+                delay,
+                e,
+            )
+            return None
+        self.backoff[sink.name] = _Backoff()
+        return changes
+
+    def run(self, poll_seconds: float = settings.outbox_poll_ms / 1000) -> None:
+        """
+        Deliver until `stop` is called, polling for new changes once caught up.
+        """
+        while not self._stop.is_set():
+            try:
+                delivered = self.run_once()
+            except Exception:
+                # the database being unreachable shouldn't end the loop
+                logger.exception("Reading the change log failed")
+                delivered = 0
+            if not delivered:
+                self._stop.wait(poll_seconds)
+
+    def start(self, **kwargs) -> None:
+        self._thread = threading.Thread(
+            target=self.run, kwargs=kwargs, name="outbox", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.executor.shutdown()
+
+
+def main():
+    from .database.db import SessionLocal
+
+    parser = argparse.ArgumentParser(prog="python -m hpcadmin_server.outbox")
+    parser.add_argument(
+        "--once", action="store_true", help="deliver what's pending and exit"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    sinks = parse_sinks(settings.outbox_sinks)
+    if not sinks:
+        parser.error("HPCADMIN_OUTBOX_SINKS names no sinks")
+    dispatcher = Dispatcher(SessionLocal, sinks)
+    try:
+        if args.once:
+            while dispatcher.run_once():
+                pass
+        else:
+            dispatcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dispatcher.stop()
+
+
+if __name__ == "__main__":
+    main()
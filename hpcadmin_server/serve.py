@@ -0,0 +1,43 @@
+"""
+The production launcher, configured by the settings in config.py.
+
+    python main.py            # HPCADMIN_WORKERS processes serving main:app
+    python main.py --reload   # one process, restarted when the code changes
+
+uvloop and httptools are used when they're installed, which
+`uvicorn[standard]` does.
+"""
+
+import argparse
+import importlib.util
+
+import uvicorn
+
+from .config import Settings, settings as default_settings
+
+APP = "main:app"
+
+
+def uvicorn_options(settings: Settings) -> dict:
+    return {
+        "host": settings.host,
+        "port": settings.port,
+        "workers": settings.workers,
+        "loop": "uvloop" if importlib.util.find_spec("uvloop") else "asyncio",
+        "http": "httptools" if importlib.util.find_spec("httptools") else "h11",
+        "backlog": settings.backlog,
+        "timeout_keep_alive": settings.keep_alive,
+        "access_log": settings.access_log,
+    }
+
+
+def serve(argv: list[str] | None = None, settings: Settings = default_settings):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--reload", action="store_true", help="restart when the code changes"
+    )
+    args = parser.parse_args(argv)
+    if args.reload:
+        uvicorn.run(APP, host=settings.host, port=settings.port, reload=True)
+        return
+    uvicorn.run(APP, **uvicorn_options(settings))
@@ -0,0 +1,107 @@
+import asyncio
+from unittest.mock import patch
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import sessionmaker
+
+from . import serve
+from .api import users
+from .app import create_app, warm_up, warm_up_requests
+from .config import Settings
+from .database import async_db, crud, db, models
+from .database.db import create_db_engine, get_db
+from .metrics import Metrics, MetricsMiddleware
+
+
+class TestApp:
+    def setup_class(self):
+        self.engine = create_db_engine(Settings(database_url="sqlite://"))
+        models.Base.metadata.create_all(bind=self.engine)
+        crud.cache.clear()
+        self.SessionLocal = sessionmaker(autoflush=False, bind=self.engine)
+
+    def teardown_class(self):
+        models.Base.metadata.drop_all(bind=self.engine)
+        crud.cache.clear()
+
+    def test_create_app_routes(self):
+        # building the app mustn't need the database
+        paths = create_app().openapi()["paths"]
+        for path in [
+            "/users/",
+            "/users:import",
+            "/pirgs/",
+            "/changes/",
+            "/audit/",
+            "/metrics",
+        ]:
+            assert path in paths
+
+    def test_warm_up_compiles_hot_queries(self):
+        warm_up(self.SessionLocal)
+        compiled = len(self.engine._compiled_cache)
+        with self.SessionLocal() as db:
+            list(crud.stream_user_rows(db, limit=100, after=5))
+            list(crud.stream_pirg_rows(db, limit=100))
+            crud.get_user(db, id=12345)
+            crud.get_user_by_username(db, username="nobody")
+        assert len(self.engine._compiled_cache) == compiled
+
+    def test_warm_up_requests_not_counted(self):
+        registry = Metrics()
+        app = FastAPI()
+        app.add_middleware(MetricsMiddleware, registry=registry)
+        app.include_router(users.router)
+
+        def override_get_db():
+            with self.SessionLocal() as db:
+                yield db
+
+        app.dependency_overrides[get_db] = override_get_db
+        asyncio.run(warm_up_requests(app))
+        assert not registry.requests
+
+    def test_in_memory_database(self):
+        # HPCADMIN_DATABASE_URL=sqlite:// leaves no async engine, so the
+        # async routes read through the sync one
+        engine = create_db_engine(Settings(database_url="sqlite://"))
+        SessionLocal = sessionmaker(autoflush=False, bind=engine)
+        with patch.object(db, "engine", engine), patch.object(
+            db, "SessionLocal", SessionLocal
+        ), patch.object(async_db, "async_engine", None):
+            with TestClient(create_app()) as client:
+                user = client.post(
+                    "/users/",
+                    json={
+                        "username": "memory",
+                        "firstname": "In",
+                        "lastname": "Memory",
+                        "email": "memory@example.org",
+                        "is_pi": True,
+                        "sponsor_id": None,
+                    },
+                ).json()
+                for path in [
+                    f"/users/{user['id']}",
+                    "/users/memory",
+                    "/users/memory/memberships",
+                    "/users/memory/sponsees",
+                    "/users/memory/sponsors",
+                ]:
+                    assert client.get(path).status_code == 200, path
+                response = client.post(
+                    "/users/memberships:batch", json={"usernames": ["memory"]}
+                )
+                assert response.json() == {"memory": []}
+        engine.dispose()
+        crud.cache.clear()
+
+    def test_uvicorn_options(self):
+        options = serve.uvicorn_options(
+            Settings(host="0.0.0.0", workers=4, backlog=512, keep_alive=10)
+        )
+        assert options["host"] == "0.0.0.0" and options["workers"] == 4
+        assert options["backlog"] == 512 and options["timeout_keep_alive"] == 10
+        assert options["loop"] in ("uvloop", "asyncio")
+        assert options["http"] in ("httptools", "h11")
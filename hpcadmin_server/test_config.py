@@ -0,0 +1,50 @@
+from sqlalchemy import text
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from .config import Settings
+from .database.db import check_connection, create_db_engine
+
+
+class TestConfig:
+    def test_settings_defaults(self):
+        s = Settings.from_env({})
+        assert s == Settings()
+        assert s.echo == False
+
+    def test_settings_from_env(self):
+        s = Settings.from_env(
+            {
+                "HPCADMIN_DATABASE_URL": "postgresql://hpc@db/hpcadmin",
+                "HPCADMIN_POOL_SIZE": "20",
+                "HPCADMIN_POOL_PRE_PING": "false",
+                "HPCADMIN_ECHO": "1",
+            }
+        )
+        assert (
+            s.database_url == "postgresql://hpc@db/hpcadmin"
+            and s.pool_size == 20
+            and s.pool_pre_ping == False
+            and s.echo == True
+        )
+
+    def test_memory_engine_shares_connection(self):
+        engine = create_db_engine(Settings(database_url="sqlite://"))
+        assert isinstance(engine.pool, StaticPool)
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE t (id INTEGER)"))
+        with engine.connect() as connection:
+            connection.execute(text("SELECT * FROM t"))
+
+    def test_file_engine_pragmas(self, tmp_path):
+        engine = create_db_engine(
+            Settings(database_url=f"sqlite:///{tmp_path / 'test.db'}", pool_size=3)
+        )
+        check_connection(engine)
+        assert isinstance(engine.pool, QueuePool) and engine.pool.size() == 3
+        with engine.connect() as connection:
+            journal_mode = connection.execute(text("PRAGMA journal_mode")).scalar()
+            synchronous = connection.execute(text("PRAGMA synchronous")).scalar()
+        assert journal_mode == "wal"
+        # NORMAL
+        assert synchronous == 1
+        engine.dispose()
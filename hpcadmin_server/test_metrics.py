@@ -0,0 +1,112 @@
+import logging
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import sessionmaker
+
+from .api import users
+from .config import Settings
+from .database import crud, models
+from .database.db import create_db_engine, get_db
+from .metrics import Metrics, MetricsMiddleware, instrument_engine
+
+
+class TestMetrics:
+    def setup_class(self):
+        self.engine = create_db_engine(Settings(database_url="sqlite://"))
+        models.Base.metadata.create_all(bind=self.engine)
+        crud.cache.clear()
+        self.registry = Metrics()
+        instrument_engine(self.engine, "sync", registry=self.registry)
+        SessionLocal = sessionmaker(autoflush=False, bind=self.engine)
+
+        def override_get_db():
+            with SessionLocal() as db:
+                yield db
+
+        app = FastAPI()
+        app.add_middleware(
+            MetricsMiddleware,
+            registry=self.registry,
+            slow_request_ms=0,
+            slow_request_queries=5,
+        )
+        app.include_router(users.router)
+        app.dependency_overrides[get_db] = override_get_db
+        self.client = TestClient(app)
+
+    def teardown_class(self):
+        models.Base.metadata.drop_all(bind=self.engine)
+        crud.cache.clear()
+
+    def test_request_recorded_by_route(self):
+        for i in range(3):
+            response = self.client.post(
+                "/users/",
+                json={
+                    "username": f"metric{i}",
+                    "firstname": "Metric",
+                    "lastname": "User",
+                    "email": f"metric{i}@example.org",
+                    "is_pi": False,
+                    "sponsor_id": None,
+                },
+            )
+            assert response.status_code == 200
+        self.client.get("/users/")
+        self.client.get("/nowhere")
+        text = self.registry.render()
+        assert (
+            'hpcadmin_http_requests_total{method="POST",route="/users/",status="200"} 3'
+            in text
+        )
+        assert (
+            'hpcadmin_http_requests_total{method="GET",route="unmatched",status="404"} 1'
+            in text
+        )
+        key = ("POST", "/users/")
+        # every create runs the same statements
+        assert self.registry.queries[key] % 3 == 0 and self.registry.queries[key] > 0
+        assert self.registry.db_seconds[key] > 0
+        assert self.registry.serialization_seconds[key] > 0
+        assert self.registry.durations[key].count == 3
+
+    def test_pool_checkouts(self):
+        self.client.get("/users/")
+        text = self.registry.render()
+        assert 'hpcadmin_db_pool_checkout_seconds_count{engine="sync"}' in text
+        # a StaticPool has no size or overflow to report
+        assert 'hpcadmin_db_pool_checked_out{engine="sync"}' not in text
+
+    def test_pool_checkouts_after_dispose(self):
+        engine = create_db_engine(Settings(database_url="sqlite://"))
+        registry = Metrics()
+        instrument_engine(engine, "disposed", registry=registry)
+        # dispose replaces the pool, which mustn't lose the timing
+        engine.dispose()
+        with engine.connect():
+            pass
+        assert registry.checkouts[("disposed",)].count == 1
+        engine.dispose()
+
+    def test_cache_stats_rendered(self):
+        text = self.registry.render(cache_stats=crud.cache.stats())
+        assert "hpcadmin_cache_hits_total " in text
+        assert "# TYPE hpcadmin_cache_entries gauge" in text
+
+    def test_slow_request_logged(self, caplog):
+        with caplog.at_level(logging.WARNING, logger="hpcadmin_server.metrics"):
+            self.client.post(
+                "/users/",
+                json={
+                    "username": "metric_slow",
+                    "firstname": "Metric",
+                    "lastname": "User",
+                    "email": "metric_slow@example.org",
+                    "is_pi": False,
+                    "sponsor_id": None,
+                },
+            )
+        [record] = caplog.records
+        assert "POST /users/ 200" in record.getMessage()
+        assert "INSERT INTO users" in record.getMessage()
@@ -0,0 +1,208 @@
+import json
+
+import httpx
+import pytest
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+from .api import schemas
+from .config import Settings
+from .database import crud, models
+from .database.db import create_db_engine
+from .outbox import Dispatcher, FileSink, HttpSink, Sink, coalesce, parse_sinks
+
+
+class FlakySink(Sink):
+    def __init__(self, name: str, failures: int):
+        super().__init__(name)
+        self.failures = failures
+        self.attempts = 0
+        self.delivered = []
+
+    def deliver(self, changes):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise ConnectionError("target is down")
+        self.delivered.extend(changes)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestOutbox:
+    def setup_class(self):
+        self.engine = create_db_engine(Settings(database_url="sqlite://"))
+        models.Base.metadata.create_all(bind=self.engine)
+        crud.cache.clear()
+        self.SessionLocal = sessionmaker(autoflush=False, bind=self.engine)
+        with self.SessionLocal.begin() as db:
+            owner = crud.create_user(
+                db,
+                schemas.UserCreate(
+                    username="owner",
+                    firstname="Owner",
+                    lastname="Test",
+                    email="owner@example.com",
+                    is_pi=True,
+                    sponsor_id=None,
+                ),
+            )
+            self.owner_id = owner.id
+
+    def teardown_class(self):
+        models.Base.metadata.drop_all(bind=self.engine)
+        crud.cache.clear()
+
+    def create_user(self, username: str) -> int:
+        with self.SessionLocal.begin() as db:
+            return crud.create_user(
+                db,
+                schemas.UserCreate(
+                    username=username,
+                    firstname=username,
+                    lastname="Test",
+                    email=f"{username}@example.com",
+                    is_pi=False,
+                    sponsor_id=self.owner_id,
+                ),
+            ).id
+
+    def create_pirg(self, name: str, user_ids: list[int]) -> None:
+        with self.SessionLocal.begin() as db:
+            crud.create_pirg(
+                db,
+                schemas.PirgCreate(
+                    name=name, owner_id=self.owner_id, admin_ids=[], user_ids=user_ids
+                ),
+            )
+
+    def remove_from_pirg(self, name: str, user_id: int) -> None:
+        with self.SessionLocal.begin() as db:
+            pirg = crud.get_pirg_by_name(db, name=name)
+            crud.remove_user_from_pirg(db, pirg, crud.get_user(db, id=user_id))
+
+    def cursor(self, target: str) -> int:
+        with self.SessionLocal() as db:
+            return db.scalar(
+                select(models.DeliveryCursor.seq).where(
+                    models.DeliveryCursor.target == target
+                )
+            )
+
+    def test_coalesce(self):
+        fields = ["seq", "entity", "entity_id", "member_id", "role", "action"]
+        changes = [
+            dict(zip(fields, values))
+            for values in [
+                (1, "pirg", 1, None, None, "create"),
+                (2, "pirg", 1, 5, "user", "add"),
+                (3, "pirg", 1, 6, "user", "add"),
+                (4, "pirg", 1, 5, "user", "remove"),
+            ]
+        ]
+        # the add is dropped, the other member's add keeps its place
+        assert [c["seq"] for c in coalesce(changes)] == [1, 3, 4]
+
+    def test_coalesce_updates(self):
+        fields = ["seq", "entity", "entity_id", "member_id", "role", "action"]
+        changes = [
+            dict(zip(fields, values))
+            for values in [
+                (1, "user", 1, None, None, "create"),
+                (2, "user", 1, None, None, "update"),
+                (3, "user", 2, None, None, "update"),
+                (4, "user", 2, None, None, "update"),
+                (5, "user", 2, None, None, "delete"),
+            ]
+        ]
+        # the create isn't replaced by the update after it, the delete replaces
+        # the updates before it
+        assert [c["seq"] for c in coalesce(changes)] == [1, 5]
+
+    def test_parse_sinks(self):
+        ldap, slurm = parse_sinks(
+            "ldap=file:///tmp/ldap.ndjson, slurm=https://slurm/hook"
+        )
+        assert isinstance(ldap, FileSink) and ldap.path == "/tmp/ldap.ndjson"
+        assert isinstance(slurm, HttpSink) and slurm.url == "https://slurm/hook"
+        assert parse_sinks("") == []
+        with pytest.raises(ValueError):
+            parse_sinks("ldap=ftp://host/path")
+
+    def test_file_sink(self, tmp_path):
+        path = tmp_path / "ldap.ndjson"
+        dispatcher = Dispatcher(self.SessionLocal, [FileSink("file", str(path))])
+        # a new target starts from the latest change
+        assert dispatcher.run_once() == 0
+        start = self.cursor("file")
+
+        user_id = self.create_user("filey")
+        self.create_pirg("filepirg", [user_id])
+        self.remove_from_pirg("filepirg", user_id)
+        delivered = dispatcher.run_once()
+        dispatcher.stop()
+
+        changes = [json.loads(line) for line in path.read_text().splitlines()]
+        assert delivered > len(changes)
+        assert [(c["entity"], c["action"]) for c in changes] == [
+            ("user", "create"),
+            ("pirg", "create"),
+            ("pirg", "remove"),
+        ]
+        assert changes[-1]["member_id"] == user_id
+        assert self.cursor("file") == start + delivered
+
+    def test_failing_sink_backs_off(self):
+        clock = Clock()
+        flaky, healthy = FlakySink("flaky", failures=2), FlakySink("healthy", 0)
+        dispatcher = Dispatcher(
+            self.SessionLocal, [flaky, healthy], backoff_base=10, clock=clock
+        )
+        dispatcher.run_once()
+        start = self.cursor("flaky")
+        self.create_user("flaky")
+
+        assert dispatcher.run_once() == 1
+        assert flaky.attempts == 1 and self.cursor("flaky") == start
+        assert len(healthy.delivered) == 1
+
+        # not retried until the backoff is up, then for twice as long
+        clock.now = 5
+        dispatcher.run_once()
+        assert flaky.attempts == 1
+        clock.now = 10
+        dispatcher.run_once()
+        assert flaky.attempts == 2
+        clock.now = 25
+        dispatcher.run_once()
+        assert flaky.attempts == 2
+        clock.now = 30
+        assert dispatcher.run_once() == 1
+        dispatcher.stop()
+        assert flaky.delivered == healthy.delivered
+        assert self.cursor("flaky") == self.cursor("healthy")
+
+    def test_http_sink(self):
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            return httpx.Response(200 if len(requests) > 1 else 503)
+
+        client = httpx.Client(transport=httpx.MockTransport(handler))
+        sink = HttpSink("http", "http://target/changes", client=client)
+        dispatcher = Dispatcher(self.SessionLocal, [sink], backoff_base=0)
+        dispatcher.run_once()
+        self.create_user("httpy")
+        assert dispatcher.run_once() == 0
+        assert dispatcher.run_once() == 1
+        dispatcher.stop()
+
+        assert requests[-1].headers["content-type"] == "application/x-ndjson"
+        (change,) = [json.loads(line) for line in requests[-1].content.splitlines()]
+        assert change["entity"] == "user" and change["name"] == "httpy"